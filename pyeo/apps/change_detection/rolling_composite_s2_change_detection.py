@@ -22,6 +22,27 @@ For each preprocessed image:
 
     Step 7: Update last_date of composite
 
+If --pipeline is given, steps 2 to 7 are run per image as a dependency graph (see pyeo.pipeline), so that an image
+can be stacked and classified while the next image is still being corrected and merged. Completed steps are recorded
+in log/rolling_pipeline.json; rerunning the same command resumes from the last completed step.
+
+If --tile_workers is given, each MGRS tile keeps its own chain of composites, and the tiles are processed in parallel
+worker processes (see pyeo.pipeline.run_tile_shards). With --pipeline too, each worker process runs the pipeline of
+one tile, and each tile's completed steps are recorded in log/rolling_pipeline_[tile].json.
+
+If --scratch_dir /vsimem/ is given, the intermediate stacks and masks made while merging are kept in memory, and only
+the final images are written to images/merged.
+
+If the config file has a [grid] section, every merged image and mask is warped onto that grid (see
+pyeo.coordinate_manipulation.ProjectGrid), so stacking and compositing can line images up by whole pixels.
+
+Every GeoTIFF is written tiled and compressed. The creation options can be changed in an [output] section of the
+config file (see pyeo.raster_manipulation.read_creation_options); with cog=True in that section, the class and
+probability maps are written as cloud-optimised GeoTIFFs with overviews.
+
+Before sen2cor, each L1C image is checked against the sizes and checksums in its manifest.safe; images that fail
+are moved to images/quarantine in the project root rather than processed.
+
  """
 import sys
 
@@ -29,14 +50,179 @@ import pyeo.classification
 import pyeo.queries_and_downloads
 import pyeo.raster_manipulation
 import pyeo.filesystem_utilities
+import pyeo.pipeline
+import pyeo.coordinate_manipulation
+from pyeo.exceptions import BadS2Exception
 
 
 import configparser
 import argparse
+import logging
 import os
 import datetime as dt
 
 
+def detect_change_for_images(tile, image_paths, composite_dir, stacked_image_dir, catagorised_image_dir,
+                             probability_image_dir, model_path, do_stack=True, do_classify=True, do_update=True,
+                             flip_stacks=False, num_chunks=10, cog=False):
+    """
+    Stacks each image in image_paths with its preceding composite, classifies the stack and updates the composite,
+    oldest image first. If tile is given, only composites of that tile are used and new composites are named
+    composite_[tile]_[timestamp].tif, so that each tile keeps its own composite lineage. If cog is True, class and
+    probability maps are saved as cloud-optimised GeoTIFFs.
+    """
+    log = logging.getLogger("pyeo")
+    for new_image_path in image_paths:
+        image = os.path.basename(new_image_path)
+        log.info("Detecting change for {}".format(image))
+
+        try:
+            latest_composite_path = pyeo.filesystem_utilities.get_preceding_image_path(new_image_path,
+                                                                                       composite_dir, tile=tile)
+        except FileNotFoundError:
+            log.warning("No preceding composite found for {}, skipping.".format(new_image_path))
+            continue
+
+        # Stack with preceding composite
+        if do_stack:
+            log.info("Stacking {} with composite {}".format(new_image_path, latest_composite_path))
+            new_stack_path = pyeo.raster_manipulation.stack_image_with_composite(new_image_path, latest_composite_path,
+                                                                                 stacked_image_dir,
+                                                                                 invert_stack=flip_stacks)
+
+        # Classify with composite
+        if do_classify:
+            log.info("Classifying with composite")
+            new_class_image = os.path.join(catagorised_image_dir, "class_{}".format(os.path.basename(new_stack_path)))
+            if probability_image_dir:
+                new_prob_image = os.path.join(probability_image_dir, "prob_{}".format(os.path.basename(new_stack_path)))
+            else:
+                new_prob_image = None
+            pyeo.classification.classify_image(new_stack_path, model_path, new_class_image, new_prob_image,
+                                               num_chunks=num_chunks, skip_existing=True, apply_mask=True, cog=cog)
+
+        # Build new composite
+        if do_update:
+            log.info("Updating composite")
+            new_composite_path = os.path.join(composite_dir, composite_name(image, tile))
+            pyeo.raster_manipulation.composite_images_with_mask(
+                (latest_composite_path, new_image_path), new_composite_path, generate_date_image=True)
+
+
+def composite_name(image_name, tile=None):
+    """The filename of the composite updated with image_name; includes the tile if given."""
+    timestamp = pyeo.filesystem_utilities.get_sen_2_image_timestamp(os.path.basename(image_name))
+    if tile:
+        return "composite_{}_{}.tif".format(tile, timestamp)
+    return "composite_{}.tif".format(timestamp)
+
+
+def build_pipeline_stages(l1_image_dir, l2_image_dir, merged_image_dir, stacked_image_dir, catagorised_image_dir,
+                          probability_image_dir, composite_dir, sen2cor_path, model_path, epsg,
+                          cloud_certainty_threshold, download_l2_data=False, flip_stacks=False, num_chunks=10,
+                          stage_workers=2, shard_by_tile=False, scratch_dir=None, grid=None, cog=False,
+                          mask_strategy="scl+fmask", fast_correction=False, quarantine_dir=None):
+    """Returns the list of pyeo.pipeline.Stages that make up the rolling change detection chain for one image.
+    If shard_by_tile is True, each tile keeps its own composite lineage; use with chain_key=lambda unit: unit.tile.
+    scratch_dir, grid and mask_strategy are passed to pyeo.raster_manipulation.preprocess_sen2_image, and cog to
+    pyeo.classification.classify_image. If fast_correction is True, the sen2cor stage is skipped and the merge stage
+    uses pyeo.raster_manipulation.preprocess_sen2_l1_image on the L1C image instead. If quarantine_dir is given, L1C
+    images that fail pyeo.filesystem_utilities.validate_safe_file are moved there before sen2cor, and their unit
+    fails. stage_workers is the number of images merged at once; sen2cor always runs one image at a time."""
+    log = logging.getLogger("pyeo")
+
+    def sen2cor(unit, results):
+        if fast_correction:
+            return os.path.join(l1_image_dir, unit.name + ".SAFE")
+        if download_l2_data:
+            return os.path.join(l2_image_dir, unit.name + ".SAFE")
+        l1_safe_file = os.path.join(l1_image_dir, unit.name + ".SAFE")
+        try:
+            return pyeo.filesystem_utilities.get_l2_safe_file(l1_safe_file, l2_image_dir)
+        except IndexError:
+            pass
+        if quarantine_dir and pyeo.filesystem_utilities.validate_safe_file(l1_safe_file):
+            pyeo.filesystem_utilities.quarantine_safe_file(l1_safe_file, quarantine_dir)
+            raise BadS2Exception("{} is incomplete or corrupt".format(l1_safe_file))
+        l2_path = pyeo.raster_manipulation.apply_sen2cor(l1_safe_file, sen2cor_path)
+        out_path = os.path.join(l2_image_dir, os.path.basename(l2_path))
+        os.rename(l2_path, out_path)
+        return out_path
+
+    def merge(unit, results):
+        if fast_correction:
+            return pyeo.raster_manipulation.preprocess_sen2_l1_image(results["sen2cor"], merged_image_dir,
+                                                                     epsg=epsg, buffer_size=5,
+                                                                     scratch_dir=scratch_dir, grid=grid,
+                                                                     mask_strategy=mask_strategy)
+        return pyeo.raster_manipulation.preprocess_sen2_image(results["sen2cor"], merged_image_dir, l1_image_dir,
+                                                              cloud_certainty_threshold, epsg=epsg, buffer_size=5,
+                                                              scratch_dir=scratch_dir, grid=grid,
+                                                              mask_strategy=mask_strategy)
+
+    def stack(unit, results):
+        new_image_path = results["merge"]
+        try:
+            latest_composite_path = pyeo.filesystem_utilities.get_preceding_image_path(
+                new_image_path, composite_dir, tile=unit.tile if shard_by_tile else None)
+        except FileNotFoundError:
+            log.warning("No preceding composite found for {}, skipping.".format(new_image_path))
+            return None
+        return pyeo.raster_manipulation.stack_image_with_composite(new_image_path, latest_composite_path,
+                                                                   stacked_image_dir, invert_stack=flip_stacks)
+
+    def classify(unit, results):
+        new_stack_path = results["stack"]
+        if not new_stack_path:
+            return None
+        new_class_image = os.path.join(catagorised_image_dir, "class_{}".format(os.path.basename(new_stack_path)))
+        new_prob_image = None
+        if probability_image_dir:
+            new_prob_image = os.path.join(probability_image_dir, "prob_{}".format(os.path.basename(new_stack_path)))
+        return pyeo.classification.classify_image(new_stack_path, model_path, new_class_image, new_prob_image,
+                                                  num_chunks=num_chunks, skip_existing=True, apply_mask=True,
+                                                  cog=cog)
+
+    def update(unit, results):
+        new_image_path = results["merge"]
+        tile = unit.tile if shard_by_tile else None
+        try:
+            latest_composite_path = pyeo.filesystem_utilities.get_preceding_image_path(new_image_path, composite_dir,
+                                                                                       tile=tile)
+        except FileNotFoundError:
+            return None
+        new_composite_path = os.path.join(composite_dir, composite_name(new_image_path, tile))
+        log.info("Updating composite {} with {}".format(latest_composite_path, new_image_path))
+        return pyeo.raster_manipulation.composite_images_with_mask(
+            (latest_composite_path, new_image_path), new_composite_path, generate_date_image=True)
+
+    return [
+        # Concurrent sen2cor runs in one process share SEN2COR_HOME and overwrite each other's config and logs, and
+        # apply_sen2cor finds its output by the time it started, so sen2cor runs one image at a time
+        pyeo.pipeline.Stage("sen2cor", sen2cor, workers=1),
+        pyeo.pipeline.Stage("merge", merge, requires=("sen2cor",), workers=stage_workers),
+        # The stack needs the composite built from the previous image, so stack and update run in date order
+        pyeo.pipeline.Stage("stack", stack, requires=("merge",), requires_previous=("update",)),
+        pyeo.pipeline.Stage("classify", classify, requires=("stack",)),
+        pyeo.pipeline.Stage("update", update, requires=("merge",), requires_previous=("update",)),
+    ]
+
+
+def run_pipeline_for_tile(tile, image_paths, checkpoint_dir, stage_kwargs):
+    """Runs the stages from build_pipeline_stages(shard_by_tile=True, **stage_kwargs) over the images of one tile,
+    recording completed steps in checkpoint_dir/rolling_pipeline_[tile].json. For use with
+    pyeo.pipeline.run_tile_shards, so that each tile runs in its own process."""
+    # Like parallel_sen2cor, each worker process gets its own sen2cor home
+    sen_2_cor_home = os.getenv("SEN2COR_HOME", os.path.join(os.path.expanduser("~"), "sen2cor"))
+    os.environ["SEN2COR_HOME"] = os.path.join(sen_2_cor_home, "tile_{}".format(tile))
+    os.makedirs(os.environ["SEN2COR_HOME"], exist_ok=True)
+    stages = build_pipeline_stages(shard_by_tile=True, **stage_kwargs)
+    units = [pyeo.pipeline.work_unit_from_path(image_path) for image_path in image_paths]
+    checkpoint_path = os.path.join(checkpoint_dir, "rolling_pipeline_{}.json".format(tile))
+    runner = pyeo.pipeline.PipelineRunner(stages, checkpoint_path, chain_key=lambda unit: unit.tile)
+    return runner.run(units)
+
+
 if __name__ == "__main__":
     do_all = True
 
@@ -96,6 +282,30 @@ if __name__ == "__main__":
 
     parser.add_argument('--skip_prob_image', dest="skip_prob_image", action="store_true", default=False,
                         help="")
+    parser.add_argument('--pipeline', dest="pipeline", action="store_true", default=False,
+                        help="If present, runs sen2cor, merging, stacking, classification and composite updates for "
+                             "each image as a pipeline; an image is stacked and classified as soon as it is ready, "
+                             "and a failed run resumes from the last completed step.")
+    parser.add_argument('--tile_workers', dest="tile_workers", type=int, default=0,
+                        help="If present, each tile keeps its own composite and tiles are processed in this many "
+                             "parallel worker processes, with or without --pipeline. Composites are named "
+                             "composite_[tile]_[timestamp].tif; build the initial composite with this option too.")
+    parser.add_argument('--stage_workers', dest="stage_workers", type=int, default=2,
+                        help="With --pipeline, the number of images to merge at once. sen2cor runs one image at a "
+                             "time in each process; use --tile_workers to run it on several tiles at once.")
+    parser.add_argument('--scratch_dir', dest="scratch_dir", default=None,
+                        help="Where to keep intermediate images when merging. Set to /vsimem/ to keep them in memory, "
+                             "or to a RAM-backed directory such as /dev/shm. Defaults to the system temp directory.")
+    parser.add_argument('--mask_strategy', dest="mask_strategy", default="scl+fmask",
+                        help="The sources of each image's cloud mask, joined with '+': scl (sen2cor scene "
+                             "classification), cld (sen2cor cloud probability above cloud_certainty_threshold), "
+                             "fmask, and heuristic (a quick spectral test; much faster than fmask). Use scl alone "
+                             "to skip fmask. Defaults to scl+fmask.")
+    parser.add_argument('--fast_correction', dest="fast_correction", action="store_true", default=False,
+                        help="If present, skips sen2cor and merges the L1 images directly with an approximate "
+                             "atmospheric correction (dark object subtraction). Much faster, but only gives "
+                             "relative reflectance. Mask sources that need sen2cor (scl, cld) are dropped from "
+                             "--mask_strategy; if none are left, the heuristic mask is used.")
 
     args = parser.parse_args()
 
@@ -120,10 +330,19 @@ if __name__ == "__main__":
     composite_start_date = conf['forest_sentinel']['composite_start']
     composite_end_date = conf['forest_sentinel']['composite_end']
     epsg = int(conf['forest_sentinel']['epsg'])
+    grid = pyeo.coordinate_manipulation.read_project_grid(conf)
+    pyeo.raster_manipulation.read_creation_options(conf)
+    cog = conf.getboolean("output", "cog", fallback=False)
 
     pyeo.filesystem_utilities.create_file_structure(project_root)
     pyeo.filesystem_utilities.create_file_structure(project_root)
     log = pyeo.filesystem_utilities.init_log(log_path)
+
+    mask_strategy = args.mask_strategy
+    if args.fast_correction:
+        mask_strategy = "+".join(source for source in pyeo.raster_manipulation.parse_mask_strategy(mask_strategy)
+                                 if source in pyeo.raster_manipulation.L1_MASK_SOURCES) or "heuristic"
+        log.info("Fast atmospheric correction; using mask strategy {}".format(mask_strategy))
     
     try:
         l1_image_dir = os.path.join(project_root, r"images/L1")
@@ -137,6 +356,7 @@ if __name__ == "__main__":
         composite_l1_image_dir = os.path.join(project_root, r"composite/L1")
         composite_l2_image_dir = os.path.join(project_root, r"composite/L2")
         composite_merged_dir = os.path.join(project_root, r"composite/merged")
+        quarantine_dir = os.path.join(project_root, r"images/quarantine")
 
         if args.skip_prob_image:
             probability_image_dir = None
@@ -168,16 +388,31 @@ if __name__ == "__main__":
                     log.info("{} products remain".format(len(composite_products)))
                 pyeo.queries_and_downloads.download_s2_data(composite_products, composite_l1_image_dir, composite_l2_image_dir,
                                                             source=args.download_source, user=sen_user, passwd=sen_pass, try_scihub_on_fail=True)
-            if args.do_preprocess or do_all and not args.download_l2_data:
+            if args.fast_correction and (args.do_merge or do_all):
+                log.info("Aggregating composite layers with fast atmospheric correction")
+                pyeo.raster_manipulation.preprocess_sen2_l1_images(composite_l1_image_dir, composite_merged_dir,
+                                                                   epsg=epsg, buffer_size=5,
+                                                                   scratch_dir=args.scratch_dir, grid=grid,
+                                                                   mask_strategy=mask_strategy)
+            elif args.do_preprocess or do_all and not args.download_l2_data:
                 log.info("Preprocessing composite products")
                 pyeo.raster_manipulation.atmospheric_correction(composite_l1_image_dir, composite_l2_image_dir, sen2cor_path,
-                                                                delete_unprocessed_image=False)
-            if args.do_merge or do_all:
+                                                                delete_unprocessed_image=False,
+                                                                quarantine_dir=quarantine_dir)
+            if (args.do_merge or do_all) and not args.fast_correction:
                 log.info("Aggregating composite layers")
                 pyeo.raster_manipulation.preprocess_sen2_images(composite_l2_image_dir, composite_merged_dir, composite_l1_image_dir,
-                                                                cloud_certainty_threshold, epsg=epsg, buffer_size=5)
+                                                                cloud_certainty_threshold, epsg=epsg, buffer_size=5,
+                                                                scratch_dir=args.scratch_dir, grid=grid,
+                                                                mask_strategy=mask_strategy)
             log.info("Building initial cloud-free composite")
-            pyeo.raster_manipulation.composite_directory(composite_merged_dir, composite_dir, generate_date_images=True)
+            if args.tile_workers:
+                for tile in set(pyeo.filesystem_utilities.get_sen_2_tiles(composite_merged_dir)):
+                    pyeo.raster_manipulation.composite_directory(composite_merged_dir, composite_dir,
+                                                                 generate_date_images=True, tile=tile)
+            else:
+                pyeo.raster_manipulation.composite_directory(composite_merged_dir, composite_dir,
+                                                             generate_date_images=True)
 
         # Query and download all images since last composite
         if args.do_download or do_all:
@@ -189,16 +424,54 @@ if __name__ == "__main__":
             log.info("Downloading")
             pyeo.queries_and_downloads.download_s2_data(products, l1_image_dir, l2_image_dir, args.download_source, user=sen_user, passwd=sen_pass, try_scihub_on_fail=True)
 
+        if args.pipeline:
+            log.info("Running per-image processing as a pipeline")
+            stage_kwargs = dict(l1_image_dir=l1_image_dir, l2_image_dir=l2_image_dir,
+                                merged_image_dir=merged_image_dir, stacked_image_dir=stacked_image_dir,
+                                catagorised_image_dir=catagorised_image_dir,
+                                probability_image_dir=probability_image_dir if args.build_prob_image else None,
+                                composite_dir=composite_dir, sen2cor_path=sen2cor_path, model_path=model_path,
+                                epsg=epsg, cloud_certainty_threshold=cloud_certainty_threshold,
+                                download_l2_data=args.download_l2_data, flip_stacks=args.flip_stacks,
+                                num_chunks=args.num_chunks, stage_workers=args.stage_workers,
+                                scratch_dir=args.scratch_dir, grid=grid, cog=cog, mask_strategy=mask_strategy,
+                                fast_correction=args.fast_correction, quarantine_dir=quarantine_dir)
+            unit_dir = l2_image_dir if args.download_l2_data and not args.fast_correction else l1_image_dir
+            unit_paths = [record.path for record in
+                          pyeo.filesystem_utilities.get_image_index(unit_dir).records(extension=".SAFE")]
+            if args.tile_workers:
+                # Each tile's chain runs in its own process, so the numpy and GDAL work of different tiles is not
+                # serialised by the GIL
+                log.info("Running the pipeline of each tile in {} worker processes".format(args.tile_workers))
+                pyeo.pipeline.run_tile_shards(run_pipeline_for_tile, unit_paths, processes=args.tile_workers,
+                                              temp_root=os.path.join(project_root, "tmp"),
+                                              args=(os.path.join(project_root, "log"), stage_kwargs))
+            else:
+                stages = build_pipeline_stages(**stage_kwargs)
+                units = [pyeo.pipeline.work_unit_from_path(unit_path) for unit_path in unit_paths]
+                runner = pyeo.pipeline.PipelineRunner(stages, os.path.join(project_root, "log",
+                                                                           "rolling_pipeline.json"))
+                runner.run(units)
+            log.info("***PROCESSING END***")
+            sys.exit(0)
+
         # Atmospheric correction
-        if args.do_preprocess or do_all and not args.download_l2_data:
+        if args.fast_correction and (args.do_merge or do_all):
+            log.info("Aggregating layers with fast atmospheric correction")
+            pyeo.raster_manipulation.preprocess_sen2_l1_images(l1_image_dir, merged_image_dir, epsg=epsg,
+                                                               buffer_size=5, scratch_dir=args.scratch_dir, grid=grid,
+                                                               mask_strategy=mask_strategy)
+        elif args.do_preprocess or do_all and not args.download_l2_data:
             log.info("Applying sen2cor")
-            pyeo.raster_manipulation.atmospheric_correction(l1_image_dir, l2_image_dir, sen2cor_path, delete_unprocessed_image=False)
+            pyeo.raster_manipulation.atmospheric_correction(l1_image_dir, l2_image_dir, sen2cor_path, delete_unprocessed_image=False,
+                                                            quarantine_dir=quarantine_dir)
 
         # Aggregating layers into single image
-        if args.do_merge or do_all:
+        if (args.do_merge or do_all) and not args.fast_correction:
             log.info("Aggregating layers")
             pyeo.raster_manipulation.preprocess_sen2_images(l2_image_dir, merged_image_dir, l1_image_dir, cloud_certainty_threshold, epsg=epsg,
-                                                            buffer_size=5)
+                                                            buffer_size=5, scratch_dir=args.scratch_dir, grid=grid,
+                                                            mask_strategy=mask_strategy)
 
         log.info("Finding most recent composite")
         try:
@@ -227,42 +500,17 @@ if __name__ == "__main__":
             raise FileNotFoundError("No images found in {}. Did your preprocessing complete?".format(merged_image_dir))
         log.info("Images to process: {}".format(images))
 
-        for image in images:
-            log.info("Detecting change for {}".format(image))
-            new_image_path = os.path.join(merged_image_dir, image)
-
-            # Stack with preceding composite
-            if args.do_stack or do_all:
-                try:
-                    latest_composite_path = pyeo.filesystem_utilities.get_preceding_image_path(new_image_path, composite_dir)
-                except FileNotFoundError:
-                    log.warning("No preceding composite found for {}, skipping.".format(new_image_path))
-                    continue
-                log.info("Stacking {} with composite {}".format(new_image_path, latest_composite_path))
-                new_stack_path = pyeo.raster_manipulation.stack_image_with_composite(new_image_path, latest_composite_path, stacked_image_dir,
-                                                                                     invert_stack=args.flip_stacks)
-            #else new_stack_path =
-
-            # Classify with composite
-            if args.do_classify or do_all:
-                log.info("Classifying with composite")
-                new_class_image = os.path.join(catagorised_image_dir, "class_{}".format(os.path.basename(new_stack_path)))
-                if args.build_prob_image:
-                    new_prob_image = os.path.join(probability_image_dir, "prob_{}".format(os.path.basename(new_stack_path)))
-                else:
-                    new_prob_image = None
-                pyeo.classification.classify_image(new_stack_path, model_path, new_class_image, new_prob_image, num_chunks=args.num_chunks,
-                                                   skip_existing=True, apply_mask=True)
-
-            # Build new composite
-            if args.do_update or do_all:
-                log.info("Updating composite")
-                new_composite_path = os.path.join(
-                    composite_dir, "composite_{}.tif".format(
-                        pyeo.filesystem_utilities.get_sen_2_image_timestamp(os.path.basename(image))))
-                pyeo.raster_manipulation.composite_images_with_mask(
-                    (latest_composite_path, new_image_path), new_composite_path, generate_date_image=True)
-                latest_composite_path = new_composite_path
+        detect_change_args = (composite_dir, stacked_image_dir, catagorised_image_dir,
+                              probability_image_dir if args.build_prob_image else None, model_path,
+                              args.do_stack or do_all, args.do_classify or do_all, args.do_update or do_all,
+                              args.flip_stacks, args.num_chunks, cog)
+        image_paths = [os.path.join(merged_image_dir, image) for image in images]
+        if args.tile_workers:
+            log.info("Processing tiles in {} worker processes".format(args.tile_workers))
+            pyeo.pipeline.run_tile_shards(detect_change_for_images, image_paths, processes=args.tile_workers,
+                                          temp_root=os.path.join(project_root, "tmp"), args=detect_change_args)
+        else:
+            detect_change_for_images(None, image_paths, *detect_change_args)
 
         log.info("***PROCESSING END***")
     except Exception:
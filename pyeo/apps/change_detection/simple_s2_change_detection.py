@@ -101,7 +101,7 @@ if __name__ == "__main__":
     # Mosaic stacked layers
     if args.do_stack or do_all:
         log.info("Mosaicking stacked multitemporal images across tiles")
-        pyeo.raster_manipulation.mosaic_images(stacked_image_path, mosaic_image_path, format="GTiff", datatype=gdal.GDT_Int32, nodata=0)
+        pyeo.raster_manipulation.mosaic_images(stacked_image_path, mosaic_image_path, format="GTiff", nodata=0)
 
     # Classify stacks
     if args.do_classify or do_all:
@@ -0,0 +1,66 @@
+"""
+benchmark_cloud_masks
+---------------------
+Times the heuristic cloud and shadow mask against fmask on the same Sentinel-2 image, and reports how well the
+heuristic mask agrees with fmask.
+
+Usage:
+
+::
+
+   $ benchmark_cloud_masks my_l1c_image.SAFE my_output_dir
+
+This will create heuristic.msk and fmask.msk in my_output_dir and log the time each took, the fraction of pixels
+both masks agree on, and the precision and recall of the heuristic's masked pixels, taking fmask as the truth.
+"""
+import pyeo.filesystem_utilities
+import pyeo.raster_manipulation
+
+import argparse
+import gdal
+import numpy as np
+import os
+import time
+
+
+def compare_masks(test_mask_path, reference_mask_path):
+    """Returns the agreement, precision and recall of the masked (0) pixels of test_mask_path against those of
+    reference_mask_path. Both masks must be on the same grid."""
+    test_masked = gdal.Open(test_mask_path).GetRasterBand(1).ReadAsArray() == 0
+    reference_masked = gdal.Open(reference_mask_path).GetRasterBand(1).ReadAsArray() == 0
+    agreement = np.mean(test_masked == reference_masked)
+    true_positives = np.count_nonzero(test_masked & reference_masked)
+    precision = true_positives / max(np.count_nonzero(test_masked), 1)
+    recall = true_positives / max(np.count_nonzero(reference_masked), 1)
+    return agreement, precision, recall
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Compare the speed and accuracy of the heuristic cloud mask and fmask')
+    parser.add_argument("l1_safe_file", help="An L1C .SAFE directory")
+    parser.add_argument("out_dir", help="Where to write both masks")
+    parser.add_argument("--buffer_size", type=int, default=0, help="Buffer to apply to the heuristic mask")
+    parser.add_argument("-l", "--log_path", default=os.path.join(os.getcwd(), "benchmark_cloud_masks.log"))
+    args = parser.parse_args()
+
+    log = pyeo.filesystem_utilities.init_log(args.log_path)
+    os.makedirs(args.out_dir, exist_ok=True)
+    heuristic_path = os.path.join(args.out_dir, "heuristic.msk")
+    fmask_path = os.path.join(args.out_dir, "fmask.msk")
+
+    start = time.perf_counter()
+    pyeo.raster_manipulation.create_mask_from_heuristic(args.l1_safe_file, heuristic_path,
+                                                        buffer_size=args.buffer_size)
+    heuristic_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pyeo.raster_manipulation.create_mask_from_fmask(args.l1_safe_file, fmask_path)
+    fmask_time = time.perf_counter() - start
+
+    agreement, precision, recall = compare_masks(heuristic_path, fmask_path)
+    log.info("Heuristic mask: {:.1f}s".format(heuristic_time))
+    log.info("fmask: {:.1f}s ({:.1f}x slower)".format(fmask_time, fmask_time / heuristic_time))
+    log.info("Agreement with fmask: {:.1%}".format(agreement))
+    log.info("Precision of masked pixels: {:.1%}".format(precision))
+    log.info("Recall of masked pixels: {:.1%}".format(recall))
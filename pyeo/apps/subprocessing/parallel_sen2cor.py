@@ -1,11 +1,27 @@
-import os
-import pyeo.preprocessing
-import pyeo.filesystem_utilities
+"""
+Runs sen2cor over every .SAFE file in a directory, shared between any number of workers.
+
+Start as many copies of this script as you like, on one machine or on several machines that share the L1 and L2
+directories; for example, as the tasks of a PBS or SLURM array job, or just in the background of a workstation.
+Each copy claims images from a work queue in the L2 directory until none are left, so no image is processed
+twice. If a worker dies, its image is picked up by another worker once its lease (--lease, in seconds) runs out.
+
+The path to sen2cor is read from the [sen2cor] section of the config file, or given with --sen2cor_path.
+"""
+
 import argparse
+import configparser
+import logging
+import os
 import shutil
+import sys
 
+import pyeo.filesystem_utilities
 import pyeo.raster_manipulation
-import pyeo.sen2_funcs
+import pyeo.work_queue
+from pyeo.exceptions import BadS2Exception
+
+log = logging.getLogger("pyeo")
 
 
 def moveL2(from_path, to_path):
@@ -14,40 +30,75 @@ def moveL2(from_path, to_path):
     then copies the S2A directory from L1 to L2
     and finally removes S2A directory from L1
     '''
-
-    #TODO Test
-
     if os.path.exists(to_path):
         shutil.rmtree(to_path)
     shutil.copytree(from_path, to_path)
     shutil.rmtree(from_path)
 
+
+def process_l1_image(l1_path, l2_dir, sen2cor_path, quarantine_dir=None):
+    """Runs sen2cor on l1_path and moves the result to l2_dir. Returns the path of the L2 product. If quarantine_dir
+    is given, l1_path is first checked against its manifest, and moved to quarantine_dir if it is incomplete."""
+    if quarantine_dir and pyeo.filesystem_utilities.validate_safe_file(l1_path):
+        pyeo.filesystem_utilities.quarantine_safe_file(l1_path, quarantine_dir)
+        raise BadS2Exception("{} is incomplete or corrupt".format(l1_path))
+    l2_name = pyeo.raster_manipulation.apply_sen2cor(l1_path, sen2cor_path)
+    from_path = os.path.join(os.path.dirname(l1_path), os.path.basename(l2_name))
+    to_path = os.path.join(l2_dir, os.path.basename(l2_name))
+    log.info("l2_name  : {}".format(l2_name))
+    log.info("Moving   : {}".format(from_path))
+    log.info("Moving to: {}".format(to_path))
+    moveL2(from_path, to_path)
+    return to_path
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Parallel sen2cor')
     parser.add_argument('l1_dir', action='store', help="Path to the directory containing L1 imagery")
     parser.add_argument('l2_dir', action='store', help="Path to directory to contain L2 imagery")
-    array_id = int(os.getenv("PBS_ARRAYID"))
-    sen_2_cor_home = os.getenv("SEN2COR_HOME")
+    parser.add_argument('--config', dest='config_path', action='store', default=None,
+                        help="A config file with the path to sen2cor in its [sen2cor] section")
+    parser.add_argument('--sen2cor_path', action='store', default=None,
+                        help="Path to L2A_Process. Overrides the config file.")
+    parser.add_argument('--queue_dir', action='store', default=None,
+                        help="Directory holding the work queue. Defaults to l2_dir/.sen2cor_queue")
+    parser.add_argument('--lease', action='store', type=int, default=3600,
+                        help="Seconds without a heartbeat before an image claimed by a worker is given to another")
+    parser.add_argument('--quarantine_dir', action='store', default=None,
+                        help="If given, each image is checked against its manifest before sen2cor, and incomplete "
+                             "or corrupt images are moved here and marked as failed")
+    parser.add_argument('--retry_failed', action='store_true', default=False,
+                        help="If present, images that failed on an earlier run are queued again")
     args = parser.parse_args()
 
-    log = pyeo.filesystem_utilities.init_log("sen2cor_{}.log".format(array_id))
+    sen2cor_path = args.sen2cor_path
+    if not sen2cor_path and args.config_path:
+        conf = configparser.ConfigParser(allow_no_value=True)
+        conf.read(args.config_path)
+        sen2cor_path = conf['sen2cor']['path']
+    if not sen2cor_path:
+        parser.error("Give the path to sen2cor with --sen2cor_path or --config")
+
+    queue_dir = args.queue_dir if args.queue_dir else os.path.join(args.l2_dir, ".sen2cor_queue")
+    queue = pyeo.work_queue.FileWorkQueue(queue_dir, lease_seconds=args.lease)
 
-    new_home = os.path.join((sen_2_cor_home), str(array_id))
+    log = pyeo.filesystem_utilities.init_log(os.path.join(queue_dir, "sen2cor_{}.log".format(queue.worker_id)))
+
+    # Each worker needs its own sen2cor home, or concurrent runs overwrite each other's config and logs
+    sen_2_cor_home = os.getenv("SEN2COR_HOME", os.path.join(os.path.expanduser("~"), "sen2cor"))
+    new_home = os.path.join(sen_2_cor_home, queue.worker_id)
     log.info("Setting SEN2COR_HOME to {}".format(new_home))
-    try:
-        os.mkdir(new_home)
-    except FileExistsError:
-        log.warning("{} already exists, continuing.".format(new_home))
-    os.putenv("SEN2COR_HOME", new_home)
-
-    file_list = [os.path.join(args.l1_dir, l1_filename) for l1_filename in sorted(os.listdir(args.l1_dir))]
-
-    l2_name = pyeo.raster_manipulation.apply_sen2cor(file_list[array_id],
-                                      r"/scratch/clcr/shared/Sen2Cor-02.05.05-Linux64/bin/L2A_Process")
-    from_path = os.path.join(args.l1_dir, os.path.basename(l2_name))
-    to_path = os.path.join(args.l2_dir, os.path.basename(l2_name))
-    log.info("l2_name  : {}".format(l2_name))
-    log.info("Moving   : {}".format(from_path))
-    log.info("Moving to: {}".format(to_path))
-    moveL2(from_path, to_path)
+    os.makedirs(new_home, exist_ok=True)
+    os.environ["SEN2COR_HOME"] = new_home
+
+    if args.retry_failed:
+        queue.retry_failed()
+    # sen2cor writes its L2A output into l1_dir before it is moved, so only L1C products are queued
+    queue.enqueue([os.path.join(args.l1_dir, l1_filename) for l1_filename in sorted(os.listdir(args.l1_dir))
+                   if l1_filename.startswith("MSIL1C", 4) and l1_filename.endswith(".SAFE")])
 
+    done, failed = pyeo.work_queue.run_worker(queue, lambda l1_path: process_l1_image(l1_path, args.l2_dir,
+                                                                                      sen2cor_path,
+                                                                                      args.quarantine_dir))
+    log.info("Queue status: {}".format(queue.status()))
+    sys.exit(1 if failed else 0)
@@ -22,7 +22,8 @@ from sklearn.model_selection import cross_val_score
 from pyeo.coordinate_manipulation import get_local_top_left
 from pyeo.filesystem_utilities import get_mask_path
 
-from pyeo.raster_manipulation import stack_images, create_matching_dataset, apply_array_image_mask, get_masked_array
+from pyeo.raster_manipulation import stack_images, create_matching_dataset, apply_array_image_mask, get_masked_array, \
+    get_creation_options, save_as_cog
 
 import pyeo.windows_compatability
 
@@ -64,7 +65,7 @@ def change_from_composite(image_path, composite_path, model_path, class_out_path
 
 
 def classify_image(image_path, model_path, class_out_path, prob_out_path=None,
-                   apply_mask=False, out_type="GTiff", num_chunks=10, nodata=0, skip_existing = False):
+                   apply_mask=False, out_type="GTiff", num_chunks=10, nodata=0, skip_existing = False, cog=False):
     """
     Produces a class map from a raster and a model.
     This applies the model's fit() function to each pixel in the input raster, and saves the result into an output
@@ -94,6 +95,9 @@ def classify_image(image_path, model_path, class_out_path, prob_out_path=None,
         The value to write to masked pixels
     skip_existing
         If true, do not run if class_out_path already exists
+    cog
+        If true, the class and probability images are converted to cloud-optimised GeoTIFFs with overviews once
+        they are written. See pyeo.raster_manipulation.save_as_cog.
 
 
     Notes
@@ -221,6 +225,10 @@ def classify_image(image_path, model_path, class_out_path, prob_out_path=None,
 
     class_out_image = None
     prob_out_image = None
+    if cog:
+        save_as_cog(class_out_path, resampling="NEAREST")
+        if prob_out_path:
+            save_as_cog(prob_out_path, resampling="AVERAGE")
     if prob_out_path:
         return class_out_path, prob_out_path
     else:
@@ -648,7 +656,7 @@ def raster_reclass_binary(img_path, rcl_value, outFn, outFmt='GTiff', write_out=
     if write_out:
         driver = gdal.GetDriverByName(outFmt)
         out_ds = driver.Create(outFn, in_band.XSize, in_band.YSize, 1,
-                               in_band.DataType)
+                               in_band.DataType, options=get_creation_options(outFmt, in_band.DataType))
         out_ds.SetProjection(in_ds.GetProjection())
         out_ds.SetGeoTransform(in_ds.GetGeoTransform())
         # Todo: Check for existing files. Skip if exists or make overwrite optional.
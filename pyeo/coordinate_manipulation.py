@@ -13,13 +13,21 @@ These functions all work on the objects provided by the ogr and gdal libraries.
 processing, a gdal.Image object is usually the output from gdal.Open() and an ogr.Geometry object can be obtained from
 a well-known text (wkt) string using the  snipped `object=ogr.ImportFromWkt("mywkt"). For more information on wkt, see
 https://en.wikipedia.org/wiki/Well-known_text_representation_of_geometry and the "QuickWKT" QGIS plugin.
+
+For axis-aligned rasters, most of this work is rectangle arithmetic. The functions get_raster_extent,
+bounds_intersection, bounds_union and bounds_to_pixel_window work on plain (x_min, x_max, y_min, y_max) tuples
+(the same order as ogr.Geometry.GetEnvelope()) without creating any OGR objects; pixel_bounds_from_polygon uses them
+whenever the polygon is a rectangle, and only falls back to OGR for other shapes.
 """
+import json
+import os
 import subprocess
 
 import numpy as np
 from osgeo import osr, ogr
 import logging
 log = logging.getLogger("pyeo")
+from pyeo.dataset_cache import get_raster_info
 import pyeo.windows_compatability
 
 def reproject_geotransform(in_gt, old_proj_wkt, new_proj_wkt):
@@ -81,6 +89,33 @@ def get_combined_polygon(rasters, geometry_mode ="intersect"):
     return combined_polygons
 
 
+def get_combined_bounds(rasters, geometry_mode="intersect"):
+    """
+    Returns the bounding rectangle of the combined area of rasters as a tuple, using arithmetic only. For rasters,
+    this is the envelope of get_combined_polygon.
+
+    Parameters
+    ----------
+    rasters
+        A list of raster objects opened with gdal.Open()
+    geometry_mode
+        If 'intersect', returns the area that all rasters cover.
+        If 'union', returns the bounding rectangle of the area that any raster covers.
+
+    Returns
+    -------
+    A tuple of (x_min, x_max, y_min, y_max), or None if geometry_mode is 'intersect' and the rasters do not overlap.
+
+    """
+    extents = [get_raster_extent(raster) for raster in rasters]
+    if geometry_mode == "intersect":
+        return bounds_intersection(*extents)
+    elif geometry_mode == "union":
+        return bounds_union(*extents)
+    else:
+        raise Exception("Invalid geometry mode")
+
+
 def multiple_union(polygons):
     """
     Takes a list of polygons and returns a polygon of the union of their perimeter
@@ -132,13 +167,28 @@ def pixel_bounds_from_polygon(raster, polygon):
         A gdal raster object
 
     polygon
-        A ogr.Geometry object containing a single polygon
+        A ogr.Geometry object containing a single polygon, or a tuple of (x_min, x_max, y_min, y_max)
 
     Returns
     -------
     A tuple (x_min, x_max, y_min, y_max)
 
+    Notes
+    -----
+    If polygon is a tuple or a rectangle, this is calculated with arithmetic only; see bounds_to_pixel_window.
+
     """
+    if isinstance(polygon, (tuple, list)):
+        bounds = tuple(polygon)
+    elif is_rectangle(polygon):
+        bounds = polygon.GetEnvelope()
+    else:
+        bounds = None
+    if bounds:
+        overlap = bounds_intersection(get_raster_extent(raster), bounds)
+        if overlap:
+            return bounds_to_pixel_window(raster.GetGeoTransform(), overlap)
+        polygon = bounds_to_polygon(bounds)
     raster_bounds = get_raster_bounds(raster)
     intersection = get_poly_intersection(raster_bounds, polygon)
     bounds_geo = intersection.Boundary()
@@ -153,6 +203,144 @@ def pixel_bounds_from_polygon(raster, polygon):
     return x_min_pixel, x_max_pixel, y_min_pixel, y_max_pixel
 
 
+def get_raster_extent(raster):
+    """
+    Returns the bounding rectangle of a raster as a tuple, without creating an OGR geometry. The top left corner is
+    rounded down in the same way as in get_raster_bounds.
+
+    Parameters
+    ----------
+    raster
+        A gdal.Image object, or a path to a raster. Paths are read from the metadata cache in pyeo.dataset_cache, so
+        the raster is only opened the first time.
+
+    Returns
+    -------
+    A tuple of (x_min, x_max, y_min, y_max)
+
+    """
+    if isinstance(raster, str):
+        info = get_raster_info(raster)
+        geotrans, x_size, y_size = info.geotransform, info.x_size, info.y_size
+    else:
+        geotrans, x_size, y_size = raster.GetGeoTransform(), raster.RasterXSize, raster.RasterYSize
+    top_left_x = floor_to_resolution(geotrans[0], geotrans[1])
+    top_left_y = floor_to_resolution(geotrans[3], geotrans[5]*-1)
+    width = geotrans[1]*x_size
+    height = geotrans[5]*y_size * -1
+    return top_left_x, top_left_x + width, top_left_y - height, top_left_y
+
+
+def bounds_intersection(*bounds):
+    """
+    Returns the intersection of any number of rectangles.
+
+    Parameters
+    ----------
+    bounds
+        Tuples of (x_min, x_max, y_min, y_max)
+
+    Returns
+    -------
+    A tuple of (x_min, x_max, y_min, y_max), or None if the rectangles do not all overlap.
+
+    """
+    x_min = max(bound[0] for bound in bounds)
+    x_max = min(bound[1] for bound in bounds)
+    y_min = max(bound[2] for bound in bounds)
+    y_max = min(bound[3] for bound in bounds)
+    if x_min >= x_max or y_min >= y_max:
+        return None
+    return x_min, x_max, y_min, y_max
+
+
+def bounds_union(*bounds):
+    """
+    Returns the bounding rectangle of any number of rectangles.
+
+    Parameters
+    ----------
+    bounds
+        Tuples of (x_min, x_max, y_min, y_max)
+
+    Returns
+    -------
+    A tuple of (x_min, x_max, y_min, y_max)
+
+    """
+    return (min(bound[0] for bound in bounds), max(bound[1] for bound in bounds),
+            min(bound[2] for bound in bounds), max(bound[3] for bound in bounds))
+
+
+def bounds_to_pixel_window(gt, bounds):
+    """
+    Converts a rectangle in geographic coordinates to pixel bounds in a raster with geotransform gt. Gives the same
+    result as calling point_to_pixel_coordinates on two opposite corners.
+
+    Parameters
+    ----------
+    gt
+        The geotransform of a north-up, non-rotated raster
+    bounds
+        A tuple of (x_min, x_max, y_min, y_max) in the projection of the raster
+
+    Returns
+    -------
+    A tuple of (x_min, x_max, y_min, y_max) pixel indicies.
+
+    """
+    origin_x = floor_to_resolution(gt[0], gt[1])
+    origin_y = floor_to_resolution(gt[3], gt[5]*-1)
+    x_pixels = sorted((int(np.floor((bounds[0] - origin_x)/gt[1])), int(np.floor((bounds[1] - origin_x)/gt[1]))))
+    y_pixels = sorted((int(np.floor((bounds[2] - origin_y)/gt[5])), int(np.floor((bounds[3] - origin_y)/gt[5]))))
+    return x_pixels[0], x_pixels[1], y_pixels[0], y_pixels[1]
+
+
+def is_rectangle(polygon):
+    """
+    Returns True if polygon is a single axis-aligned rectangle, so that it is the same as its envelope.
+
+    Parameters
+    ----------
+    polygon
+        An ogr.Geometry object
+
+    """
+    if polygon.GetGeometryName() != "POLYGON" or polygon.GetGeometryCount() != 1:
+        return False
+    if polygon.GetGeometryRef(0).GetPointCount() > 5:
+        return False
+    x_min, x_max, y_min, y_max = polygon.GetEnvelope()
+    envelope_area = (x_max - x_min)*(y_max - y_min)
+    return envelope_area > 0 and abs(polygon.GetArea() - envelope_area) <= 1e-9*envelope_area
+
+
+def bounds_to_polygon(bounds):
+    """
+    Returns a rectangular polygon from a tuple of (x_min, x_max, y_min, y_max).
+
+    Parameters
+    ----------
+    bounds
+        A tuple of (x_min, x_max, y_min, y_max)
+
+    Returns
+    -------
+    An ogr.Geometry object containing a single wkbPolygon.
+
+    """
+    x_min, x_max, y_min, y_max = bounds
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    ring.AddPoint(x_min, y_min)
+    ring.AddPoint(x_max, y_min)
+    ring.AddPoint(x_max, y_max)
+    ring.AddPoint(x_min, y_max)
+    ring.AddPoint(x_min, y_min)
+    bounds_poly = ogr.Geometry(ogr.wkbPolygon)
+    bounds_poly.AddGeometry(ring)
+    return bounds_poly
+
+
 def point_to_pixel_coordinates(raster, point, oob_fail=False):
     """
     Returns a tuple (x_pixel, y_pixel) in a georaster raster corresponding to the geographic point in a projection.
@@ -217,6 +405,62 @@ def pixel_to_point_coordinates(pixel, GT):
     return Xgeo, Ygeo
 
 
+def pixels_to_points(pixels, GT, pixel_centre=False):
+    """
+    The array version of pixel_to_point_coordinates: converts many pixels to geographic coordinates at once.
+    NOTE: Like pixel_to_point_coordinates, this takes pixels in the form (y, x).
+
+    Parameters
+    ----------
+    pixels
+        An array-like of shape (N, 2), where each row is the (y, x) index of a pixel
+    GT
+        A six-element geotransform
+    pixel_centre
+        If True, returns the centre of each pixel instead of its top-left corner.
+
+    Returns
+    -------
+    A float64 numpy array of shape (N, 2), where each row is the (x, y) geographic coordinates of a pixel.
+
+    """
+    pixels = np.asarray(pixels, dtype=np.float64).reshape(-1, 2)
+    y_lines = pixels[:, 0]
+    x_pixels = pixels[:, 1]
+    if pixel_centre:
+        y_lines = y_lines + 0.5
+        x_pixels = x_pixels + 0.5
+    out = np.empty(pixels.shape, dtype=np.float64)
+    out[:, 0] = GT[0] + x_pixels * GT[1] + y_lines * GT[2]
+    out[:, 1] = GT[3] + x_pixels * GT[4] + y_lines * GT[5]
+    return out
+
+
+def points_to_pixels(raster, points):
+    """
+    The array version of point_to_pixel_coordinates: converts many geographic points to pixel indicies at once.
+    Assumes raster is north-up non rotated.
+
+    Parameters
+    ----------
+    raster
+        A gdal raster object, or a six-element geotransform
+    points
+        An array-like of shape (N, 2), where each row is an (x, y) point in the projection of the raster
+
+    Returns
+    -------
+    An int64 numpy array of shape (N, 2), where each row is the (x_pixel, y_pixel) index of a point.
+
+    """
+    gt = raster if isinstance(raster, (tuple, list, np.ndarray)) else raster.GetGeoTransform()
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    out = np.empty(points.shape, dtype=np.int64)
+    out[:, 0] = np.floor((points[:, 0] - floor_to_resolution(gt[0], gt[1]))/gt[1])
+    out[:, 1] = np.floor((points[:, 1] - floor_to_resolution(gt[3], gt[5]*-1))/gt[5])  # y resolution is -ve
+    return out
+
+
 def write_geometry(geometry, out_path, srs_id=4326):
     """
     Saves the geometry in an ogr.Geometry object to a shapefile.
@@ -256,6 +500,99 @@ def write_geometry(geometry, out_path, srs_id=4326):
     data_source = None
 
 
+VECTOR_DRIVERS = {
+    ".shp": "ESRI Shapefile",
+    ".gpkg": "GPKG",
+    ".fgb": "FlatGeobuf",
+    ".geojson": "GeoJSON",
+    ".json": "GeoJSON"
+}
+
+
+def write_points(coords, out_path, projection, fields=None, layer_name="points", driver_name=None):
+    """
+    Writes an array of points to a vector file in a single transaction.
+
+    Parameters
+    ----------
+    coords
+        An array-like of shape (N, 2), where each row is an (x, y) point
+    out_path
+        The path to the output file. If it already exists, it is overwritten.
+    projection
+        The projection of coords; an EPSG number or a WKT string.
+    fields
+        Optional. A dictionary of {field name: array-like of N values}. String fields are created for arrays of
+        strings or objects, integer fields for integer arrays and real fields for anything else.
+    layer_name
+        The name of the new layer
+    driver_name
+        The OGR driver to write with. If None, chosen from the extension of out_path: .shp, .gpkg, .fgb
+        (FlatGeobuf, GDAL 3.1 or later) or .geojson. Any other path, such as a directory, is written as a shapefile.
+
+    Returns
+    -------
+    out_path
+
+    Notes
+    -----
+    Geometries are built directly from the coordinates, and every feature is written inside one transaction. For
+    GeoPackage, this means one SQLite commit for the whole layer instead of one per feature, which is what makes large
+    point sets slow to write.
+
+    """
+    if driver_name is None:
+        extension = os.path.splitext(out_path)[1].lower()
+        driver_name = VECTOR_DRIVERS.get(extension, "ESRI Shapefile")
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    fields = fields if fields else {}
+    field_values = {name: np.asarray(values) for name, values in fields.items()}
+
+    driver = ogr.GetDriverByName(driver_name)
+    if driver is None:
+        raise ValueError("OGR driver {} is not available in this GDAL build".format(driver_name))
+    if os.path.isfile(out_path):
+        driver.DeleteDataSource(out_path)
+    data_source = driver.CreateDataSource(out_path)
+    srs = osr.SpatialReference()
+    if type(projection) is int:
+        srs.ImportFromEPSG(projection)
+    else:
+        srs.ImportFromWkt(projection)
+    layer = data_source.CreateLayer(layer_name, srs, ogr.wkbPoint)
+    for name, values in field_values.items():
+        if values.dtype.kind in "iub":
+            layer.CreateField(ogr.FieldDefn(name, ogr.OFTInteger64))
+        elif values.dtype.kind == "f":
+            layer.CreateField(ogr.FieldDefn(name, ogr.OFTReal))
+        else:
+            string_field = ogr.FieldDefn(name, ogr.OFTString)
+            string_field.SetWidth(max(24, max((len(str(value)) for value in values), default=0)))
+            layer.CreateField(string_field)
+    # Python scalars, so OGR doesn't have to cope with numpy types
+    columns = [(layer.GetLayerDefn().GetFieldIndex(name), values.tolist()) for name, values in field_values.items()]
+
+    layer_defn = layer.GetLayerDefn()
+    layer.StartTransaction()
+    try:
+        for i, (x, y) in enumerate(coords.tolist()):
+            feature = ogr.Feature(layer_defn)
+            point = ogr.Geometry(ogr.wkbPoint)
+            point.AddPoint_2D(x, y)
+            feature.SetGeometryDirectly(point)
+            for field_index, values in columns:
+                feature.SetField(field_index, values[i])
+            layer.CreateFeature(feature)
+            feature = None
+        layer.CommitTransaction()
+    except Exception:
+        layer.RollbackTransaction()
+        raise
+    layer = None
+    data_source = None
+    return out_path
+
+
 def reproject_vector(in_path, out_path, dest_srs):
     """
     Reprojects a vector file to a new SRS. Simple wrapper for ogr2ogr.
@@ -565,3 +902,164 @@ def get_local_top_left(raster1, raster2):
     # TODO: Test this
     inner_gt = raster2.GetGeoTransform()
     return point_to_pixel_coordinates(raster1, [inner_gt[0], inner_gt[3]])
+
+
+class ProjectGrid(object):
+    """
+    A fixed output grid for a project. Every product snapped to the same grid has pixels that line up exactly, so
+    images can be stacked, mosaicked and composited using whole-pixel offsets (see get_grid_windows).
+
+    Parameters
+    ----------
+    projection
+        The projection of the grid, as well-known text or an EPSG number
+    resolution
+        The pixel size of the grid, in the units of projection
+    origin_x, origin_y
+        A corner of any one pixel of the grid. Defaults to (0, 0), which matches the Sentinel-2 and Landsat UTM grids.
+    tile_extents
+        Optional. A dictionary of {tile: (x_min, x_max, y_min, y_max)}. Products from a tile in this dictionary are
+        given exactly this extent.
+    """
+    def __init__(self, projection, resolution, origin_x=0, origin_y=0, tile_extents=None):
+        if type(projection) is int:
+            proj = osr.SpatialReference()
+            proj.ImportFromEPSG(projection)
+            projection = proj.ExportToWkt()
+        self.projection = projection
+        self.resolution = resolution
+        self.origin_x = origin_x
+        self.origin_y = origin_y
+        self.tile_extents = tile_extents if tile_extents else {}
+
+    def snap_bounds(self, x_min, x_max, y_min, y_max):
+        """Returns (x_min, x_max, y_min, y_max) expanded outwards to the nearest pixel edges of the grid."""
+        res = self.resolution
+        return (self.origin_x + np.floor((x_min - self.origin_x) / res) * res,
+                self.origin_x + np.ceil((x_max - self.origin_x) / res) * res,
+                self.origin_y + np.floor((y_min - self.origin_y) / res) * res,
+                self.origin_y + np.ceil((y_max - self.origin_y) / res) * res)
+
+    def get_output_bounds(self, raster, tile=None):
+        """
+        Returns the (x_min, x_max, y_min, y_max) bounds on this grid that a raster should be warped to.
+
+        Parameters
+        ----------
+        raster
+            A gdal.Image object, in any projection
+        tile
+            The tile of the raster. If it is in tile_extents, the extent of that tile is returned.
+
+        Returns
+        -------
+        A tuple of (x_min, x_max, y_min, y_max) in the projection of the grid.
+
+        """
+        if tile in self.tile_extents:
+            return tuple(self.tile_extents[tile])
+        gt = raster.GetGeoTransform()
+        x_size = raster.RasterXSize
+        y_size = raster.RasterYSize
+        # Corners and edge midpoints of the raster, to allow for curved edges after reprojection
+        pixels = [(x, y) for x in (0, x_size / 2, x_size) for y in (0, y_size / 2, y_size)]
+        points = [(gt[0] + x * gt[1] + y * gt[2], gt[3] + x * gt[4] + y * gt[5]) for x, y in pixels]
+        in_proj = osr.SpatialReference()
+        in_proj.ImportFromWkt(raster.GetProjection())
+        out_proj = osr.SpatialReference()
+        out_proj.ImportFromWkt(self.projection)
+        if not in_proj.IsSame(out_proj):
+            transform = osr.CoordinateTransformation(in_proj, out_proj)
+            points = [transform.TransformPoint(x, y)[:2] for x, y in points]
+        xs = [point[0] for point in points]
+        ys = [point[1] for point in points]
+        return self.snap_bounds(min(xs), max(xs), min(ys), max(ys))
+
+
+def read_project_grid(conf):
+    """
+    Reads a ProjectGrid from the [grid] section of a config file.
+
+    Parameters
+    ----------
+    conf
+        A configparser.ConfigParser object. The [grid] section should contain epsg and resolution, and can contain
+        origin_x, origin_y and tile_extents, a path to a json file of {tile: [x_min, x_max, y_min, y_max]}.
+
+    Returns
+    -------
+    A ProjectGrid, or None if the config has no [grid] section.
+
+    """
+    if not conf.has_section("grid"):
+        return None
+    grid_conf = conf["grid"]
+    tile_extents = None
+    if grid_conf.get("tile_extents"):
+        with open(grid_conf["tile_extents"]) as fp:
+            tile_extents = json.load(fp)
+    return ProjectGrid(int(grid_conf["epsg"]), float(grid_conf["resolution"]),
+                       float(grid_conf.get("origin_x", 0)), float(grid_conf.get("origin_y", 0)), tile_extents)
+
+
+def get_grid_windows(rasters, geometry_mode="intersect", tolerance=1e-6):
+    """
+    If every raster in rasters is on the same pixel grid, returns the geotransform and size of their combined extent
+    and the pixel window of each raster within it, using whole-pixel arithmetic and no OGR geometry.
+
+    Parameters
+    ----------
+    rasters
+        A list of gdal.Image objects
+    geometry_mode
+        'intersect' or 'union'
+    tolerance
+        How far, in pixels, two rasters' pixel edges can be apart and still count as on the same grid.
+
+    Returns
+    -------
+    None if the rasters are not on the same grid (different projections, pixel sizes, rotations or fractional
+    offsets) or do not overlap in 'intersect' mode. Otherwise, a tuple of (geotransform, (x_size, y_size), windows),
+    where windows is a list with, for each raster, a tuple of ((in_x_min, in_x_max, in_y_min, in_y_max),
+    (out_x_min, out_x_max, out_y_min, out_y_max)): the pixel bounds of the part of that raster within the combined
+    extent, and where they are in the combined extent.
+
+    """
+    first_gt = rasters[0].GetGeoTransform()
+    projection = rasters[0].GetProjection()
+    extents = []
+    for raster in rasters:
+        gt = raster.GetGeoTransform()
+        if gt[2] != 0 or gt[4] != 0 or raster.GetProjection() != projection:
+            return None
+        if abs(gt[1] - first_gt[1]) > tolerance * abs(first_gt[1]) or \
+                abs(gt[5] - first_gt[5]) > tolerance * abs(first_gt[5]):
+            return None
+        x_offset = (gt[0] - first_gt[0]) / first_gt[1]
+        y_offset = (gt[3] - first_gt[3]) / first_gt[5]
+        if abs(x_offset - round(x_offset)) > tolerance or abs(y_offset - round(y_offset)) > tolerance:
+            return None
+        x_offset = int(round(x_offset))
+        y_offset = int(round(y_offset))
+        extents.append((x_offset, x_offset + raster.RasterXSize, y_offset, y_offset + raster.RasterYSize))
+
+    if geometry_mode == "intersect":
+        combined = bounds_intersection(*extents)
+        if combined is None:
+            return None
+    elif geometry_mode == "union":
+        combined = bounds_union(*extents)
+    else:
+        raise ValueError("geometry_mode must be 'intersect' or 'union'")
+    x_min, x_max, y_min, y_max = combined
+
+    out_gt = (first_gt[0] + x_min * first_gt[1], first_gt[1], 0,
+              first_gt[3] + y_min * first_gt[5], 0, first_gt[5])
+    windows = []
+    for extent in extents:
+        window_x_min, window_x_max, window_y_min, window_y_max = bounds_intersection(extent, combined)
+        windows.append(((window_x_min - extent[0], window_x_max - extent[0],
+                         window_y_min - extent[2], window_y_max - extent[2]),
+                        (window_x_min - x_min, window_x_max - x_min,
+                         window_y_min - y_min, window_y_max - y_min)))
+    return out_gt, (x_max - x_min, y_max - y_min), windows
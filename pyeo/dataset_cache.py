@@ -0,0 +1,162 @@
+"""
+pyeo.dataset_cache
+------------------
+A pool of open, read-only GDAL datasets and a cache of raster metadata, to avoid opening and parsing the header of
+the same file (and, for .jp2 bands, decoding its metadata) many times in one processing step.
+
+Datasets and metadata are keyed by the absolute path, modification time and size of the file, so a file that is
+rewritten is opened again rather than served from the cache. GDAL dataset handles must not be shared between
+threads, so each thread has its own pool of handles; the metadata cache is shared.
+
+Pooled handles stay open until they are pushed out of the pool or close_all_datasets() is called, so disk space from
+a deleted file may not be freed until then. Files in /vsimem/ and other GDAL virtual filesystems are never pooled.
+"""
+
+import collections
+import logging
+import os
+import threading
+
+import gdal
+
+log = logging.getLogger("pyeo")
+
+RasterInfo = collections.namedtuple("RasterInfo", ["path", "x_size", "y_size", "band_count", "datatype",
+                                                   "geotransform", "projection", "bounds"])
+RasterInfo.__doc__ = """Metadata of a raster. datatype is the GDAL datatype of the first band; bounds is a tuple of
+(x_min, x_max, y_min, y_max) calculated from the geotransform."""
+
+
+def _file_key(path):
+    """Returns (abspath, mtime, size) for a file on disk, or None for virtual or missing files."""
+    if path.startswith("/vsi"):
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+class DatasetPool(object):
+    """
+    A least-recently-used pool of read-only gdal.Dataset handles, with one pool per thread.
+
+    Parameters
+    ----------
+    max_size
+        The most handles each thread keeps open.
+    """
+    def __init__(self, max_size=32):
+        self.max_size = max_size
+        self._local = threading.local()
+
+    def _handles(self):
+        if not hasattr(self._local, "handles"):
+            self._local.handles = collections.OrderedDict()
+        return self._local.handles
+
+    def open(self, path):
+        """
+        Returns a read-only gdal.Dataset for path, reusing an open handle if this thread has one for the current
+        version of the file. Returns None if GDAL can't open the file, like gdal.Open.
+        """
+        key = _file_key(path)
+        if key is None:
+            return gdal.Open(path)
+        handles = self._handles()
+        if key in handles:
+            handles.move_to_end(key)
+            return handles[key]
+        dataset = gdal.Open(path)
+        if dataset is None:
+            return None
+        handles[key] = dataset
+        while len(handles) > self.max_size:
+            handles.popitem(last=False)
+        return dataset
+
+    def close_all(self):
+        """Closes every handle held by the calling thread."""
+        self._handles().clear()
+
+
+_default_pool = DatasetPool()
+_info_cache = collections.OrderedDict()
+_info_lock = threading.Lock()
+MAX_CACHED_INFO = 4096
+
+
+def open_dataset(path):
+    """
+    Opens path read-only through the default DatasetPool. Do not use for datasets that will be written to.
+
+    Parameters
+    ----------
+    path
+        The path to a raster
+
+    Returns
+    -------
+    A gdal.Dataset object, or None if the file could not be opened.
+
+    """
+    return _default_pool.open(path)
+
+
+def close_all_datasets():
+    """Closes every pooled dataset handle held by the calling thread, and empties the metadata cache."""
+    _default_pool.close_all()
+    with _info_lock:
+        _info_cache.clear()
+
+
+def get_raster_info(path):
+    """
+    Returns the metadata of a raster, reading its header only the first time it is asked for.
+
+    Parameters
+    ----------
+    path
+        The path to a raster
+
+    Returns
+    -------
+    A RasterInfo object
+
+    Raises
+    ------
+    FileNotFoundError
+        If GDAL can't open the raster
+
+    """
+    key = _file_key(path)
+    if key is not None:
+        with _info_lock:
+            if key in _info_cache:
+                _info_cache.move_to_end(key)
+                return _info_cache[key]
+    dataset = open_dataset(path)
+    if dataset is None:
+        raise FileNotFoundError("Image not found at {}".format(path))
+    gt = dataset.GetGeoTransform()
+    x_size = dataset.RasterXSize
+    y_size = dataset.RasterYSize
+    x_edges = (gt[0], gt[0] + x_size*gt[1])
+    y_edges = (gt[3], gt[3] + y_size*gt[5])
+    info = RasterInfo(
+        path=path,
+        x_size=x_size,
+        y_size=y_size,
+        band_count=dataset.RasterCount,
+        datatype=dataset.GetRasterBand(1).DataType if dataset.RasterCount else None,
+        geotransform=tuple(gt),
+        projection=dataset.GetProjection(),
+        bounds=(min(x_edges), max(x_edges), min(y_edges), max(y_edges))
+    )
+    if key is not None:
+        with _info_lock:
+            _info_cache[key] = info
+            while len(_info_cache) > MAX_CACHED_INFO:
+                _info_cache.popitem(last=False)
+    return info
@@ -43,5 +43,11 @@ class FMaskException(PyeoException):
 class NonSquarePixelException(PyeoException):
     pass
 
+class PipelineException(PyeoException):
+    pass
+
+class DatatypeOverflowException(PyeoException):
+    pass
+
 class TooManyRequests(requests.RequestException):
     """Too many requests; do exponential backoff"""
\ No newline at end of file
@@ -5,13 +5,22 @@ Contains functions for sorting, creating and comparing images as part of the fil
 that works on a generic pyeo timestamp and sentinel 2 functions.
 """
 
+import bisect
+import collections
 import datetime
 import datetime as dt
+import fnmatch
 import glob
+import hashlib
+import json
 import logging
 import os
 import re
 import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
 
 from pyeo.exceptions import CreateNewStacksException
 
@@ -79,9 +88,10 @@ def check_for_invalid_l2_data(l2_SAFE_file, resolution="10m"):
         log.info("{} does not exist.".format(l2_SAFE_file))
         return 2
     log.info("Checking {} for incomplete {} imagery".format(l2_SAFE_file, resolution))
-    granule_path = r"GRANULE/*/IMG_DATA/R{}/*_B0[8,4,3,2]*.jp2".format(resolution)
-    image_glob = os.path.join(l2_SAFE_file, granule_path)
-    if len(glob.glob(image_glob)) == 4:
+    if not os.path.isdir(l2_SAFE_file):
+        return 0
+    bands = SafeIndex(l2_SAFE_file).bands   # Not cached; the product may be partial and about to be replaced
+    if all((band, int(resolution.rstrip("m"))) in bands for band in ("B02", "B03", "B04", "B08")):
         return 1
     else:
         return 0
@@ -95,14 +105,190 @@ def check_for_invalid_l1_data(l1_SAFE_file):
         log.info("{} does not exist.".format(l1_SAFE_file))
         return 2
     log.info("Checking {} for incomplete imagery".format(l1_SAFE_file))
-    granule_path = r"GRANULE/*/IMG_DATA/*_B0[8,4,3,2]*.jp2"
-    image_glob = os.path.join(l1_SAFE_file, granule_path)
-    if len(glob.glob(image_glob)) == 4:
+    if not os.path.isdir(l1_SAFE_file):
+        return 0
+    bands = SafeIndex(l1_SAFE_file).bands   # Not cached; the product may be partial and about to be replaced
+    if all((band, 10) in bands for band in ("B02", "B03", "B04", "B08")):
         return 1
     else:
         return 0
 
 
+SafeMember = collections.namedtuple("SafeMember", ["path", "size", "checksum_name", "checksum"])
+SafeMember.__doc__ = """A file listed in the manifest.safe of a Sentinel-2 product. path is relative to the .SAFE
+directory; size, checksum_name and checksum are None if the manifest doesn't give them."""
+
+# The name of the sidecar file that validate_safe_file records its result in, inside the .SAFE directory
+SAFE_VALIDATION_RECORD = "pyeo_validation.json"
+
+
+def read_safe_manifest(safe_dir):
+    """
+    Returns every file listed in the manifest.safe of a Sentinel-2 product, with its size and checksum.
+
+    Parameters
+    ----------
+    safe_dir
+        The path to an L1C or L2A .SAFE directory
+
+    Returns
+    -------
+    A list of SafeMember objects
+
+    Raises
+    ------
+    FileNotFoundError
+        If the product has no manifest.safe
+
+    """
+    root = ElementTree.parse(os.path.join(safe_dir, "manifest.safe")).getroot()
+    members = []
+    for element in root.iter():
+        if not element.tag.endswith("byteStream"):
+            continue
+        location = checksum = None
+        for child in element:
+            if child.tag.endswith("fileLocation"):
+                location = child.get("href")
+            elif child.tag.endswith("checksum"):
+                checksum = child
+        if not location:
+            continue
+        size = element.get("size")
+        members.append(SafeMember(
+            path=os.path.normpath(location),
+            size=int(size) if size else None,
+            checksum_name=checksum.get("checksumName") if checksum is not None else None,
+            checksum=checksum.text.strip().lower() if checksum is not None and checksum.text else None
+        ))
+    return members
+
+
+def hash_file(path, checksum_name="MD5", chunk_size=1024*1024):
+    """Returns the hex digest of the file at path, read a chunk at a time. checksum_name is a manifest.safe
+    checksum name such as "MD5" or "SHA3-256"."""
+    hasher = hashlib.new(checksum_name.lower().replace("-", "_"))
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _check_safe_member(safe_dir, member, check_checksums):
+    # Returns a description of the problem with member, or None if it is fine
+    path = os.path.join(safe_dir, member.path)
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return "{} is missing".format(member.path)
+    if member.size is not None and size != member.size:
+        return "{} is {} bytes, expected {}".format(member.path, size, member.size)
+    if check_checksums and member.checksum:
+        try:
+            checksum = hash_file(path, member.checksum_name or "MD5")
+        except ValueError:
+            log.warning("Unknown checksum {} for {}; not checked".format(member.checksum_name, member.path))
+            return None
+        if checksum != member.checksum:
+            return "{} has {} {}, expected {}".format(member.path, member.checksum_name, checksum, member.checksum)
+    return None
+
+
+def validate_safe_file(safe_dir, check_checksums=True, num_threads=8, force=False):
+    """
+    Checks every file listed in the manifest.safe of a Sentinel-2 product exists and has the right size and, if
+    check_checksums is True, checksum. Files are checked in parallel, and read a chunk at a time, so large bands are
+    never held in memory.
+
+    The result is recorded in a sidecar file, SAFE_VALIDATION_RECORD, in the .SAFE directory, so each product is only
+    checked once; it is checked again if the manifest changes.
+
+    Parameters
+    ----------
+    safe_dir
+        The path to an L1C or L2A .SAFE directory
+    check_checksums
+        If False, only existence and sizes are checked, which is much faster.
+    num_threads
+        The number of files to check at once
+    force
+        If True, ignores any recorded result and checks the product again.
+
+    Returns
+    -------
+    A list of descriptions of problems with the product; an empty list if it is valid.
+
+    """
+    manifest_path = os.path.join(safe_dir, "manifest.safe")
+    if not os.path.exists(manifest_path):
+        return ["{} has no manifest.safe".format(safe_dir)]
+    manifest_stat = os.stat(manifest_path)
+    manifest_key = [manifest_stat.st_mtime_ns, manifest_stat.st_size, check_checksums]
+    record_path = os.path.join(safe_dir, SAFE_VALIDATION_RECORD)
+    if not force and os.path.exists(record_path):
+        try:
+            with open(record_path, "r") as fp:
+                record = json.load(fp)
+            recorded_key = record["manifest"]
+            # A product that passed a checksum check doesn't need checking again for a size-only check
+            if recorded_key[:2] == manifest_key[:2] and (recorded_key[2] == check_checksums or
+                                                         (recorded_key[2] and not record["problems"])):
+                return record["problems"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    try:
+        members = read_safe_manifest(safe_dir)
+    except ElementTree.ParseError as error:
+        problems = ["manifest.safe could not be read: {}".format(error)]
+    else:
+        log.info("Validating {} files in {}".format(len(members), safe_dir))
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            results = executor.map(lambda member: _check_safe_member(safe_dir, member, check_checksums), members)
+            problems = [problem for problem in results if problem]
+    for problem in problems:
+        log.warning("{}: {}".format(os.path.basename(safe_dir), problem))
+    temp_path = record_path + ".tmp"
+    with open(temp_path, "w") as fp:
+        json.dump({"manifest": manifest_key, "problems": problems, "checked": time.time()}, fp, indent=1)
+    os.replace(temp_path, record_path)
+    return problems
+
+
+def quarantine_safe_file(safe_dir, quarantine_dir):
+    """Moves an invalid .SAFE directory into quarantine_dir, replacing any earlier copy there. Returns the new path."""
+    os.makedirs(quarantine_dir, exist_ok=True)
+    out_path = os.path.join(quarantine_dir, os.path.basename(safe_dir.rstrip("/")))
+    if os.path.exists(out_path):
+        shutil.rmtree(out_path)
+    log.warning("Quarantining {} in {}".format(safe_dir, quarantine_dir))
+    shutil.move(safe_dir, out_path)
+    return out_path
+
+
+def validate_safe_dir(safe_dir_parent, quarantine_dir=None, check_checksums=True, num_threads=8):
+    """
+    Validates every .SAFE directory in safe_dir_parent with validate_safe_file, moving invalid products into
+    quarantine_dir if given.
+
+    Returns
+    -------
+    A list of the paths of the valid products
+
+    """
+    valid = []
+    for safe_name in sorted(os.listdir(safe_dir_parent)):
+        if not safe_name.endswith(".SAFE"):
+            continue
+        safe_dir = os.path.join(safe_dir_parent, safe_name)
+        if not validate_safe_file(safe_dir, check_checksums, num_threads):
+            valid.append(safe_dir)
+        elif quarantine_dir:
+            quarantine_safe_file(safe_dir, quarantine_dir)
+    log.info("{} valid products in {}".format(len(valid), safe_dir_parent))
+    return valid
+
+
 def clean_l2_data(l2_SAFE_file, resolution="10m", warning=True):
     """Removes any directories that don't have band 2, 3, 4 or 8 in the specified resolution folder
     If warning=True, prompts first."""
@@ -150,9 +336,11 @@ def clean_aoi(aoi_dir, images_to_keep = 4, warning=True):
 def sort_by_timestamp(strings, recent_first=True):
     """Takes a list of strings that contain sen2 timestamps and returns them sorted, most recent first. Does not
     guarantee ordering of strings with the same timestamp. Removes any string that does not contain a timestamp"""
-    strings = list(filter(get_image_acquisition_time, strings))
-    strings.sort(key=lambda x: get_image_acquisition_time(x), reverse=recent_first)
-    return strings
+    # Parse each timestamp once and sort on the cached value
+    timed_strings = [(get_image_acquisition_time(string), string) for string in strings]
+    timed_strings = [timed_string for timed_string in timed_strings if timed_string[0]]
+    timed_strings.sort(key=lambda timed_string: timed_string[0], reverse=recent_first)
+    return [string for _, string in timed_strings]
 
 
 def get_change_detection_dates(image_name):
@@ -164,16 +352,194 @@ def get_change_detection_dates(image_name):
     return date_times
 
 
-def get_preceding_image_path(target_image_name, search_dir):
-    """Gets the path to the image in search_dir preceding the image called image_name"""
+def get_preceding_image_path(target_image_name, search_dir, tile=None):
+    """Gets the path to the image in search_dir preceding the image called image_name. If tile is given, only
+    considers images of that tile. Uses the cached directory index; see get_image_index."""
     target_time = get_image_acquisition_time(target_image_name)
-    image_paths = sort_by_timestamp(os.listdir(search_dir), recent_first=True)  # Sort image list newest first
-    image_paths = filter(is_tif, image_paths)
-    for image_path in image_paths:   # Walk through newest to oldest
-        accq_time = get_image_acquisition_time(image_path)   # Get this image time
-        if accq_time < target_time:   # If this image is older than the target image, return it.
-            return os.path.join(search_dir, image_path)
-    raise FileNotFoundError("No image older than {}".format(target_image_name))
+    record = get_image_index(search_dir).get_preceding(target_time, tile=tile, extension=".tif")
+    if record is None:
+        raise FileNotFoundError("No image older than {}".format(target_image_name))
+    return record.path
+
+
+Sen2ImageRecord = collections.namedtuple("Sen2ImageRecord",
+                                         ["tile", "sensing_time", "orbit", "baseline", "level", "path"])
+Sen2ImageRecord.__doc__ = """A filename in a pyeo directory, parsed once. Fields that are not present in the name
+(for example, the orbit of a composite) are None. sensing_time is the first timestamp in the name."""
+
+_SEN_2_TIMESTAMP_RE = re.compile(r"\d{8}T\d{6}")
+_SEN_2_TILE_RE = re.compile(r"T\d{2}[A-Z]{3}")
+_SEN_2_ORBIT_RE = re.compile(r"_(R\d{3})_")
+_SEN_2_BASELINE_RE = re.compile(r"_(N\d{4})_")
+_SEN_2_LEVEL_RE = re.compile(r"MSI(L1C|L2A)")
+
+
+def parse_sen_2_image_name(image_path):
+    """
+    Parses a Sentinel-2 or pyeo image name into a Sen2ImageRecord in a single pass. Works on .SAFE directories,
+    merged images, stacks and composites.
+
+    Parameters
+    ----------
+    image_path
+        A filename or path containing a Sentinel-2 timestamp (yyyymmddThhmmss)
+
+    Returns
+    -------
+    A Sen2ImageRecord, or None if image_path does not contain a timestamp.
+
+    """
+    name = os.path.basename(image_path.rstrip("/"))
+    timestamp = _SEN_2_TIMESTAMP_RE.search(name)
+    if not timestamp:
+        return None
+    try:
+        sensing_time = dt.datetime.strptime(timestamp.group(0), "%Y%m%dT%H%M%S")
+    except ValueError:
+        return None
+    tile = _SEN_2_TILE_RE.search(name)
+    orbit = _SEN_2_ORBIT_RE.search(name)
+    baseline = _SEN_2_BASELINE_RE.search(name)
+    level = _SEN_2_LEVEL_RE.search(name)
+    return Sen2ImageRecord(
+        tile=tile.group(0) if tile else None,
+        sensing_time=sensing_time,
+        orbit=orbit.group(1) if orbit else None,
+        baseline=baseline.group(1) if baseline else None,
+        level=level.group(1) if level else None,
+        path=image_path
+    )
+
+
+class ImageDirectoryIndex(object):
+    """
+    A time-sorted index of every timestamped file in a directory. Each filename is parsed once; the index is
+    rebuilt only when the modification time of the directory changes (ie a file has been added, removed or renamed).
+
+    Parameters
+    ----------
+    directory
+        The directory to index
+
+    Notes
+    -----
+    Use get_image_index to get a shared, cached instance rather than creating these directly.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._mtime = None
+        self._records = []
+        self._times = []
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Rebuilds the index if the directory has changed since it was last read."""
+        mtime = os.stat(self.directory).st_mtime_ns
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            records = []
+            for name in os.listdir(self.directory):
+                record = parse_sen_2_image_name(os.path.join(self.directory, name))
+                if record:
+                    records.append(record)
+            records.sort(key=lambda record: record.sensing_time)
+            self._records = records
+            self._times = [record.sensing_time for record in records]
+            # Some filesystems only store mtime to the second; if the directory changed very recently, a further
+            # change in the same tick would not be seen, so don't trust the cached listing until it has settled.
+            if time.time() - mtime / 1e9 > 2:
+                self._mtime = mtime
+            else:
+                self._mtime = None
+
+    def records(self, tile=None, level=None, extension=None, recent_first=False):
+        """
+        Returns a list of Sen2ImageRecords in this directory, sorted by sensing time.
+
+        Parameters
+        ----------
+        tile
+            If given, only return images of this tile (eg "T13QFB")
+        level
+            If given, only return products of this level ("L1C" or "L2A")
+        extension
+            If given, only return files ending with extension (eg ".tif" or ".SAFE")
+        recent_first
+            If True, returns the newest image first.
+
+        Returns
+        -------
+        A list of Sen2ImageRecord objects
+        """
+        self.refresh()
+        out = [record for record in self._records if _record_matches(record, tile, level, extension)]
+        if recent_first:
+            out.reverse()
+        return out
+
+    def get_preceding(self, target_time, tile=None, level=None, extension=None):
+        """Returns the record of the most recent image strictly older than target_time, or None."""
+        self.refresh()
+        records, times = self._records, self._times
+        for i in range(bisect.bisect_left(times, target_time) - 1, -1, -1):
+            if _record_matches(records[i], tile, level, extension):
+                return records[i]
+        return None
+
+    def get_following(self, target_time, tile=None, level=None, extension=None):
+        """Returns the record of the oldest image strictly newer than target_time, or None."""
+        self.refresh()
+        records, times = self._records, self._times
+        for i in range(bisect.bisect_right(times, target_time), len(records)):
+            if _record_matches(records[i], tile, level, extension):
+                return records[i]
+        return None
+
+    def find(self, sensing_time, tile=None, level=None, extension=None):
+        """Returns a list of records with a sensing time equal to sensing_time."""
+        self.refresh()
+        records, times = self._records, self._times
+        start = bisect.bisect_left(times, sensing_time)
+        end = bisect.bisect_right(times, sensing_time)
+        return [record for record in records[start:end] if _record_matches(record, tile, level, extension)]
+
+
+def _record_matches(record, tile, level, extension):
+    if tile and record.tile != tile:
+        return False
+    if level and record.level != level:
+        return False
+    if extension and not record.path.endswith(extension):
+        return False
+    return True
+
+
+_image_indices = {}
+_image_indices_lock = threading.Lock()
+
+
+def get_image_index(directory):
+    """
+    Returns the cached ImageDirectoryIndex for directory, creating it if needed. Repeated calls for the same
+    directory are cheap; the directory is only re-read when its modification time changes.
+
+    Parameters
+    ----------
+    directory
+        The directory to index
+
+    Returns
+    -------
+    An ImageDirectoryIndex object
+    """
+    key = os.path.abspath(directory)
+    with _image_indices_lock:
+        index = _image_indices.get(key)
+        if index is None or index.directory != directory:
+            index = ImageDirectoryIndex(directory)
+            _image_indices[key] = index
+    return index
 
 
 def is_tif(image_string):
@@ -224,21 +590,17 @@ def get_related_images(target_image_name, project_dir):
 def get_l1_safe_file(image_name, l1_dir):
     """Returns the path to the L1 .SAFE directory of image. Gets from granule and timestamp. image_name can be a path or
     a filename"""
-    timestamp = get_sen_2_image_timestamp(os.path.basename(image_name))
-    granule = get_sen_2_image_tile(os.path.basename(image_name))
-    safe_glob = "S2[A|B]_MSIL1C_{}_*_{}_*.SAFE".format(timestamp, granule)
-    out = glob.glob(os.path.join(l1_dir, safe_glob))[0]
-    return out
+    record = parse_sen_2_image_name(image_name)
+    out = get_image_index(l1_dir).find(record.sensing_time, tile=record.tile, level="L1C", extension=".SAFE")[0]
+    return out.path
 
 
 def get_l2_safe_file(image_name, l2_dir):
     """Returns the path to the L2 .SAFE directory of image. Gets from granule and timestamp. image_name can be a path or
     a filename"""
-    timestamp = get_sen_2_image_timestamp(os.path.basename(image_name))
-    granule = get_sen_2_image_tile(os.path.basename(image_name))
-    safe_glob = "S2[A|B]_MSIL2A_{}_*_{}_*.SAFE".format(timestamp, granule)
-    out = glob.glob(os.path.join(l2_dir, safe_glob))[0]
-    return out
+    record = parse_sen_2_image_name(image_name)
+    out = get_image_index(l2_dir).find(record.sensing_time, tile=record.tile, level="L2A", extension=".SAFE")[0]
+    return out.path
 
 
 def get_sen_2_image_timestamp(image_name):
@@ -278,6 +640,195 @@ def get_sen_2_granule_id(safe_dir):
     return id
 
 
+# Native resolutions in metres of the bands of an L1C product, whose filenames don't include them
+SEN_2_BAND_RESOLUTIONS = {
+    "B01": 60, "B02": 10, "B03": 10, "B04": 10, "B05": 20, "B06": 20, "B07": 20, "B08": 10, "B8A": 20,
+    "B09": 60, "B10": 60, "B11": 20, "B12": 20, "TCI": 10
+}
+_sen_2_band_re = re.compile(r"_(B\d[\dA]|SCL|AOT|WVP|TCI)(?:_(\d+)m)?\.jp2$")
+
+
+class SafeIndex(object):
+    """
+    An index of the files in a Sentinel-2 .SAFE directory, built from a single walk of the directory, so that bands,
+    quality masks and metadata can be looked up without globbing the tree again.
+
+    Parameters
+    ----------
+    safe_dir
+        The path to an L1C or L2A .SAFE directory
+
+    Attributes
+    ----------
+    bands
+        A dictionary of {(band, resolution in metres): path} for every band image, including SCL, AOT, WVP and TCI.
+    qi_files
+        A sorted list of the paths of every file in the QI_DATA directories, such as the cloud probability masks.
+    metadata_files
+        A sorted list of the paths of every .xml and .safe file, such as MTD_MSIL1C.xml, MTD_TL.xml and
+        manifest.safe.
+
+    Notes
+    -----
+    Use get_safe_index to get a shared, cached instance rather than creating these directly.
+    """
+    def __init__(self, safe_dir):
+        self.safe_dir = safe_dir
+        self.bands = {}
+        self.qi_files = []
+        self.metadata_files = []
+        for dir_path, _, file_names in os.walk(safe_dir):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                if file_name.endswith((".xml", ".safe")):
+                    self.metadata_files.append(path)
+                elif os.path.basename(dir_path) == "QI_DATA":
+                    self.qi_files.append(path)
+                else:
+                    match = _sen_2_band_re.search(file_name)
+                    if match and "IMG_DATA" in dir_path:
+                        band = match.group(1)
+                        resolution = int(match.group(2)) if match.group(2) else SEN_2_BAND_RESOLUTIONS[band]
+                        self.bands[(band, resolution)] = path
+        self.qi_files.sort()
+        self.metadata_files.sort()
+
+    def get_band_resolutions(self, band):
+        """Returns a sorted list of the resolutions band is available at; an empty list if it isn't present."""
+        return sorted(resolution for band_name, resolution in self.bands if band_name == band)
+
+    def get_band_path(self, band, resolution=None):
+        """
+        Returns the path of a band.
+
+        Parameters
+        ----------
+        band
+            The band name, such as "B02" or "SCL"
+        resolution
+            Optional. The resolution in metres. If band isn't available at this resolution, or resolution is None,
+            the finest resolution available is returned.
+
+        Returns
+        -------
+        The path to the band image
+
+        Raises
+        ------
+        FileNotFoundError
+            If band isn't in the product at any resolution
+
+        """
+        if (band, resolution) in self.bands:
+            return self.bands[(band, resolution)]
+        resolutions = self.get_band_resolutions(band)
+        if not resolutions:
+            raise FileNotFoundError("Band {} not found for safe file {}".format(band, self.safe_dir))
+        if resolution is not None:
+            log.warning("Band {} not found at {}m, using {}m".format(band, resolution, resolutions[0]))
+        return self.bands[(band, resolutions[0])]
+
+    def find_qi_files(self, pattern):
+        """Returns the paths of the files in QI_DATA whose names match the glob-style pattern."""
+        return [path for path in self.qi_files if fnmatch.fnmatch(os.path.basename(path), pattern)]
+
+    def find_metadata_files(self, pattern):
+        """Returns the paths of the metadata files whose names match the glob-style pattern."""
+        return [path for path in self.metadata_files if fnmatch.fnmatch(os.path.basename(path), pattern)]
+
+
+_safe_indices = collections.OrderedDict()
+_safe_indices_lock = threading.Lock()
+MAX_CACHED_SAFE_INDICES = 256
+
+
+def _safe_dir_key(safe_dir):
+    """The cache key of safe_dir: its absolute path and the modification time of its manifest.safe, or of the
+    directory itself if it has no manifest. A new download of the product rewrites the manifest; writing sidecar files
+    such as SAFE_VALIDATION_RECORD does not."""
+    manifest_path = os.path.join(safe_dir, "manifest.safe")
+    try:
+        mtime = os.stat(manifest_path).st_mtime_ns
+    except FileNotFoundError:
+        mtime = os.stat(safe_dir).st_mtime_ns
+    return os.path.abspath(safe_dir), mtime
+
+
+def get_safe_index(safe_dir):
+    """
+    Returns the cached SafeIndex for safe_dir, creating it if needed. The index is rebuilt if the manifest of safe_dir
+    changes, such as when it is replaced by a new download. Code that adds bands to or removes bands from an existing
+    .SAFE directory, such as extracting a download into it, must call invalidate_safe_index.
+
+    Parameters
+    ----------
+    safe_dir
+        The path to an L1C or L2A .SAFE directory
+
+    Returns
+    -------
+    A SafeIndex object
+
+    Raises
+    ------
+    FileNotFoundError
+        If safe_dir does not exist
+
+    """
+    key = _safe_dir_key(safe_dir)
+    with _safe_indices_lock:
+        if key in _safe_indices:
+            _safe_indices.move_to_end(key)
+            return _safe_indices[key]
+    index = SafeIndex(safe_dir)
+    with _safe_indices_lock:
+        _safe_indices[key] = index
+        while len(_safe_indices) > MAX_CACHED_SAFE_INDICES:
+            _safe_indices.popitem(last=False)
+    return index
+
+
+def invalidate_safe_index(safe_dir):
+    """Drops any cached SafeIndex of safe_dir, so the next call to get_safe_index indexes it again. Call after
+    extracting files into or deleting files from a .SAFE directory."""
+    safe_path = os.path.abspath(safe_dir)
+    with _safe_indices_lock:
+        for key in [key for key in _safe_indices if key[0] == safe_path]:
+            del _safe_indices[key]
+
+
+def _find_sen_2_metadata(safe_dir, pattern):
+    paths = get_safe_index(safe_dir).find_metadata_files(pattern)
+    if not paths:
+        raise FileNotFoundError("No metadata matching {} in {}".format(pattern, safe_dir))
+    return ElementTree.parse(paths[0]).getroot()
+
+
+def get_sen_2_sun_angles(safe_dir):
+    """Returns the mean (zenith, azimuth) of the sun over a Sentinel 2 granule in degrees, from the MTD_TL.xml file of
+    its SAFE directory. Azimuth is measured clockwise from north."""
+    root = _find_sen_2_metadata(safe_dir, "MTD_TL.xml")
+    for element in root.iter():
+        if element.tag.endswith("Mean_Sun_Angle"):
+            return float(element.find("ZENITH_ANGLE").text), float(element.find("AZIMUTH_ANGLE").text)
+    raise FileNotFoundError("No Mean_Sun_Angle in the tile metadata of {}".format(safe_dir))
+
+
+def get_sen_2_radiometric_scaling(safe_dir):
+    """Returns (offset, quantification value) of a Sentinel 2 SAFE directory, such that reflectance is
+    (DN + offset) / quantification value. The offset is -1000 from processing baseline 04.00 and 0 before it."""
+    root = _find_sen_2_metadata(safe_dir, "MTD_MSIL*.xml")
+    offset = 0
+    quantification = 10000
+    for element in root.iter():
+        tag = element.tag.split("}")[-1]
+        if tag in ("RADIO_ADD_OFFSET", "BOA_ADD_OFFSET"):
+            offset = int(element.text)
+        elif tag in ("QUANTIFICATION_VALUE", "BOA_QUANTIFICATION_VALUE"):
+            quantification = float(element.text)
+    return offset, quantification
+
+
 def get_mask_path(image_path):
     """A gdal mask is an image with the same name as the image it's masking, but with a .msk extension"""
     image_name = os.path.basename(image_path)
@@ -0,0 +1,348 @@
+"""
+pyeo.pipeline
+-------------
+A small dependency-graph runner for processing chains that work on a set of images.
+
+A processing chain is described as a list of Stages (for example: sen2cor -> merge -> stack -> classify -> update).
+Each image is a WorkUnit, identified by its tile and sensing date. The runner builds a graph with one node for every
+(stage, unit) pair and runs every node as soon as the nodes it depends on are finished, so the stack of one image can
+run while the next image is still in sen2cor. Each stage has its own pool of workers.
+
+Dependencies
+------------
+- A node always depends on the stages listed in its stage's `requires` for the same unit.
+- A node can also depend on stages of the *previous* unit in the same chain, using `requires_previous`. This is
+  how serial steps such as updating a rolling composite are kept in date order.
+- Units are split into chains by `chain_key`; by default every unit is in one chain, ordered by date.
+
+Checkpointing
+-------------
+The output of every finished node is recorded in a json checkpoint file. On a rerun, finished nodes are skipped and
+their recorded outputs are passed on, so a failed run resumes from the last completed unit. Stage outputs should
+therefore be json-serialisable; usually a path.
+
+Workers are threads. Most of the work in pyeo stages is done in GDAL, numpy or external processes (sen2cor, fmask),
+which do not hold the GIL.
+
+Tile sharding
+-------------
+Images from different tiles never need each other, so run_tile_shards splits a list of images by tile and runs each
+tile's images through a function in its own worker process, with its own temporary directory.
+"""
+
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from pyeo.exceptions import PipelineException
+from pyeo.filesystem_utilities import parse_sen_2_image_name
+
+log = logging.getLogger("pyeo")
+
+
+WorkUnit = collections.namedtuple("WorkUnit", ["tile", "date", "name"])
+WorkUnit.__doc__ = """A single image moving through a pipeline. date is a datetime; name is a unique identifier,
+usually the product ID."""
+
+
+def work_unit_from_path(image_path):
+    """
+    Builds a WorkUnit from the path of a Sentinel-2 product or a pyeo image.
+
+    Parameters
+    ----------
+    image_path
+        Path to the image or .SAFE directory
+
+    Returns
+    -------
+    A WorkUnit with the tile and sensing time of the image, named with the filename without extension.
+
+    """
+    record = parse_sen_2_image_name(image_path)
+    if record is None:
+        raise PipelineException("No timestamp found in {}".format(image_path))
+    name = os.path.basename(image_path.rstrip("/")).rsplit(".", 1)[0]
+    return WorkUnit(tile=record.tile, date=record.sensing_time, name=name)
+
+
+class Stage(object):
+    """
+    A single step of a pipeline.
+
+    Parameters
+    ----------
+    name
+        A unique name for this stage. Cannot contain ':'.
+    function
+        A function of the form f(unit, results), where unit is a WorkUnit and results is a dictionary of
+        {stage name: output} of the stages already completed for that unit. Also contains the key "previous",
+        holding the results dictionary of the previous unit in the chain (or None for the first unit).
+        Returns the output of this stage for that unit.
+    requires
+        Names of stages that must be complete for the same unit before this stage runs.
+    requires_previous
+        Names of stages that must be complete for the previous unit in the chain before this stage runs.
+    workers
+        The number of units this stage can process at once.
+    """
+    def __init__(self, name, function, requires=(), requires_previous=(), workers=1):
+        self.name = name
+        self.function = function
+        self.requires = tuple(requires)
+        self.requires_previous = tuple(requires_previous)
+        self.workers = workers
+
+
+class PipelineRunner(object):
+    """
+    Runs a list of Stages over a list of WorkUnits. See the module documentation for details.
+
+    Parameters
+    ----------
+    stages
+        A list of Stage objects. Stages can only require stages that come before them in this list.
+    checkpoint_path
+        Path to a json file to record finished nodes in. If None, no checkpoint is kept.
+    chain_key
+        A function of a WorkUnit returning the chain it belongs to; for example, lambda unit: unit.tile.
+        Defaults to putting every unit in a single chain.
+    """
+    def __init__(self, stages, checkpoint_path=None, chain_key=None):
+        self.stages = list(stages)
+        self.checkpoint_path = checkpoint_path
+        self.chain_key = chain_key if chain_key else lambda unit: None
+        self._lock = threading.Lock()
+        stage_names = []
+        for stage in self.stages:
+            for required in stage.requires + stage.requires_previous:
+                if required not in stage_names and required != stage.name:
+                    raise PipelineException("Stage {} requires unknown or later stage {}".format(stage.name, required))
+            if stage.name in stage_names:
+                raise PipelineException("Duplicate stage name {}".format(stage.name))
+            if ":" in stage.name:
+                raise PipelineException("Stage name {} contains ':', which separates stage and unit names in the "
+                                        "checkpoint file".format(stage.name))
+            stage_names.append(stage.name)
+
+    def load_checkpoint(self):
+        """Returns the {node key: output} dictionary stored at checkpoint_path, or an empty dictionary."""
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return {}
+        with open(self.checkpoint_path, "r") as fp:
+            return json.load(fp)
+
+    def _save_checkpoint(self, completed):
+        # Merged into the existing checkpoint, so nodes of units that are not in this run (such as other tiles from an
+        # earlier run) are kept
+        if not self.checkpoint_path:
+            return
+        checkpoint = self.load_checkpoint()
+        checkpoint.update(completed)
+        temp_path = self.checkpoint_path + ".tmp"
+        with open(temp_path, "w") as fp:
+            json.dump(checkpoint, fp, indent=1, sort_keys=True)
+        os.replace(temp_path, self.checkpoint_path)
+
+    @staticmethod
+    def node_key(stage_name, unit):
+        """The key used for a (stage, unit) node in the checkpoint file."""
+        return "{}:{}".format(stage_name, unit.name)
+
+    def run(self, units):
+        """
+        Runs every stage over every unit.
+
+        Parameters
+        ----------
+        units
+            An iterable of WorkUnits.
+
+        Returns
+        -------
+        A dictionary of {unit name: {stage name: output}}.
+
+        Raises
+        ------
+        PipelineException
+            If any node failed. Every node that did not depend on a failed node is still run and checkpointed.
+
+        """
+        # Build the chains: each chain is sorted oldest first, and each unit knows its predecessor
+        chains = collections.defaultdict(list)
+        for unit in units:
+            chains[self.chain_key(unit)].append(unit)
+        previous_unit = {}
+        all_units = []
+        for chain in chains.values():
+            chain.sort(key=lambda unit: unit.date)
+            for i, unit in enumerate(chain):
+                previous_unit[unit.name] = chain[i-1] if i > 0 else None
+                all_units.append(unit)
+        all_units.sort(key=lambda unit: unit.date)
+
+        checkpoint = self.load_checkpoint()
+        completed = {}
+        results = {unit.name: {} for unit in all_units}
+        for unit in all_units:
+            for stage in self.stages:
+                key = self.node_key(stage.name, unit)
+                if key in checkpoint:
+                    completed[key] = checkpoint[key]
+                    results[unit.name][stage.name] = checkpoint[key]
+        if completed:
+            log.info("Resuming pipeline; {} of {} steps already complete".format(
+                len(completed), len(all_units)*len(self.stages)))
+
+        failed = set()
+        running = {}
+        running_nodes = {}
+        executors = {stage.name: ThreadPoolExecutor(max_workers=stage.workers) for stage in self.stages}
+
+        def dependencies(stage, unit):
+            deps = [self.node_key(name, unit) for name in stage.requires]
+            previous = previous_unit[unit.name]
+            if previous:
+                deps += [self.node_key(name, previous) for name in stage.requires_previous]
+            return deps
+
+        def run_node(stage, unit, unit_results):
+            log.info("Pipeline: starting {} for {}".format(stage.name, unit.name))
+            return stage.function(unit, unit_results)
+
+        try:
+            while True:
+                # Submit every node that is ready
+                for unit in all_units:
+                    for stage in self.stages:
+                        key = self.node_key(stage.name, unit)
+                        if key in completed or key in failed or key in running.values():
+                            continue
+                        deps = dependencies(stage, unit)
+                        if any(dep in failed for dep in deps):
+                            log.warning("Pipeline: skipping {} for {}; an earlier step failed".format(
+                                stage.name, unit.name))
+                            failed.add(key)
+                            continue
+                        if all(dep in completed for dep in deps):
+                            unit_results = dict(results[unit.name])
+                            previous = previous_unit[unit.name]
+                            unit_results["previous"] = dict(results[previous.name]) if previous else None
+                            future = executors[stage.name].submit(run_node, stage, unit, unit_results)
+                            running[future] = key
+                            running_nodes[future] = (stage.name, unit.name)
+                if not running:
+                    break
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = running.pop(future)
+                    stage_name, unit_name = running_nodes.pop(future)
+                    try:
+                        output = future.result()
+                    except Exception:
+                        log.exception("Pipeline: {} failed for {}".format(stage_name, unit_name))
+                        failed.add(key)
+                        continue
+                    with self._lock:
+                        completed[key] = output
+                        results[unit_name][stage_name] = output
+                        self._save_checkpoint(completed)
+                    log.info("Pipeline: finished {} for {}".format(stage_name, unit_name))
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=True)
+
+        if failed:
+            raise PipelineException("{} pipeline steps failed or were skipped: {}".format(
+                len(failed), sorted(failed)))
+        return results
+
+
+def group_by_tile(image_paths):
+    """
+    Splits a list of image paths by tile.
+
+    Parameters
+    ----------
+    image_paths
+        A list of paths to Sentinel-2 products or pyeo images
+
+    Returns
+    -------
+    An OrderedDict of {tile: [paths]}, with the tiles in alphabetical order and each list of paths oldest first.
+    Images without a tile in their name are under the key None.
+
+    """
+    shards = collections.defaultdict(list)
+    for image_path in image_paths:
+        record = parse_sen_2_image_name(image_path)
+        if record is None:
+            log.warning("No timestamp in {}; not assigned to a tile".format(image_path))
+            continue
+        shards[record.tile].append(record)
+    out = collections.OrderedDict()
+    for tile in sorted(shards, key=lambda tile: tile or ""):
+        out[tile] = [record.path for record in sorted(shards[tile], key=lambda record: record.sensing_time)]
+    return out
+
+
+def _run_shard(function, tile, image_paths, temp_root, args):
+    # Runs in the worker process. Each tile gets its own scratch space for TemporaryDirectory and GDAL.
+    if temp_root:
+        shard_temp_dir = os.path.join(temp_root, str(tile))
+        os.makedirs(shard_temp_dir, exist_ok=True)
+        tempfile.tempdir = shard_temp_dir
+        os.environ["CPL_TMPDIR"] = shard_temp_dir
+    log.info("Worker {} processing {} images of tile {}".format(os.getpid(), len(image_paths), tile))
+    return function(tile, image_paths, *args)
+
+
+def run_tile_shards(function, image_paths, processes=None, temp_root=None, args=()):
+    """
+    Runs function once per tile over the images of that tile, with tiles processed in parallel worker processes.
+
+    Parameters
+    ----------
+    function
+        A module-level function of the form f(tile, image_paths, *args). image_paths are sorted oldest first.
+        Must be picklable.
+    image_paths
+        A list of paths to images from any number of tiles
+    processes
+        The number of worker processes. Defaults to the number of CPUs.
+    temp_root
+        If given, each worker uses temp_root/[tile] as its temporary directory.
+    args
+        Any further arguments to pass to function.
+
+    Returns
+    -------
+    A dictionary of {tile: output of function}
+
+    Raises
+    ------
+    PipelineException
+        If any tile failed. Every other tile is still processed.
+
+    """
+    shards = group_by_tile(image_paths)
+    log.info("Processing {} tiles: {}".format(len(shards), list(shards.keys())))
+    out = {}
+    failed = []
+    with multiprocessing.Pool(processes) as pool:
+        pending = {tile: pool.apply_async(_run_shard, (function, tile, paths, temp_root, tuple(args)))
+                   for tile, paths in shards.items()}
+        for tile, result in pending.items():
+            try:
+                out[tile] = result.get()
+            except Exception:
+                log.exception("Processing failed for tile {}".format(tile))
+                failed.append(tile)
+    if failed:
+        raise PipelineException("Processing failed for tiles {}".format(failed))
+    return out
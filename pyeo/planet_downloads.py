@@ -0,0 +1,508 @@
+"""
+pyeo.planet_downloads
+---------------------
+An asyncio engine for activating and downloading Planet assets, for pulling hundreds of scenes at once.
+
+Planet assets must be activated before they can be downloaded, which can take minutes. Rather than giving each item
+a thread that spins until its asset is active, every item is a coroutine: it asks for activation, then polls the
+asset with a per-item exponential backoff, sleeping on the event loop between polls. Once the asset is active, it
+waits for one of a bounded number of download slots, and streams the file to disk a chunk at a time.
+
+Every request to the API goes through a single RateLimiter, so however many items are in flight, the API is never
+sent more than a fixed number of requests per second. Responses of 429 (too many requests) are retried after the
+time the API asks for, or an exponential backoff.
+
+HTTP requests are made with requests in a pool of worker threads, so no extra dependencies are needed; the event
+loop only schedules them.
+
+Searches are run by the same engine. A search follows the _next link of each page of results, and a long date range
+is split into shorter ranges that are searched in parallel. Items are deduplicated by id and yielded as each page
+arrives, so when a search is given to PlanetDownloader.download_items, the first items are being activated while
+later pages are still being fetched.
+
+Use PlanetDownloader.run from synchronous code; see pyeo.queries_and_downloads.planet_query.
+"""
+
+import asyncio
+import datetime as dt
+import functools
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import requests.adapters
+
+from pyeo.exceptions import TooManyRequests
+
+log = logging.getLogger("pyeo")
+
+PLANET_API_ROOT = "https://api.planet.com/data/v1/"
+PLANET_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+# Errors that are worth retrying after a wait; requests.Timeout covers both connect and read timeouts
+RETRYABLE_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+def _is_retryable(error):
+    """HTTP errors are only worth retrying for server errors (5xx)."""
+    if isinstance(error, requests.HTTPError) and not isinstance(error, TooManyRequests):
+        return error.response is not None and error.response.status_code >= 500
+    return True
+
+
+def _parse_planet_time(time_string):
+    for time_format in (PLANET_TIME_FORMAT, "%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%d"):
+        try:
+            return dt.datetime.strptime(time_string, time_format)
+        except ValueError:
+            pass
+    raise ValueError("{} is not a date or a UTC time like 2019-01-31T00:00:00.000Z".format(time_string))
+
+
+def split_date_range(start_date, end_date, days_per_query):
+    """
+    Splits a date range into consecutive ranges of at most days_per_query days. Neighbouring ranges share their
+    boundary, so an item acquired exactly on a boundary is found twice; search deduplicates these.
+
+    Parameters
+    ----------
+    start_date
+        The start of the range, as a date (yyyy-mm-dd) or a UTC time (yyyy-mm-ddThh:mm:ss.sssZ)
+    end_date
+        The end of the range, in the same formats
+    days_per_query
+        The longest range to return, in days. If None, the whole range is returned.
+
+    Returns
+    -------
+    A list of (start, end) tuples of UTC time strings
+
+    """
+    start = _parse_planet_time(start_date)
+    end = _parse_planet_time(end_date)
+    if not days_per_query:
+        return [(start.strftime(PLANET_TIME_FORMAT), end.strftime(PLANET_TIME_FORMAT))]
+    step = dt.timedelta(days=days_per_query)
+    ranges = []
+    while True:
+        range_end = min(start + step, end)
+        ranges.append((start.strftime(PLANET_TIME_FORMAT), range_end.strftime(PLANET_TIME_FORMAT)))
+        if range_end >= end:
+            return ranges
+        start = range_end
+
+
+def build_search_filter(aoi, start_date, end_date, item_types):
+    """
+    Builds the body of a Planet search request for items of item_types acquired between start_date and end_date
+    (inclusive) that intersect aoi.
+
+    Parameters
+    ----------
+    aoi
+        A geojson geometry
+    start_date
+        The start of the time window, as a UTC time string
+    end_date
+        The end of the time window, as a UTC time string
+    item_types
+        A list of Planet item types, such as ["PSScene4Band"]
+
+    Returns
+    -------
+    A dictionary to send as the json body of a quick search
+
+    """
+    return {
+        "item_types": list(item_types),
+        "filter": {
+            "type": "AndFilter",
+            "config": [
+                {"type": "DateRangeFilter", "field_name": "acquired",
+                 "config": {"gte": start_date, "lte": end_date}},
+                {"type": "GeometryFilter", "field_name": "geometry", "config": aoi}
+            ]
+        }
+    }
+
+
+class RateLimiter(object):
+    """
+    A token bucket shared by every coroutine on an event loop: allows at most rate acquisitions per second on
+    average, and bursts of up to burst.
+
+    Parameters
+    ----------
+    rate
+        The average number of acquisitions allowed per second
+    burst
+        The most acquisitions allowed at once after a quiet period. Defaults to rate.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst else max(rate, 1))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = None
+
+    async def acquire(self):
+        """Waits until a request is allowed."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class PlanetDownloader(object):
+    """
+    Searches for Planet items, and activates and downloads their assets; see the module documentation for details.
+
+    Parameters
+    ----------
+    api_key
+        A Planet API key. Not needed if session is given.
+    out_dir
+        The folder to save the assets in. Each asset is saved as [item id].tif
+    asset_type
+        The Planet asset type to download, such as "analytic"
+    max_downloads
+        The most assets to download at once
+    requests_per_second
+        The most API requests to make per second, across every item
+    poll_interval
+        Seconds to wait before first checking whether an asset has activated. Doubles after every check.
+    max_poll_interval
+        The longest wait between checks
+    activation_timeout
+        Seconds to wait for an asset to activate before giving up on that item
+    max_retries
+        The number of times to retry a request that was refused with a 429 or failed to connect
+    retry_delay
+        Seconds to wait before the first retry. Doubles after every retry, up to a minute.
+    api_root
+        The root URL of the Planet data API
+    session
+        Optional. A requests.Session with authentication already set up.
+    chunk_size
+        Bytes to write at a time when downloading
+    """
+    def __init__(self, api_key=None, out_dir=".", asset_type="analytic", max_downloads=4, requests_per_second=5,
+                 poll_interval=5, max_poll_interval=60, activation_timeout=3600, max_retries=8, retry_delay=1,
+                 api_root=PLANET_API_ROOT, session=None, chunk_size=1024*1024):
+        self.out_dir = out_dir
+        self.asset_type = asset_type
+        self.max_downloads = max_downloads
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.activation_timeout = activation_timeout
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.api_root = api_root
+        self.chunk_size = chunk_size
+        self.rate_limiter = RateLimiter(requests_per_second)
+        if session is None:
+            session = requests.Session()
+            session.auth = (api_key, '')
+            # Enough connections for every download, plus the API calls in flight alongside them
+            adapter = requests.adapters.HTTPAdapter(pool_connections=max_downloads + 4,
+                                                    pool_maxsize=max_downloads + 4)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self.session = session
+        self._executor = None
+        self._download_slots = None
+
+    def asset_url(self, item):
+        """The URL of the assets of a Planet item, as returned by a search."""
+        return "{}item-types/{}/items/{}/assets/".format(self.api_root, item["properties"]["item_type"], item["id"])
+
+    async def _call(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(function, *args, **kwargs))
+
+    async def request(self, method, url, **kwargs):
+        """
+        Makes a rate-limited request to the API, retrying with backoff on a 429, a server error (5xx), a timeout
+        or a dropped connection.
+
+        Returns
+        -------
+        A requests.Response
+
+        Raises
+        ------
+        TooManyRequests
+            If the request is still refused with a 429 after max_retries attempts
+        requests.HTTPError
+            For any other error status, or a server error after max_retries attempts
+
+        """
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire()
+            try:
+                response = await self._call(self.session.request, method, url, timeout=60, **kwargs)
+            except RETRYABLE_ERRORS:
+                if attempt == self.max_retries:
+                    raise
+                log.warning("Request to {} failed; retrying in {}s".format(url, delay))
+            else:
+                if response.status_code >= 500:
+                    if attempt == self.max_retries:
+                        response.raise_for_status()
+                    log.warning("Server error {} from {}; retrying in {}s".format(response.status_code, url, delay))
+                elif response.status_code != 429:
+                    response.raise_for_status()
+                    return response
+                else:
+                    retry_after = response.headers.get("Retry-After")
+                    if retry_after and retry_after.isdigit():
+                        delay = max(delay, int(retry_after))
+                    log.warning("Too many requests to {}; backing off for {}s".format(url, delay))
+            await asyncio.sleep(delay * (1 + random.random() / 4))
+            delay = min(delay * 2, 60)
+        raise TooManyRequests("Gave up on {} after {} attempts".format(url, self.max_retries + 1))
+
+    async def search_pages(self, search_request):
+        """
+        Runs a quick search, following the _next link of each page of results until the last page.
+
+        Parameters
+        ----------
+        search_request
+            The json body of the search; see build_search_filter
+
+        Yields
+        ------
+        The list of items on each page, as it arrives
+
+        """
+        response = await self.request("POST", self.api_root + "quick-search", json=search_request)
+        while True:
+            page = response.json()
+            items = page.get("features", [])
+            if items:
+                yield items
+            next_url = page.get("_links", {}).get("_next")
+            if not items or not next_url:
+                return
+            response = await self.request("GET", next_url)
+
+    async def search(self, aoi, start_date, end_date, item_types, days_per_query=30, max_searches=4):
+        """
+        Searches for items in aoi between start_date and end_date. The date range is split into ranges of
+        days_per_query days, and up to max_searches of these are searched at once.
+
+        Parameters
+        ----------
+        aoi
+            A geojson geometry
+        start_date
+            The start of the time window, as a date (yyyy-mm-dd) or a UTC time (yyyy-mm-ddThh:mm:ss.sssZ)
+        end_date
+            The inclusive end of the time window, in the same formats
+        item_types
+            A list of Planet item types, such as ["PSScene4Band"]
+        days_per_query
+            The longest date range to search in one query. If None, the range is not split.
+        max_searches
+            The most queries to run at once
+
+        Yields
+        ------
+        Each item found, once, in the order the pages arrive
+
+        """
+        date_ranges = split_date_range(start_date, end_date, days_per_query)
+        pages = asyncio.Queue()
+        search_slots = asyncio.Semaphore(max_searches)
+
+        async def search_range(range_start, range_end):
+            try:
+                async with search_slots:
+                    search_request = build_search_filter(aoi, range_start, range_end, item_types)
+                    async for page in self.search_pages(search_request):
+                        await pages.put(page)
+            except Exception as error:
+                await pages.put(error)
+            finally:
+                await pages.put(None)
+
+        log.info("Searching for Planet items between {} and {} in {} queries".format(start_date, end_date,
+                                                                                        len(date_ranges)))
+        tasks = [asyncio.ensure_future(search_range(range_start, range_end))
+                 for range_start, range_end in date_ranges]
+        seen = set()
+        finished = 0
+        try:
+            while finished < len(tasks):
+                page = await pages.get()
+                if page is None:
+                    finished += 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    for item in page:
+                        if item["id"] not in seen:
+                            seen.add(item["id"])
+                            yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+        log.info("Search found {} Planet items".format(len(seen)))
+
+    def _start(self):
+        # Everything bound to an event loop is made again for each run
+        self._download_slots = asyncio.Semaphore(self.max_downloads)
+        self.rate_limiter = RateLimiter(self.rate_limiter.rate, self.rate_limiter.burst)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_downloads + 8)
+
+    async def activate(self, item):
+        """
+        Activates the asset of item and waits until it is active, polling with an exponential backoff.
+
+        Returns
+        -------
+        The download URL of the asset
+
+        """
+        item_id = item["id"]
+        asset_url = self.asset_url(item)
+        deadline = time.monotonic() + self.activation_timeout
+        interval = self.poll_interval
+        activation_requested = False
+        while True:
+            asset = (await self.request("GET", asset_url)).json()[self.asset_type]
+            status = asset["status"]
+            if status == "active":
+                return asset["location"]
+            if status == "inactive" and not activation_requested:
+                log.info("Activating {}".format(item_id))
+                await self.request("POST", asset["_links"]["activate"])
+                activation_requested = True
+            if time.monotonic() > deadline:
+                raise TimeoutError("{} not activated after {}s".format(item_id, self.activation_timeout))
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
+
+    def _stream_to_file(self, url, out_path):
+        # Runs in a worker thread. Writes to a temporary file, so a failed download leaves nothing behind.
+        temp_path = out_path + ".part"
+        with self.session.get(url, stream=True, timeout=60) as response:
+            if response.status_code == 429:
+                raise TooManyRequests("Too many requests downloading {}".format(url))
+            response.raise_for_status()
+            with open(temp_path, "wb") as fp:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    fp.write(chunk)
+        os.replace(temp_path, out_path)
+
+    async def download_item(self, item):
+        """
+        Activates and downloads the asset of a single item. Items already in out_dir are skipped.
+
+        Returns
+        -------
+        The path to the downloaded asset
+
+        """
+        item_id = item["id"]
+        out_path = os.path.join(self.out_dir, item_id + ".tif")
+        if os.path.exists(out_path):
+            log.info("{} exists, skipping download".format(out_path))
+            return out_path
+        location = await self.activate(item)
+        delay = self.retry_delay
+        async with self._download_slots:
+            for attempt in range(self.max_retries + 1):
+                await self.rate_limiter.acquire()
+                log.info("Downloading item {} to {}".format(item_id, out_path))
+                try:
+                    await self._call(self._stream_to_file, location, out_path)
+                    break
+                except (TooManyRequests, requests.HTTPError) + RETRYABLE_ERRORS as error:
+                    if attempt == self.max_retries or not _is_retryable(error):
+                        raise
+                    log.warning("Download of {} failed; retrying in {}s".format(item_id, delay))
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 60)
+        log.info("Item {} download complete".format(item_id))
+        return out_path
+
+    async def _download_or_log(self, item):
+        try:
+            return await self.download_item(item)
+        except Exception:
+            log.exception("Download of {} failed".format(item.get("id")))
+            return None
+
+    async def download_items(self, items):
+        """
+        Activates and downloads every item. Items can be an iterable or an async iterator, such as a search that is
+        still returning pages; each item is started as soon as it arrives.
+
+        Returns
+        -------
+        A dictionary of {item id: path}, with a path of None for items that failed
+
+        Raises
+        ------
+        Any exception raised by items, such as a failed search. Downloads that had already started are finished first.
+
+        """
+        self._start()
+        tasks = {}
+        try:
+            try:
+                if hasattr(items, "__aiter__"):
+                    async for item in items:
+                        if item["id"] not in tasks:
+                            tasks[item["id"]] = asyncio.ensure_future(self._download_or_log(item))
+                else:
+                    for item in items:
+                        if item["id"] not in tasks:
+                            tasks[item["id"]] = asyncio.ensure_future(self._download_or_log(item))
+            except Exception:
+                log.exception("Finding items failed; finishing the {} downloads already started".format(len(tasks)))
+                await asyncio.gather(*tasks.values())
+                raise
+            results = await asyncio.gather(*tasks.values())
+        finally:
+            self._executor.shutdown(wait=False)
+        failed = sum(result is None for result in results)
+        log.info("Downloaded {} Planet items; {} failed".format(len(results) - failed, failed))
+        return dict(zip(tasks.keys(), results))
+
+    async def _collect(self, items):
+        self._start()
+        try:
+            return [item async for item in items]
+        finally:
+            self._executor.shutdown(wait=False)
+
+    def run_search(self, aoi, start_date, end_date, item_types, days_per_query=30, max_searches=4):
+        """Runs search to completion on a new event loop, for use from synchronous code. Returns a list of items."""
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self._collect(self.search(aoi, start_date, end_date, item_types,
+                                                                     days_per_query, max_searches)))
+        finally:
+            loop.close()
+
+    def run(self, items):
+        """Runs download_items to completion on a new event loop, for use from synchronous code."""
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.download_items(items))
+        finally:
+            loop.close()
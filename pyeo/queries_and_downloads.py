@@ -52,23 +52,26 @@ import logging
 import os
 import shutil
 import tarfile
+import warnings
 import zipfile
-from multiprocessing.dummy import Pool
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlencode
 import numpy as np
 from bs4 import BeautifulSoup  # I didn't really want to use BS, but I can't see a choice.
 
 import ogr
 import requests
-import tenacity
+import requests.adapters
 from botocore.exceptions import ClientError
 from requests import Request
 
 from sentinelhub import download_safe_format
 from sentinelsat import SentinelAPI, geojson_to_wkt, read_geojson
 
-from pyeo.filesystem_utilities import check_for_invalid_l2_data, check_for_invalid_l1_data, get_sen_2_image_tile
+from pyeo.filesystem_utilities import check_for_invalid_l2_data, check_for_invalid_l1_data, get_sen_2_image_tile, \
+    invalidate_safe_index
 from pyeo.exceptions import NoL2DataAvailableException, BadDataSourceExpection, TooManyRequests
+from pyeo.planet_downloads import PlanetDownloader, build_search_filter
 
 log = logging.getLogger("pyeo")
 
@@ -213,9 +216,11 @@ def landsat_query(conf, geojsonfile, start_date, end_date, cloud=50):
     return products
 
 
-def download_landsat_data(products, out_dir, conf):
+def download_landsat_data(products, out_dir, conf, bands=None, threads=4):
     """
-    Given an output from landsat_query, will download al L1C products to out_dir.
+    Given an output from landsat_query, will download al L1C products to out_dir. Products are downloaded threads at
+    a time over a single logged-in session, and each archive is extracted as it arrives, without being written to
+    disk or held in memory; see stream_landsat_product. Products that already have a folder in out_dir are skipped.
 
     Parameters
     ----------
@@ -225,13 +230,61 @@ def download_landsat_data(products, out_dir, conf):
         Directory to save Landsat files in. Folder structure is out_dir->displayId->products
     conf
         Dictionary containing USGS login credentials. See docs for landsat_query.
+    bands
+        Optional. The bands to extract from each product, as in
+        pyeo.raster_manipulation.preprocess_landsat_images(bands_to_stack=...); for example ("B2", "B3", "B4").
+        The metadata files are always extracted. If None, every file is extracted.
+    threads
+        The number of products to download at once
+
+    Returns
+    -------
+    A list of the folders of the downloaded products
+
+    """
+    dl_session = login_to_usgs(conf, pool_size=threads)
+
+    def download_product(product):
+        out_folder_path = os.path.join(out_dir, product['displayId'])
+        if os.path.exists(out_folder_path):
+            log.info("{} exists, skipping download".format(out_folder_path))
+            return out_folder_path
+        clean_url = get_landsat_download_url(dl_session, product["downloadUrl"])
+        log.info("Downloading landsat imagery from {}".format(clean_url))
+        return stream_landsat_product(dl_session, clean_url, out_folder_path, bands)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(download_product, products))
+
+
+def login_to_usgs(conf, pool_size=4, login_url="https://ers.cr.usgs.gov/login/"):
+    """
+    Returns a requests.Session logged into the USGS EROS registration system, for downloading Landsat products. The
+    session's connection pool holds pool_size connections, so it can be shared by that many download threads.
+
+    Parameters
+    ----------
+    conf
+        Dictionary containing USGS login credentials. See docs for landsat_query.
+    pool_size
+        The number of connections to keep open to each host
+    login_url
+        The URL of the login page
+
+    Returns
+    -------
+    A requests.Session object
+
     """
     # The API key is no good here, we need the auth cookie. Time to pretend to be a browser.
     dl_session = requests.Session()
-    page = dl_session.get("https://ers.cr.usgs.gov/login/").content
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    dl_session.mount("https://", adapter)
+    dl_session.mount("http://", adapter)
+    page = dl_session.get(login_url).content
     # We also need the cross-site request forgery prevention token and the __ncforminfo (dunno?) value.
     # For this, we use BeautifulSoup; a library for finding things in webpages.
-    login_soup = BeautifulSoup(page)
+    login_soup = BeautifulSoup(page, 'html.parser')
     inputs = login_soup.find_all("input")
     token = list(input.attrs['value'] for input in inputs
                  if 'name' in input.attrs
@@ -240,7 +293,7 @@ def download_landsat_data(products, out_dir, conf):
                  if 'name' in input.attrs
                  and input.attrs['name'] == '__ncforminfo')[0]
 
-    dl_session.post("https://ers.cr.usgs.gov/login/",
+    dl_session.post(login_url,
                     data={
                         "username": conf["landsat"]["user"],
                         "password": conf["landsat"]["pass"],
@@ -250,29 +303,71 @@ def download_landsat_data(products, out_dir, conf):
                     headers={
                         'User-Agent': "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:72.0) Gecko/20100101 Firefox/72.0"
                     })
+    return dl_session
 
-    # for each product in landsat, do stuff
-    for product in products:
-        download_landing_url = product["downloadUrl"]
-        # BeautifulSoup is a library for finding things in webpages - in this case, every download link
-        lp_soup = BeautifulSoup(requests.get(download_landing_url).content, 'html.parser')
-        download_buttons = lp_soup.find_all("input")
-        dirty_url = \
-            list(button.attrs['onclick'] for button in download_buttons if "STANDARD" in button.attrs['onclick'])[0]
-        clean_url = dirty_url.partition("=")[2].strip("\\'")
-        log.info("Downloading landsat imagery from {}".format(clean_url))
-        out_folder_path = os.path.join(out_dir, product['displayId'])
-        os.mkdir(out_folder_path)
-        tar_path = out_folder_path + ".tar.gz"
-        with open(tar_path, 'wb+') as fp:
-            image_response = dl_session.get(clean_url)
-            fp.write(image_response.content)
-            log.info("Item {} downloaded to {}".format(product['displayId'], tar_path))
-        log.info("Unzipping {} to {}".format(tar_path, out_folder_path))
-        with tarfile.open(tar_path, 'r:gz') as tar_ref:
-            tar_ref.extractall(out_folder_path)
-        log.info("Removing {}".format(tar_path))
-        os.remove(tar_path)
+
+def get_landsat_download_url(session, download_landing_url):
+    """Returns the URL of the standard Level-1 archive linked from the download page of a Landsat product."""
+    # BeautifulSoup is a library for finding things in webpages - in this case, every download link
+    lp_soup = BeautifulSoup(session.get(download_landing_url).content, 'html.parser')
+    download_buttons = lp_soup.find_all("input")
+    dirty_url = \
+        list(button.attrs['onclick'] for button in download_buttons if "STANDARD" in button.attrs.get('onclick', ""))[0]
+    return dirty_url.partition("=")[2].strip("\\'")
+
+
+def _is_wanted_landsat_member(member_name, bands):
+    if bands is None:
+        return True
+    name = os.path.basename(member_name)
+    if name.upper().endswith(".TXT"):
+        return True
+    return any(name.upper().endswith("_{}.TIF".format(band.upper())) for band in bands)
+
+
+def stream_landsat_product(session, url, out_folder_path, bands=None, timeout=60):
+    """
+    Downloads a Landsat .tar.gz archive and extracts it into out_folder_path as it arrives, with no temporary archive
+    on disk. The files are extracted into a temporary folder next to out_folder_path that is renamed when the archive
+    is complete, so an interrupted download never leaves a partial product.
+
+    Parameters
+    ----------
+    session
+        A requests.Session; see login_to_usgs
+    url
+        The URL of the archive
+    out_folder_path
+        The folder to extract the product to
+    bands
+        Optional. The bands to extract, such as ("B2", "B3", "B4"). The metadata (.txt) files are always extracted.
+        If None, every file is extracted.
+    timeout
+        Seconds to wait for the server to respond or send more data
+
+    Returns
+    -------
+    out_folder_path
+
+    """
+    partial_path = out_folder_path + ".partial"
+    if os.path.exists(partial_path):
+        shutil.rmtree(partial_path)
+    os.makedirs(partial_path)
+    with session.get(url, stream=True, timeout=timeout) as image_response:
+        image_response.raise_for_status()
+        image_response.raw.decode_content = True
+        # Stream mode reads the archive front to back, so members must be extracted in the order they arrive
+        with tarfile.open(fileobj=image_response.raw, mode="r|*") as tar_ref:
+            for member in tar_ref:
+                if not member.isfile() or not _is_wanted_landsat_member(member.name, bands):
+                    continue
+                log.info("Extracting {}".format(member.name))
+                member.name = os.path.basename(member.name)   # No paths from the archive outside the folder
+                tar_ref.extract(member, partial_path)
+    os.replace(partial_path, out_folder_path)
+    log.info("Item {} downloaded to {}".format(os.path.basename(out_folder_path), out_folder_path))
+    return out_folder_path
 
 
 def get_landsat_api_key(conf, session):
@@ -573,6 +668,7 @@ def download_s2_data(new_data, l1_dir, l2_dir, source='scihub', user=None, passw
         else:
             log.error("Invalid data source; valid values are 'aws', 'google' and 'scihub'")
             raise BadDataSourceExpection
+        invalidate_safe_index(os.path.join(out_path, identifier + ".SAFE"))
 
 
 def download_from_aws_with_rollback(product_id, folder, uuid, user, passwd):
@@ -634,6 +730,7 @@ def download_from_scihub(product_uuid, out_folder, user, passwd):
     zip_ref = zipfile.ZipFile(zip_path, 'r')
     zip_ref.extractall(out_folder)
     zip_ref.close()
+    invalidate_safe_index(os.path.join(out_folder, prod['title'] + ".SAFE"))
     log.info("Removing {}".format(zip_path))
     os.remove(zip_path)
 
@@ -666,6 +763,7 @@ def download_from_google_cloud(product_ids, out_folder, redownload=False):
             continue
         for s2_object in object_iter:
             download_blob_from_google(bucket, object_prefix, out_folder, s2_object)
+        invalidate_safe_index(os.path.join(out_folder, safe_id))
         # Need to make these two empty folders for sen2cor to work properly
         try:
             os.mkdir(os.path.join(os.path.abspath(out_folder), safe_id, "AUX_DATA"))
@@ -713,20 +811,27 @@ def get_planet_product_path(planet_dir, product):
     return os.path.join(planet_dir, product_file)
 
 
+SEARCH_NAME_DEPRECATION = ("search_name is ignored: Planet searches are now run as unnamed quick searches. "
+                           "Use build_search_request and do_saved_search for a named, saved search.")
+
+
 def download_planet_image_on_day(aoi_path, date, out_path, api_key, item_type="PSScene4Band", search_name="auto",
                                  asset_type="analytic", threads=5):
-    """Queries and downloads all images on the date in the aoi given"""
+    """Queries and downloads all images on the date in the aoi given. search_name is deprecated; see planet_query."""
     log = logging.getLogger(__name__)
+    if search_name != "auto":
+        warnings.warn(SEARCH_NAME_DEPRECATION, DeprecationWarning, stacklevel=2)
     start_time = date + "T00:00:00.000Z"
     end_time = date + "T23:59:59.000Z"
     try:
-        planet_query(aoi_path, start_time, end_time, out_path, api_key, item_type, search_name, asset_type, threads)
+        planet_query(aoi_path, start_time, end_time, out_path, api_key, item_type, asset_type=asset_type,
+                     threads=threads)
     except IndexError:
         log.warning("IndexError exception; likely no imagery available for chosen date")
 
 
 def planet_query(aoi_path, start_date, end_date, out_path, api_key, item_type="PSScene4Band", search_name="auto",
-                 asset_type="analytic", threads=5):
+                 asset_type="analytic", threads=5, days_per_query=30):
     """
     Downloads data from Planetlabs for a given time period in the given AOI
 
@@ -749,7 +854,8 @@ def planet_query(aoi_path, start_date, end_date, out_path, api_key, item_type="P
         Image type to download (see Planet API docs)
 
     search_name : str
-        A name to refer to the search (required for large searches)
+        Deprecated. Searches are now quick searches, which have no name; passing anything other than "auto" raises
+        a DeprecationWarning.
 
     asset_type : str
         Planet asset type to download (see Planet API docs)
@@ -757,96 +863,84 @@ def planet_query(aoi_path, start_date, end_date, out_path, api_key, item_type="P
     threads : int
         The number of downloads to perform concurrently
 
+    days_per_query : int
+        Time windows longer than this many days are split into shorter windows that are searched in parallel
+
+    Returns
+    -------
+    A dictionary of {item id: path to the downloaded image}; the path is None for items that failed.
+
     Notes
     -----
-    IMPORTANT: Will not run for searches returning greater than 250 items.
+    Items are found and downloaded by a pyeo.planet_downloads.PlanetDownloader. Every page of search results is
+    fetched, and items start activating as soon as their page arrives, so downloads begin before the search is
+    finished. Activation is waited for without blocking, and the rate of requests to the API is limited.
 
     """
+    if search_name != "auto":
+        warnings.warn(SEARCH_NAME_DEPRECATION, DeprecationWarning, stacklevel=2)
     feature = read_aoi(aoi_path)
     aoi = feature['geometry']
     session = requests.Session()
     session.auth = (api_key, '')
-    search_request = build_search_request(aoi, start_date, end_date, item_type, search_name)
-    search_result = do_quick_search(session, search_request)
-
-    thread_pool = Pool(threads)
-    threaded_dl = lambda item: activate_and_dl_planet_item(session, item, asset_type, out_path)
-    thread_pool.map(threaded_dl, search_result)
+    downloader = PlanetDownloader(out_dir=out_path, asset_type=asset_type, max_downloads=threads, session=session)
+    search = downloader.search(aoi, start_date, end_date, [item_type], days_per_query=days_per_query)
+    return downloader.run(search)
 
 
 def build_search_request(aoi, start_date, end_date, item_type, search_name):
-    """Builds a search request for the planet API"""
-    date_filter = planet_api.filters.date_range("acquired", gte=start_date, lte=end_date)
-    aoi_filter = planet_api.filters.geom_filter(aoi)
-    query = planet_api.filters.and_filter(date_filter, aoi_filter)
-    search_request = planet_api.filters.build_search_request(query, [item_type])
+    """Builds a search request for the planet API. search_name names the search when it is saved with
+    do_saved_search; do_quick_search leaves it out."""
+    search_request = build_search_filter(aoi, start_date, end_date, [item_type])
     search_request.update({'name': search_name})
     return search_request
 
 
 def do_quick_search(session, search_request):
-    """Tries the quick search; returns a dict of features"""
+    """Does a quick search; returns a list of every feature found, from every page of results"""
     search_url = "https://api.planet.com/data/v1/quick-search"
-    search_request.pop("name")
-    print("Sending quick search")
-    search_result = session.post(search_url, json=search_request)
-    if search_result.status_code >= 400:
+    search_request = {key: value for key, value in search_request.items() if key != "name"}
+    log.info("Sending quick search")
+    search_response = session.post(search_url, json=search_request)
+    if search_response.status_code >= 400:
         raise requests.ConnectionError
-    return search_result.json()["features"]
+    return get_paginated_items(session, search_response.json())
 
 
 def do_saved_search(session, search_request):
-    """Does a saved search; this doesn't seem to work yet."""
+    """Saves search_request as a search and runs it; returns a list of every feature found"""
     search_url = "https://api.planet.com/data/v1/searches/"
     search_response = session.post(search_url, json=search_request)
+    search_response.raise_for_status()
     search_id = search_response.json()['id']
-    if search_response.json()['_links'].get('_next_url'):
-        return get_paginated_items(session)
-    else:
-        search_url = "https://api-planet.com/data/v1/searches/{}/results".format(search_id)
-        response = session.get(search_url)
-        items = response.content.json()["features"]
-        return items
+    results_response = session.get("https://api.planet.com/data/v1/searches/{}/results".format(search_id))
+    results_response.raise_for_status()
+    return get_paginated_items(session, results_response.json())
 
 
-def get_paginated_items(session, search_id):
-    """Let's leave this out for now."""
-    raise Exception("pagination not handled yet")
+def get_paginated_items(session, first_page):
+    """Returns the features on first_page, a page of search results, and on every page after it, following the
+    _next link of each page."""
+    items = []
+    page = first_page
+    while True:
+        items.extend(page.get("features", []))
+        next_url = page.get("_links", {}).get("_next")
+        if not page.get("features") or not next_url:
+            return items
+        response = session.get(next_url)
+        response.raise_for_status()
+        page = response.json()
 
 
-@tenacity.retry(
-    wait=tenacity.wait_exponential(),
-    stop=tenacity.stop_after_delay(10000),
-    retry=tenacity.retry_if_exception_type(TooManyRequests)
-)
 def activate_and_dl_planet_item(session, item, asset_type, file_path):
-    """Activates and downloads a single planet item"""
-    log = logging.getLogger(__name__)
-    #  TODO: Implement more robust error handling here (not just 429)
-    item_id = item["id"]
-    item_type = item["properties"]["item_type"]
-    item_url = "https://api.planet.com/data/v1/" + \
-               "item-types/{}/items/{}/assets/".format(item_type, item_id)
-    item_response = session.get(item_url)
-    log.info("Activating " + item_id)
-    activate_response = session.post(item_response.json()[asset_type]["_links"]["activate"])
-    while True:
-        status = session.get(item_url)
-        if status.status_code == 429:
-            log.warning("ID {} too fast; backing off".format(item_id))
-            raise TooManyRequests
-        if status.json()[asset_type]["status"] == "active":
-            break
-    dl_link = status.json()[asset_type]["location"]
-    item_fp = os.path.join(file_path, item_id + ".tif")
-    log.info("Downloading item {} from {} to {}".format(item_id, dl_link, item_fp))
-    # TODO Do we want the metadata in a separate file as well as embedded in the geotiff?
-    with open(item_fp, 'wb+') as fp:
-        image_response = session.get(dl_link)
-        if image_response.status_code == 429:
-            raise TooManyRequests
-        fp.write(image_response.content)  # Don't like this; it might store the image twice. Check.
-        log.info("Item {} download complete".format(item_id))
+    """Activates and downloads a single planet item. See pyeo.planet_downloads.PlanetDownloader; to download many
+    items, give them all to one PlanetDownloader instead of calling this for each."""
+    downloader = PlanetDownloader(out_dir=file_path, asset_type=asset_type, max_downloads=1, session=session)
+    path = downloader.run([item])[item["id"]]
+    if path is None:
+        raise requests.ConnectionError("Download of {} failed".format(item["id"]))
+    return path
 
 
 def read_aoi(aoi_path):
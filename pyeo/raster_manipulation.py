@@ -32,33 +32,305 @@ import os
 import shutil
 import subprocess
 import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from tempfile import TemporaryDirectory, NamedTemporaryFile
 
 import gdal
 import numpy as np
 from osgeo import gdal_array, osr, ogr
 from osgeo.gdal_array import NumericTypeCodeToGDALTypeCode, GDALTypeCodeToNumericTypeCode
-#from skimage import morphology as morph
+from scipy import ndimage
 
 import pdb
 
 from pyeo.coordinate_manipulation import get_combined_polygon, pixel_bounds_from_polygon, write_geometry, \
-    get_aoi_intersection, get_raster_bounds, align_bounds_to_whole_number, get_poly_bounding_rect, reproject_vector
+    get_aoi_intersection, get_raster_bounds, align_bounds_to_whole_number, get_poly_bounding_rect, reproject_vector, \
+    get_grid_windows, get_raster_extent
 from pyeo.array_utilities import project_array
 from pyeo.filesystem_utilities import sort_by_timestamp, get_sen_2_tiles, get_l1_safe_file, get_sen_2_image_timestamp, \
-    get_sen_2_image_tile, get_sen_2_granule_id, check_for_invalid_l2_data, get_mask_path, get_sen_2_baseline
-from pyeo.exceptions import CreateNewStacksException, StackImagesException, BadS2Exception, NonSquarePixelException
+    get_sen_2_image_tile, get_sen_2_granule_id, check_for_invalid_l2_data, get_mask_path, get_sen_2_baseline, \
+    get_image_index, get_sen_2_sun_angles, get_sen_2_radiometric_scaling, get_safe_index, validate_safe_file, \
+    quarantine_safe_file
+from pyeo.dataset_cache import open_dataset, get_raster_info
+from pyeo.exceptions import CreateNewStacksException, StackImagesException, BadS2Exception, NonSquarePixelException, \
+    DatatypeOverflowException
 
 log = logging.getLogger("pyeo")
 
 import pyeo.windows_compatability
 
+# The creation options given to every GeoTIFF pyeo writes. PREDICTOR=AUTO picks the predictor from the datatype
+# of the image being written; see get_creation_options. Change with set_creation_options or read_creation_options.
+DEFAULT_CREATION_OPTIONS = {
+    "TILED": "YES",
+    "BLOCKXSIZE": "512",
+    "BLOCKYSIZE": "512",
+    "COMPRESS": "DEFLATE",
+    "PREDICTOR": "AUTO",
+    "BIGTIFF": "IF_SAFER",
+    "NUM_THREADS": "ALL_CPUS"
+}
+_creation_options = dict(DEFAULT_CREATION_OPTIONS)
+# Masks only hold 0 and 1, so they are written with one bit per pixel. GDAL unpacks them to Byte when read.
+MASK_NBITS = 1
+_FLOAT_DATATYPES = (gdal.GDT_Float32, gdal.GDT_Float64)
 
 
 
 
+
+def set_creation_options(**options):
+    """
+    Changes the creation options used for every GeoTIFF written by pyeo. For example,
+    set_creation_options(COMPRESS="ZSTD", ZSTD_LEVEL="9") or set_creation_options(COMPRESS="NONE", TILED=None).
+
+    Parameters
+    ----------
+    options
+        Keyword arguments of GTiff creation options (https://gdal.org/drivers/raster/gtiff.html). An option set to
+        None is removed from the profile.
+
+    """
+    for key, value in options.items():
+        key = key.upper()
+        if value is None:
+            _creation_options.pop(key, None)
+        else:
+            _creation_options[key] = str(value)
+    log.info("GeoTIFF creation options: {}".format(_creation_options))
+
+
+def reset_creation_options():
+    """Restores the creation options to DEFAULT_CREATION_OPTIONS."""
+    _creation_options.clear()
+    _creation_options.update(DEFAULT_CREATION_OPTIONS)
+
+
+def read_creation_options(conf):
+    """
+    Sets the creation options from the [output] section of a config file, if there is one. Every key in the section
+    except 'cog' is a GTiff creation option; for example, compress=ZSTD. Keys with an empty value are removed from
+    the profile.
+
+    Parameters
+    ----------
+    conf
+        A configparser.ConfigParser object
+
+    """
+    if not conf.has_section("output"):
+        return
+    set_creation_options(**{key: value if value else None for key, value in conf.items("output") if key != "cog"})
+
+
+def get_creation_options(format="GTiff", datatype=None, nbits=None):
+    """
+    Returns the current creation options as a list of "KEY=VALUE" strings, ready for driver.Create or the
+    creationOptions argument of gdal.Warp and gdal.Translate.
+
+    Parameters
+    ----------
+    format
+        The GDAL driver the options are for. Only GTiff images get the profile; every other format gets no options.
+    datatype
+        The gdal datatype of the image. If PREDICTOR is AUTO, integer images get horizontal differencing (2) and
+        floating point images get floating point prediction (3). If None, no predictor is set.
+    nbits
+        Optional. Packs each pixel into this many bits; masks use 1 (see MASK_NBITS). Bit-packed images get no
+        predictor.
+
+    Returns
+    -------
+    A list of strings
+
+    """
+    if format != "GTiff":
+        return []
+    options = dict(_creation_options)
+    predictor = options.pop("PREDICTOR", None)
+    if nbits:
+        options["NBITS"] = str(nbits)
+        predictor = None
+    if predictor == "AUTO":
+        predictor = None
+        if datatype is not None and options.get("COMPRESS", "NONE").upper() in ("DEFLATE", "LZW", "ZSTD", "LZMA"):
+            predictor = "3" if datatype in _FLOAT_DATATYPES else "2"
+    if predictor:
+        options["PREDICTOR"] = predictor
+    return ["{}={}".format(key, value) for key, value in options.items()]
+
+
+def _get_image_structure(raster):
+    """(datatype, nbits) of the first band of raster, which is a gdal.Dataset or a path. nbits is None unless the
+    image is bit-packed; both are None if the image can't be read."""
+    if type(raster) is str:
+        raster = open_dataset(raster)
+    if raster is None or not raster.RasterCount:
+        return None, None
+    band = raster.GetRasterBand(1)
+    nbits = band.GetMetadataItem("NBITS", "IMAGE_STRUCTURE")
+    return band.DataType, int(nbits) if nbits else None
+
+
+def get_matching_creation_options(raster, format="GTiff"):
+    """
+    Returns the creation options for a copy or warp of raster: the current profile, with the predictor for the
+    datatype of raster and, if raster is bit-packed like a mask, the same NBITS.
+
+    Parameters
+    ----------
+    raster
+        A gdal.Dataset or the path to a raster
+    format
+        The GDAL driver of the new image
+
+    Returns
+    -------
+    A list of strings
+
+    """
+    datatype, nbits = _get_image_structure(raster)
+    return get_creation_options(format, datatype, nbits)
+
+
+def numpy_to_gdal_datatype(dtype):
+    """
+    Returns the gdal datatype for a numpy dtype, promoting types that GeoTIFF can't hold: bool becomes Byte, int8
+    becomes Int16 and 64-bit integers become Float64.
+
+    Parameters
+    ----------
+    dtype
+        A numpy dtype
+
+    Returns
+    -------
+    A gdal datatype
+
+    """
+    dtype = np.dtype(dtype)
+    if dtype == np.bool_:
+        return gdal.GDT_Byte
+    if dtype == np.int8:
+        dtype = np.dtype(np.int16)
+    if dtype in (np.int64, np.uint64):
+        log.warning("64-bit integers are not supported; promoting to Float64")
+        return gdal.GDT_Float64
+    return NumericTypeCodeToGDALTypeCode(dtype)
+
+
+def get_common_datatype(rasters, values=()):
+    """
+    Returns the narrowest gdal datatype that can hold every band of every raster without loss, and any extra values
+    such as a nodata value. For example, UInt16 and Byte rasters give UInt16, while UInt16 and Int16 rasters (or a
+    UInt16 raster with a nodata value of -9999) give Int32.
+
+    Parameters
+    ----------
+    rasters
+        A list of gdal.Dataset objects
+    values
+        Optional. A list of numbers that must also fit in the datatype.
+
+    Returns
+    -------
+    A gdal datatype
+
+    """
+    dtypes = [GDALTypeCodeToNumericTypeCode(raster.GetRasterBand(band_index + 1).DataType)
+              for raster in rasters for band_index in range(raster.RasterCount)]
+    dtypes += [np.min_scalar_type(value) for value in values]
+    return numpy_to_gdal_datatype(np.result_type(*dtypes))
+
+
+def check_datatype_fits(array, datatype):
+    """
+    Checks that every value in array can be written to an image of datatype without overflowing. Arrays whose own
+    dtype can always be cast to datatype are not scanned.
+
+    Parameters
+    ----------
+    array
+        A numpy array or masked array
+    datatype
+        A gdal datatype
+
+    Raises
+    ------
+    DatatypeOverflowException
+        If any value of array is outside the range of datatype
+
+    """
+    out_dtype = np.dtype(GDALTypeCodeToNumericTypeCode(datatype))
+    if np.can_cast(array.dtype, out_dtype) or array.size == 0:
+        return
+    if out_dtype.kind in "iu":
+        limits = np.iinfo(out_dtype)
+    elif out_dtype.kind == "f":
+        limits = np.finfo(out_dtype)
+    else:
+        return
+    array_min, array_max = array.min(), array.max()
+    if array_min < limits.min or array_max > limits.max:
+        raise DatatypeOverflowException("Values from {} to {} do not fit in {}".format(
+            array_min, array_max, gdal.GetDataTypeName(datatype)))
+
+
+def save_as_cog(in_path, out_path=None, resampling="NEAREST"):
+    """
+    Writes an image as a Cloud-Optimized GeoTIFF with internal overviews, compressed with the current creation
+    options. Use for final products that will be viewed or served, not for images that are updated in place.
+
+    Parameters
+    ----------
+    in_path
+        The image to convert
+    out_path
+        Where to write the COG. If None, in_path is replaced.
+    resampling
+        The resampling method for the overviews. Use NEAREST for class maps and AVERAGE for continuous values.
+
+    Returns
+    -------
+    The path of the COG
+
+    """
+    replace = out_path is None or os.path.abspath(out_path) == os.path.abspath(in_path)
+    target = in_path + ".cog.tif" if replace else out_path
+    geotiff_options = dict(option.split("=", 1) for option in get_matching_creation_options(in_path))
+    if gdal.GetDriverByName("COG") is not None:
+        # GDAL 3.1 and later write the image and its overviews in one pass
+        cog_options = ["OVERVIEW_RESAMPLING={}".format(resampling)]
+        for key in ("COMPRESS", "BIGTIFF", "NUM_THREADS"):
+            if key in geotiff_options:
+                cog_options.append("{}={}".format(key, geotiff_options[key]))
+        if "BLOCKXSIZE" in geotiff_options:
+            cog_options.append("BLOCKSIZE={}".format(geotiff_options["BLOCKXSIZE"]))
+        if "PREDICTOR" in geotiff_options:
+            cog_options.append("PREDICTOR=YES")
+        gdal.Translate(target, in_path, format="COG", creationOptions=cog_options)
+    else:
+        # Older GDALs: build the overviews on a copy, then copy them in ahead of the image data
+        with TemporaryDirectory() as td:
+            temp_path = os.path.join(td, "overviews.tif")
+            temp_image = gdal.Translate(temp_path, in_path, creationOptions=["TILED=YES", "BIGTIFF=IF_SAFER"])
+            temp_image.BuildOverviews(resampling, [2, 4, 8, 16, 32])
+            geotiff_options["TILED"] = "YES"
+            geotiff_options["COPY_SRC_OVERVIEWS"] = "YES"
+            gdal.GetDriverByName("GTiff").CreateCopy(
+                target, temp_image, options=["{}={}".format(key, value) for key, value in geotiff_options.items()])
+            temp_image = None
+    if replace:
+        os.replace(target, in_path)
+        target = in_path
+    log.info("Saved cloud-optimised GeoTIFF {}".format(target))
+    return target
+
+
 def create_matching_dataset(in_dataset, out_path,
-                            format="GTiff", bands=1, datatype = None):
+                            format="GTiff", bands=1, datatype = None, nbits = None):
     """
     Creates an empty gdal dataset with the same dimensions, projection and geotransform as in_dataset.
     Defaults to 1 band.
@@ -76,6 +348,8 @@ def create_matching_dataset(in_dataset, out_path,
         The number of bands in the dataset. Defaults to one.
     datatype
         The datatype of the returned dataset. See the introduction for this module.
+    nbits
+        Optional. The number of bits per pixel, for bit-packed images such as masks.
 
     Returns
     -------
@@ -89,7 +363,8 @@ def create_matching_dataset(in_dataset, out_path,
                                 xsize=in_dataset.RasterXSize,
                                 ysize=in_dataset.RasterYSize,
                                 bands=bands,
-                                eType=datatype)
+                                eType=datatype,
+                                options=get_creation_options(format, datatype, nbits))
     out_dataset.SetGeoTransform(in_dataset.GetGeoTransform())
     out_dataset.SetProjection(in_dataset.GetProjection())
     return out_dataset
@@ -127,7 +402,8 @@ def save_array_as_image(array, path, geotransform, projection, format = "GTiff")
         xsize=array.shape[2],
         ysize=array.shape[1],
         bands=array.shape[0],
-        eType=type_code
+        eType=type_code,
+        options=get_creation_options(format, type_code)
     )
     out_dataset.SetGeoTransform(geotransform)
     out_dataset.SetProjection(projection)
@@ -238,13 +514,16 @@ def stack_image_with_composite(image_path, composite_path, out_dir, create_combi
 
 
 def stack_images(raster_paths, out_raster_path,
-                 geometry_mode="intersect", format="GTiff", datatype=gdal.GDT_Int32):
+                 geometry_mode="intersect", format="GTiff", datatype=None, band_names=None):
     """
     When provided with a list of rasters, will stack them into a single raster. The nunmber of
     bands in the output is equal to the total number of bands in the input. Geotransform and projection
     are taken from the first raster in the list; there may be unexpected behavior if multiple differing
     proejctions are provided.
 
+    If the rasters are all on the same pixel grid (see pyeo.coordinate_manipulation.ProjectGrid), they are combined
+    with whole-pixel offsets; otherwise, their overlap is calculated with OGR geometry.
+
     Parameters
     ----------
     raster_paths
@@ -259,24 +538,36 @@ def stack_images(raster_paths, out_raster_path,
     format
         The GDAL image format for the output.
     datatype
-        The datatype of the gdal array
+        The datatype of the gdal array. If None, the narrowest type that holds every input band is used (see
+        get_common_datatype), so a stack of UInt16 images stays UInt16.
+    band_names
+        Optional. A description for each band of the output, such as the names of the bands being stacked.
 
     """
     #TODO: Confirm the union works, and confirm that nondata defaults to 0.
     log.info("Stacking images {}".format(raster_paths))
     if len(raster_paths) <= 1:
         raise StackImagesException("stack_images requires at least two input images")
-    rasters = [gdal.Open(raster_path) for raster_path in raster_paths]
+    rasters = [open_dataset(raster_path) for raster_path in raster_paths]
     total_layers = sum(raster.RasterCount for raster in rasters)
+    if datatype is None:
+        datatype = get_common_datatype(rasters)
     projection = rasters[0].GetProjection()
     in_gt = rasters[0].GetGeoTransform()
     x_res = in_gt[1]
     y_res = in_gt[5]*-1   # Y resolution in affine geotransform is -ve for Maths reasons
-    combined_polygons = get_combined_polygon(rasters, geometry_mode)
+    grid_windows = get_grid_windows(rasters, geometry_mode)
 
     # Creating a new gdal object
-    out_raster = create_new_image_from_polygon(combined_polygons, out_raster_path, x_res, y_res,
-                                               total_layers, projection, format, datatype)
+    if grid_windows:
+        out_gt, (x_size, y_size), windows = grid_windows
+        out_raster = create_new_image_from_geotransform(out_gt, x_size, y_size, out_raster_path, total_layers,
+                                                        projection, format, datatype)
+    else:
+        combined_polygons = get_combined_polygon(rasters, geometry_mode)
+        out_raster = create_new_image_from_polygon(combined_polygons, out_raster_path, x_res, y_res,
+                                                   total_layers, projection, format, datatype)
+        combined_bounds = combined_polygons.GetEnvelope()  # Lets pixel_bounds_from_polygon skip OGR
 
     # I've done some magic here. GetVirtualMemArray lets you change a raster directly without copying
     out_raster_array = out_raster.GetVirtualMemArray(eAccess=gdal.GF_Write)
@@ -284,8 +575,11 @@ def stack_images(raster_paths, out_raster_path,
     for i, in_raster in enumerate(rasters):
         log.info("Stacking image {}".format(i))
         in_raster_array = in_raster.GetVirtualMemArray()
-        out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_raster, combined_polygons)
-        in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(in_raster, combined_polygons)
+        if grid_windows:
+            (in_x_min, in_x_max, in_y_min, in_y_max), (out_x_min, out_x_max, out_y_min, out_y_max) = windows[i]
+        else:
+            out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_raster, combined_bounds)
+            in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(in_raster, combined_bounds)
         if len(in_raster_array.shape) == 2:
             in_raster_array = np.expand_dims(in_raster_array, 0)
         # Gdal does band, y, x
@@ -299,6 +593,7 @@ def stack_images(raster_paths, out_raster_path,
                     in_y_min: in_y_max,
                     in_x_min: in_x_max
                     ]
+        check_datatype_fits(in_raster_view, datatype)
         out_raster_view[...] = in_raster_view
         out_raster_view = None
         in_raster_view = None
@@ -306,6 +601,9 @@ def stack_images(raster_paths, out_raster_path,
         in_raster_array = None
         in_raster = None
     out_raster_array = None
+    if band_names:
+        for band_index, band_name in enumerate(band_names):
+            out_raster.GetRasterBand(band_index+1).SetDescription(band_name)
     out_raster = None
 
 
@@ -329,7 +627,7 @@ def strip_bands(in_raster_path, out_raster_path, bands_to_strip):
 
 
 def average_images(raster_paths, out_raster_path,
-                 geometry_mode="intersect", format="GTiff", datatype=gdal.GDT_Int32):
+                 geometry_mode="intersect", format="GTiff", datatype=None):
     """
     When provided with a list of rasters, will stack them into a single raster. The nunmber of
     bands in the output is equal to the total number of bands in the input. Geotransform and projection
@@ -350,15 +648,17 @@ def average_images(raster_paths, out_raster_path,
     format
         The GDAL image format for the output.
     datatype
-        The datatype of the gdal array
+        The datatype of the gdal array. If None, the narrowest type that holds every input band is used.
 
     """
     # TODO: Confirm the union works, and confirm that nondata defaults to 0.
     log.info("Stacking images {}".format(raster_paths))
     if len(raster_paths) <= 1:
         raise StackImagesException("stack_images requires at least two input images")
-    rasters = [gdal.Open(raster_path) for raster_path in raster_paths]
+    rasters = [open_dataset(raster_path) for raster_path in raster_paths]
     most_rasters = max(raster.RasterCount for raster in rasters)
+    if datatype is None:
+        datatype = get_common_datatype(rasters)
     projection = rasters[0].GetProjection()
     in_gt = rasters[0].GetGeoTransform()
     x_res = in_gt[1]
@@ -371,8 +671,8 @@ def average_images(raster_paths, out_raster_path,
 
     # I've done some magic here. GetVirtualMemArray lets you change a raster directly without copying
     out_raster_array = out_raster.GetVirtualMemArray(eAccess=gdal.GF_Write)
-    if len(out_raster_array.shape == 2):
-        out_raster_array = np.expand_dims(out_raster_array, 3)
+    if len(out_raster_array.shape) == 2:
+        out_raster_array = np.expand_dims(out_raster_array, 0)
     present_layer = 0
     for i, in_raster in enumerate(rasters):
         log.info("Stacking image {}".format(i))
@@ -383,16 +683,17 @@ def average_images(raster_paths, out_raster_path,
             in_raster_array = np.expand_dims(in_raster_array, 0)
         # Gdal does band, y, x
         out_raster_view = out_raster_array[
-                          :
+                          :,
                           out_y_min: out_y_max,
                           out_x_min: out_x_max
                           ]
         in_raster_view = in_raster_array[
-                         :
+                         :,
                          in_y_min: in_y_max,
                          in_x_min: in_x_max
                          ]
-        out_raster_view[...] = (out_raster_view+in_raster_view)/2   # Sequential mean
+        # Sequential mean; summed in float64 so narrow integer types don't overflow
+        out_raster_view[...] = np.add(out_raster_view, in_raster_view, dtype=np.float64)/2
         out_raster_view = None
         in_raster_view = None
         present_layer += in_raster.RasterCount
@@ -451,7 +752,7 @@ def trim_image(in_raster_path, out_raster_path, polygon, format="GTiff"):
         in_raster = None
 
 
-def mosaic_images(raster_paths, out_raster_file, format="GTiff", datatype=gdal.GDT_Int32, nodata = 0):
+def mosaic_images(raster_paths, out_raster_file, format="GTiff", datatype=None, nodata = 0):
     """
     Mosaics multiple images with the same number of layers into one single image. Overwrites
     overlapping pixels with the value furthest down raster_paths. Takes projection from the first
@@ -466,7 +767,7 @@ def mosaic_images(raster_paths, out_raster_file, format="GTiff", datatype=gdal.G
     format
         The image format of the output raster.
     datatype
-        The datatype of the output raster
+        The datatype of the output raster. If None, the narrowest type that holds every input band and nodata.
     nodata
         The input nodata value; any pixels in raster_paths with this value will be ignored.
 
@@ -475,15 +776,23 @@ def mosaic_images(raster_paths, out_raster_file, format="GTiff", datatype=gdal.G
     # This, again, is very similar to stack_rasters
     log = logging.getLogger(__name__)
     log.info("Beginning mosaic")
-    rasters = [gdal.Open(raster_path) for raster_path in raster_paths]
+    rasters = [open_dataset(raster_path) for raster_path in raster_paths]
     projection = rasters[0].GetProjection()
     in_gt = rasters[0].GetGeoTransform()
     x_res = in_gt[1]
     y_res = in_gt[5] * -1  # Y resolution in agt is -ve for Maths reasons
-    combined_polygon = align_bounds_to_whole_number(get_combined_polygon(rasters, geometry_mode='union'))
     layers = rasters[0].RasterCount
-    out_raster = create_new_image_from_polygon(combined_polygon, out_raster_file, x_res, y_res, layers,
-                                               projection, format, datatype)
+    if datatype is None:
+        datatype = get_common_datatype(rasters, values=(nodata,))
+    grid_windows = get_grid_windows(rasters, geometry_mode='union')
+    if grid_windows:
+        out_gt, (x_size, y_size), windows = grid_windows
+        out_raster = create_new_image_from_geotransform(out_gt, x_size, y_size, out_raster_file, layers,
+                                                        projection, format, datatype)
+    else:
+        combined_polygon = align_bounds_to_whole_number(get_combined_polygon(rasters, geometry_mode='union'))
+        out_raster = create_new_image_from_polygon(combined_polygon, out_raster_file, x_res, y_res, layers,
+                                                   projection, format, datatype)
     log.info("New empty image created at {}".format(out_raster_file))
     out_raster_array = out_raster.GetVirtualMemArray(eAccess=gdal.GF_Write)
     for i, raster in enumerate(rasters):
@@ -491,10 +800,14 @@ def mosaic_images(raster_paths, out_raster_file, format="GTiff", datatype=gdal.G
         in_raster_array = raster.GetVirtualMemArray()
         if len(in_raster_array.shape) == 2:
             in_raster_array = np.expand_dims(in_raster_array, 0)
-        in_bounds = get_raster_bounds(raster)
-        out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_raster, in_bounds)
+        if grid_windows:
+            out_x_min, out_x_max, out_y_min, out_y_max = windows[i][1]
+        else:
+            in_bounds = get_raster_extent(raster)
+            out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_raster, in_bounds)
         out_raster_view = out_raster_array[:, out_y_min: out_y_max, out_x_min: out_x_max]
-        np.copyto(out_raster_view, in_raster_array, where=in_raster_array != nodata)
+        check_datatype_fits(in_raster_array, datatype)
+        np.copyto(out_raster_view, in_raster_array, where=in_raster_array != nodata, casting="unsafe")
         in_raster_array = None
         out_raster_view = None
     log.info("Raster mosaicking done")
@@ -525,30 +838,35 @@ def composite_images_with_mask(in_raster_path_list, composite_out_path, format="
     Masks are assumed to be a multiplicative .msk file with the same path as their corresponding image; see REFERENCE.
     All images must have the same number of layers and resolution, but do not have to be perfectly on top of each
     other. If it does not exist, composite_out_path will be created. Takes projection, resolution, ect from first band
-    of first raster in list. Will reproject images and masks if they do not match initial raster.
+    of first raster in list. Will reproject images and masks if they do not match initial raster. Images on the same
+    pixel grid are placed with whole-pixel offsets instead of OGR geometry.
 
     """
 
     log = logging.getLogger(__name__)
     driver = gdal.GetDriverByName(format)
-    in_raster_list = [gdal.Open(raster) for raster in in_raster_path_list]
+    in_raster_list = [open_dataset(raster) for raster in in_raster_path_list]
     projection = in_raster_list[0].GetProjection()
     in_gt = in_raster_list[0].GetGeoTransform()
     x_res = in_gt[1]
     y_res = in_gt[5] * -1
     n_bands = in_raster_list[0].RasterCount
-    temp_band = in_raster_list[0].GetRasterBand(1)
-    datatype = temp_band.DataType
-    temp_band = None
+    datatype = get_common_datatype(in_raster_list)
 
     # Creating output image + array
     log.info("Creating composite at {}".format(composite_out_path))
     log.info("Composite info: x_res: {}, y_res: {}, {} bands, datatype: {}, projection: {}"
              .format(x_res, y_res, n_bands, datatype, projection))
-    out_bounds = align_bounds_to_whole_number(get_poly_bounding_rect(get_combined_polygon(in_raster_list,
-                                                                                          geometry_mode="union")))
-    composite_image = create_new_image_from_polygon(out_bounds, composite_out_path, x_res, y_res, n_bands,
-                                                    projection, format, datatype)
+    grid_windows = get_grid_windows(in_raster_list, geometry_mode="union")
+    if grid_windows:
+        out_gt, (x_size, y_size), windows = grid_windows
+        composite_image = create_new_image_from_geotransform(out_gt, x_size, y_size, composite_out_path, n_bands,
+                                                             projection, format, datatype)
+    else:
+        out_bounds = align_bounds_to_whole_number(get_poly_bounding_rect(get_combined_polygon(in_raster_list,
+                                                                                              geometry_mode="union")))
+        composite_image = create_new_image_from_polygon(out_bounds, composite_out_path, x_res, y_res, n_bands,
+                                                        projection, format, datatype)
 
     if generate_date_image:
         time_out_path = composite_out_path.rsplit('.')[0]+".dates"
@@ -566,26 +884,33 @@ def composite_images_with_mask(in_raster_path_list, composite_out_path, format="
 
         # Get a view of in_raster according to output_array
         log.info("Adding {} to composite".format(in_raster_path_list[i]))
-        in_bounds = align_bounds_to_whole_number(get_raster_bounds(in_raster))
-        x_min, x_max, y_min, y_max = pixel_bounds_from_polygon(composite_image, in_bounds)
+        if grid_windows:
+            x_min, x_max, y_min, y_max = windows[i][1]
+        else:
+            in_bounds = align_bounds_to_whole_number(get_raster_bounds(in_raster))
+            x_min, x_max, y_min, y_max = pixel_bounds_from_polygon(composite_image, in_bounds)
         output_view = output_array[:, y_min:y_max, x_min:x_max]
 
-        # Move every unmasked pixel in in_raster to output_view
+        # Move every unmasked pixel in in_raster to output_view, a strip of the mask at a time
         log.info("Mask for {} at {}".format(in_raster_path_list[i], mask_paths[i]))
-        in_masked = get_masked_array(in_raster, mask_paths[i])
-        np.copyto(output_view, in_masked, where=np.logical_not(in_masked.mask))
-
-        # Save dates in date_image if needed
+        in_array = in_raster.GetVirtualMemArray()
+        if len(in_array.shape) == 2:
+            in_array = np.expand_dims(in_array, 0)
         if generate_date_image:
             dates_view = dates_array[y_min: y_max, x_min: x_max]
             # Gets timestamp as integer in form yyyymmdd
             date = np.uint32(get_sen_2_image_timestamp(in_raster.GetFileList()[0]).split("T")[0])
-            dates_view[np.logical_not(in_masked.mask[0, ...])] = date
-            dates_view = None
+        for row, valid in read_mask_blocks(mask_paths[i]):
+            rows = slice(row, row + valid.shape[0])
+            np.copyto(output_view[:, rows, :], in_array[:, rows, :], where=valid)
+            # Save dates in date_image if needed
+            if generate_date_image:
+                dates_view[rows][valid] = date
 
         # Deallocate
         output_view = None
-        in_masked = None
+        dates_view = None
+        in_array = None
 
     output_array = None
     dates_array = None
@@ -623,9 +948,10 @@ def reproject_directory(in_dir, out_dir, new_projection, extension = '.tif'):
         reproject_image(image_path, reproj_path, new_projection)
 
 
-def reproject_image(in_raster, out_raster_path, new_projection,  driver = "GTiff",  memory = 2e3, do_post_resample=True):
+def reproject_image(in_raster, out_raster_path, new_projection,  driver = "GTiff",  memory = 2e3, do_post_resample=True,
+                    resolution=None, num_threads="ALL_CPUS"):
     """
-    Creates a new, reprojected image from in_raster using the gdal.ReprojectImage function.
+    Creates a new, reprojected image from in_raster using the gdal.Warp function.
 
     Parameters
     ----------
@@ -634,19 +960,28 @@ def reproject_image(in_raster, out_raster_path, new_projection,  driver = "GTiff
     out_raster_path
         The path to the new output raster.
     new_projection
-        The new projection in .wkt
+        The new projection in .wkt, or an EPSG number
     driver
         The format of the output raster.
     memory
-        The amount of memory to give to the reprojection.
+        The amount of memory in MB to give to the reprojection; the image is warped in chunks that fit in this.
     do_post_resample
-        If set to false, do not resample the image back to the original projection.
+        If set to false and resolution is not given, let GDAL choose the output pixel size.
+    resolution
+        The pixel size of the output image, in the units of new_projection. Defaults to the pixel size of in_raster.
+    num_threads
+        The number of threads to warp with; an integer or "ALL_CPUS".
+
+    Returns
+    -------
+    out_raster_path
 
     Notes
     -----
     The GDAL reprojection routine changes the size of the pixels by a very small amount; for example, a 10m pixel image
-    can become a 10.002m pixel resolution image. To stop alignment issues,
-    by deafult this function resamples the images back to their original resolution
+    can become a 10.002m pixel resolution image. To stop alignment issues, by default this function warps straight
+    onto a grid of the original resolution whose corners are whole multiples of that resolution (gdalwarp -tap), so
+    no second resampling pass is needed.
 
     """
     if type(new_projection) is int:
@@ -657,16 +992,20 @@ def reproject_image(in_raster, out_raster_path, new_projection,  driver = "GTiff
     log.info("Reprojecting {} to {}".format(in_raster, new_projection))
     if type(in_raster) is str:
         in_raster = gdal.Open(in_raster)
-    res = in_raster.GetGeoTransform()[1]
-    gdal.Warp(out_raster_path, in_raster, dstSRS=new_projection, warpMemoryLimit=memory, format=driver)
-    # After warping, image has irregular gt; resample back to previous pixel size
-    # TODO: Make this an option
-    if do_post_resample:
-        resample_image_in_place(out_raster_path, res)
+    if resolution is None and do_post_resample:
+        resolution = in_raster.GetGeoTransform()[1]
+    grid_args = {}
+    if resolution:
+        grid_args = dict(xRes=resolution, yRes=resolution, targetAlignedPixels=True)
+    warp_options = gdal.WarpOptions(dstSRS=new_projection, warpMemoryLimit=memory, format=driver,
+                                    multithread=True, warpOptions=["NUM_THREADS={}".format(num_threads)],
+                                    creationOptions=get_matching_creation_options(in_raster, driver),
+                                    **grid_args)
+    gdal.Warp(out_raster_path, in_raster, options=warp_options)
     return out_raster_path
 
 
-def composite_directory(image_dir, composite_out_dir, format="GTiff", generate_date_images=False):
+def composite_directory(image_dir, composite_out_dir, format="GTiff", generate_date_images=False, tile=None):
     """
     Using composite_images_with_mask, creates a composite containing every image in image_dir. This will
      place a file named composite_[last image date].tif inside composite_out_dir
@@ -681,6 +1020,9 @@ def composite_directory(image_dir, composite_out_dir, format="GTiff", generate_d
         The raster format of the output image.
     generate_date_images
         If true, generates a corresponding date image for the composite. See docs for composite_images_with_mask.
+    tile
+        If given, only composites images of this tile (eg "T13QFB") and names the output
+        composite_[tile]_[last image date].tif
 
     Returns
     -------
@@ -689,11 +1031,13 @@ def composite_directory(image_dir, composite_out_dir, format="GTiff", generate_d
     """
     log = logging.getLogger(__name__)
     log.info("Compositing {}".format(image_dir))
-    sorted_image_paths = [os.path.join(image_dir, image_name) for image_name
-                          in sort_by_timestamp(os.listdir(image_dir), recent_first=False)  # Let's think about this
-                          if image_name.endswith(".tif")]
+    sorted_image_paths = [record.path for record
+                          in get_image_index(image_dir).records(tile=tile, extension=".tif")]
     last_timestamp = get_sen_2_image_timestamp(os.path.basename(sorted_image_paths[-1]))
-    composite_out_path = os.path.join(composite_out_dir, "composite_{}.tif".format(last_timestamp))
+    if tile:
+        composite_out_path = os.path.join(composite_out_dir, "composite_{}_{}.tif".format(tile, last_timestamp))
+    else:
+        composite_out_path = os.path.join(composite_out_dir, "composite_{}.tif".format(last_timestamp))
     composite_images_with_mask(sorted_image_paths, composite_out_path, format, generate_date_image=generate_date_images)
     return composite_out_path
 
@@ -740,13 +1084,38 @@ def get_masked_array(raster, mask_path):
     A numpy.masked array of the raster.
 
     """
-    mask = gdal.Open(mask_path)
+    mask = open_dataset(mask_path)
     mask_array = mask.GetVirtualMemArray()
     raster_array = raster.GetVirtualMemArray()
-    # If the shapes do not match, assume single-band mask for multi-band raster
-    if len(mask_array.shape) == 2 and len(raster_array.shape) == 3:
-        mask_array = project_array(mask_array, raster_array.shape[0], 0)
-    return np.ma.array(raster_array, mask=np.logical_not(mask_array))
+    # If the shapes do not match, assume single-band mask for multi-band raster. The broadcast is copied so callers
+    # can change the mask of each band independently.
+    return np.ma.array(raster_array, mask=np.broadcast_to(np.logical_not(mask_array), raster_array.shape).copy())
+
+
+def read_mask_blocks(mask, block_rows=None):
+    """
+    Reads a single-band mask a strip of rows at a time, so a bit-packed mask is never unpacked all at once.
+
+    Parameters
+    ----------
+    mask
+        A gdal.Dataset of a mask, or its path
+    block_rows
+        The number of rows in each strip. Defaults to the block height of the mask.
+
+    Yields
+    ------
+    Tuples of (first row, array of the strip as booleans: True for unmasked pixels)
+
+    """
+    if type(mask) is str:
+        mask = open_dataset(mask)
+    band = mask.GetRasterBand(1)
+    if block_rows is None:
+        block_rows = max(band.GetBlockSize()[1], 256)
+    for y_offset in range(0, mask.RasterYSize, block_rows):
+        rows = min(block_rows, mask.RasterYSize - y_offset)
+        yield y_offset, band.ReadAsArray(0, y_offset, mask.RasterXSize, rows).astype(np.bool_)
 
 
 def stack_and_trim_images(old_image_path, new_image_path, aoi_path, out_image):
@@ -824,7 +1193,8 @@ def clip_raster(raster_path, aoi_path, out_path, srs_id=4326, flip_x_y = False):
             cropToCutline=True,
             width=width_pix,
             height=height_pix,
-            dstSRS=srs
+            dstSRS=srs,
+            creationOptions=get_matching_creation_options(raster)
         )
         out = gdal.Warp(out_path, raster, options=clip_spec)
         out.SetGeoTransform(new_geotransform)
@@ -854,8 +1224,16 @@ def clip_raster_to_intersection(raster_to_clip_path, extent_raster_path, out_ras
         clip_raster(raster_to_clip_path, temp_aoi_path, out_raster_path, srs_id, flip_x_y = is_landsat)
 
 
+def _datatype_for_new_image(datatype, rasters):
+    if datatype is not None:
+        return datatype
+    if rasters:
+        return get_common_datatype(rasters)
+    return gdal.GDT_Int32
+
+
 def create_new_image_from_polygon(polygon, out_path, x_res, y_res, bands,
-                           projection, format="GTiff", datatype = gdal.GDT_Int32, nodata = -9999):
+                           projection, format="GTiff", datatype = None, nodata = -9999, nbits = None, rasters = None):
     """
     Returns an empty image that covers the extent of the imput polygon.
 
@@ -876,9 +1254,15 @@ def create_new_image_from_polygon(polygon, out_path, x_res, y_res, bands,
     format
         The gdal raster format of the output image
     datatype
-        The gdal datatype of the output image
+        The gdal datatype of the output image. If None, the narrowest datatype that holds every band of rasters; see
+        get_common_datatype. If rasters is not given either, Int32.
     nodata
         The nodata value of the output image
+    nbits
+        Optional. The number of bits per pixel, for bit-packed images such as masks.
+    rasters
+        Optional. A list of the gdal.Dataset objects that will be written into the new image, used to choose its
+        datatype.
 
     Returns
     -------
@@ -886,6 +1270,7 @@ def create_new_image_from_polygon(polygon, out_path, x_res, y_res, bands,
 
     """
     # TODO: Implement nodata
+    datatype = _datatype_for_new_image(datatype, rasters)
     bounds_x_min, bounds_x_max, bounds_y_min, bounds_y_max = polygon.GetEnvelope()
     if bounds_x_min >= bounds_x_max:
         bounds_x_min, bounds_x_max = bounds_x_max, bounds_x_min
@@ -896,7 +1281,7 @@ def create_new_image_from_polygon(polygon, out_path, x_res, y_res, bands,
     driver = gdal.GetDriverByName(format)
     out_raster = driver.Create(
         out_path, xsize=final_width_pixels, ysize=final_height_pixels,
-        bands=bands, eType=datatype
+        bands=bands, eType=datatype, options=get_creation_options(format, datatype, nbits)
     )
     out_raster.SetGeoTransform([
         bounds_x_min, x_res, 0,
@@ -906,6 +1291,92 @@ def create_new_image_from_polygon(polygon, out_path, x_res, y_res, bands,
     return out_raster
 
 
+def create_new_image_from_geotransform(geotransform, x_size, y_size, out_path, bands, projection, format="GTiff",
+                                       datatype=None, nodata=None, nbits=None, rasters=None):
+    """
+    Returns an empty image with the given geotransform and size in pixels.
+
+    Parameters
+    ----------
+    geotransform
+        The six-element geotransform of the new image
+    x_size
+        The width of the new image in pixels
+    y_size
+        The height of the new image in pixels
+    out_path
+        The path to save the new image to
+    bands
+        Number of bands in the new image.
+    projection
+        The projection, in wkt, of the output image.
+    format
+        The gdal raster format of the output image
+    datatype
+        The gdal datatype of the output image. If None, the narrowest datatype that holds every band of rasters; see
+        get_common_datatype. If rasters is not given either, Int32.
+    nodata
+        Optional. The nodata value of every band of the output image.
+    nbits
+        Optional. The number of bits per pixel, for bit-packed images such as masks.
+    rasters
+        Optional. A list of the gdal.Dataset objects that will be written into the new image, used to choose its
+        datatype.
+
+    Returns
+    -------
+    A gdal.Image object
+
+    """
+    datatype = _datatype_for_new_image(datatype, rasters)
+    driver = gdal.GetDriverByName(format)
+    out_raster = driver.Create(out_path, xsize=x_size, ysize=y_size, bands=bands, eType=datatype,
+                               options=get_creation_options(format, datatype, nbits))
+    out_raster.SetGeoTransform(list(geotransform))
+    out_raster.SetProjection(projection)
+    if nodata is not None:
+        for band_index in range(1, bands + 1):
+            out_raster.GetRasterBand(band_index).SetNoDataValue(nodata)
+    return out_raster
+
+
+def warp_to_project_grid(in_raster, out_raster_path, grid, tile=None, memory=2e3, num_threads="ALL_CPUS"):
+    """
+    Warps an image onto a project grid in a single pass, so that every product from the same project lines up
+    pixel-for-pixel.
+
+    Parameters
+    ----------
+    in_raster
+        Either a gdal.Image object or a path to a raster
+    out_raster_path
+        The path to the new output raster
+    grid
+        A pyeo.coordinate_manipulation.ProjectGrid object
+    tile
+        Optional. The tile of in_raster; if it is in the grid's tile_extents, the output covers exactly that tile.
+    memory
+        The amount of memory in MB to give to the warp.
+    num_threads
+        The number of threads to warp with; an integer or "ALL_CPUS".
+
+    Returns
+    -------
+    out_raster_path
+
+    """
+    if type(in_raster) is str:
+        in_raster = gdal.Open(in_raster)
+    x_min, x_max, y_min, y_max = grid.get_output_bounds(in_raster, tile)
+    log.info("Warping {} onto project grid at {}".format(in_raster.GetDescription(), (x_min, x_max, y_min, y_max)))
+    warp_options = gdal.WarpOptions(dstSRS=grid.projection, outputBounds=(x_min, y_min, x_max, y_max),
+                                    xRes=grid.resolution, yRes=grid.resolution, warpMemoryLimit=memory,
+                                    multithread=True, warpOptions=["NUM_THREADS={}".format(num_threads)],
+                                    creationOptions=get_matching_creation_options(in_raster))
+    gdal.Warp(out_raster_path, in_raster, options=warp_options)
+    return out_raster_path
+
+
 def resample_image_in_place(image_path, new_res):
     """
     Resamples an image in-place using gdalwarp to new_res in metres.
@@ -914,24 +1385,96 @@ def resample_image_in_place(image_path, new_res):
     Parameters
     ----------
     image_path
-        Path to the image to be resampled
+        Path to the image to be resampled. Can be in /vsimem/.
 
     new_res
         Pixel edge size in meters
 
     """
+    # Remember this is used for masks, so any averging resample strat will cock things up.
+    args = gdal.WarpOptions(
+        xRes=new_res,
+        yRes=new_res,
+        creationOptions=get_matching_creation_options(image_path)
+    )
+    if is_in_memory(image_path):
+        temp_image = image_path + ".resample.tif"
+        gdal.Warp(temp_image, image_path, options=args)
+        gdal.Unlink(image_path)
+        gdal.Rename(temp_image, image_path)
+        return
     # I don't like using a second object here, but hey.
     with TemporaryDirectory() as td:
-        # Remember this is used for masks, so any averging resample strat will cock things up.
-        args = gdal.WarpOptions(
-            xRes=new_res,
-            yRes=new_res
-        )
         temp_image = os.path.join(td, "temp_image.tif")
         error = gdal.Warp(temp_image, image_path, options=args)
         shutil.move(temp_image, image_path)
 
 
+def is_in_memory(image_path):
+    """Returns True if image_path is in GDAL's in-memory filesystem, /vsimem/."""
+    return image_path.startswith("/vsimem/")
+
+
+@contextmanager
+def scratch_directory(scratch_dir=None):
+    """
+    A context manager giving a temporary directory for intermediate images. The directory and everything in it is
+    removed on exit.
+
+    Parameters
+    ----------
+    scratch_dir
+        Where to make the directory. If None, uses the system temporary directory. If "/vsimem/", the directory is
+        in GDAL's in-memory filesystem; files in it can only be read and written by GDAL, so it can't hold the output
+        of external programs such as fmask. Any other path, such as the RAM-backed /dev/shm, is used as the parent of
+        a normal temporary directory.
+
+    Yields
+    ------
+    The path to the temporary directory
+
+    """
+    if scratch_dir and is_in_memory(scratch_dir.rstrip("/") + "/"):
+        temp_dir = "/vsimem/pyeo_{}".format(uuid.uuid4().hex)
+        try:
+            yield temp_dir
+        finally:
+            for file_name in gdal.ReadDirRecursive(temp_dir) or []:
+                gdal.Unlink(temp_dir + "/" + file_name)
+    else:
+        with TemporaryDirectory(dir=scratch_dir) as temp_dir:
+            yield temp_dir
+
+
+def move_image(image_path, out_path, format="GTiff"):
+    """
+    Moves an image to out_path. Images in /vsimem/ are written out with format, then removed from memory.
+
+    Parameters
+    ----------
+    image_path
+        The image to move
+    out_path
+        The new path of the image
+    format
+        The GDAL driver to write out in-memory images with
+
+    Returns
+    -------
+    out_path
+
+    """
+    if is_in_memory(image_path):
+        in_image = gdal.Open(image_path)
+        gdal.GetDriverByName(format).CreateCopy(out_path, in_image,
+                                                options=get_matching_creation_options(in_image, format))
+        in_image = None
+        gdal.Unlink(image_path)
+    else:
+        shutil.move(image_path, out_path)
+    return out_path
+
+
 def raster_to_array(rst_pth):
     """Reads in a raster file and returns a N-dimensional array.
 
@@ -961,8 +1504,8 @@ def calc_ndvi(raster_path, output_path):
     out_raster = create_matching_dataset(raster, output_path, datatype=gdal.GDT_Float32)
     array = raster.GetVirtualMemArray()
     out_array = out_raster.GetVirtualMemArray(eAccess=gdal.GA_Update)
-    R = array[2, ...]
-    I = array[3, ...]
+    R = array[2, ...].astype(np.float32)   # Unsigned bands would wrap round when subtracted
+    I = array[3, ...].astype(np.float32)
     out_array[...] = (R-I)/(R+I)
 
     out_array[...] = np.where(out_array == -2147483648, 0, out_array)
@@ -992,6 +1535,7 @@ def apply_band_function(in_path, function, bands, out_path, out_datatype = gdal.
 
 
 def ndvi_function(r, i):
+    r = r.astype(np.float32)
     return (r-i)/(r+i)
 
 
@@ -1034,7 +1578,7 @@ def raster_sum(inRstList, outFn, outFmt='GTiff'):
     # Create a 1 band GeoTiff with the same properties as the input raster
     driver = gdal.GetDriverByName(outFmt)
     out_ds = driver.Create(outFn, in_band.XSize, in_band.YSize, 1,
-                           in_band.DataType)
+                           in_band.DataType, options=get_creation_options(outFmt, in_band.DataType))
     out_ds.SetProjection(in_ds.GetProjection())
     out_ds.SetGeoTransform(in_ds.GetGeoTransform())
 
@@ -1089,8 +1633,8 @@ def filter_by_class_map(image_path, class_map_path, out_map_path, classes_of_int
         image_array = image_map.GetVirtualMemArray()
         out_map = create_matching_dataset(image_map, out_map_path)
         out_array = out_map.GetVirtualMemArray(eAccess=gdal.GA_Update)
-        class_bounds = get_raster_bounds(class_map)
-        image_bounds = get_raster_bounds(image_map)
+        class_bounds = get_raster_extent(class_map)
+        image_bounds = get_raster_extent(image_map)
         in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(image_map, class_bounds)
         image_view = image_array[in_y_min: in_y_max, in_x_min: in_x_max]
         class_x_min, class_x_max, class_y_min, class_y_max = pixel_bounds_from_polygon(class_map, image_bounds)
@@ -1109,50 +1653,209 @@ def filter_by_class_map(image_path, class_map_path, out_map_path, classes_of_int
 
 def open_dataset_from_safe(safe_file_path, band, resolution = "10m"):
     """Opens a dataset given a safe file. Give band as a string."""
-    image_glob = r"GRANULE/*/IMG_DATA/R{}/*_{}_{}.jp2".format(resolution, band, resolution)
-    # edited by hb91
-    #image_glob = r"GRANULE/*/IMG_DATA/*_{}.jp2".format(band)
-    fp_glob = os.path.join(safe_file_path, image_glob)
-    image_file_path = glob.glob(fp_glob)
-    out = gdal.Open(image_file_path[0])
-    return out
+    return gdal.Open(get_sen_2_band_path(safe_file_path, band, int(resolution.rstrip("m"))))
 
 
 def preprocess_sen2_images(l2_dir, out_dir, l1_dir, cloud_threshold=60, buffer_size=0, epsg=None,
-                           bands=("B02", "B03", "B04", "B08"), out_resolution=10):
+                           bands=("B02", "B03", "B04", "B08"), out_resolution=10, scratch_dir=None, grid=None,
+                           mask_strategy="scl+fmask"):
     """For every .SAFE folder in in_dir, stacks band 2,3,4 and 8  bands into a single geotif, creates a cloudmask from
-    the combined fmask and sen2cor cloudmasks and reprojects to a given EPSG if provided"""
+    the combined fmask and sen2cor cloudmasks and reprojects to a given EPSG if provided. Intermediate images are kept
+    in scratch_dir; set to "/vsimem/" to keep them in memory. See scratch_directory. If grid (a
+    pyeo.coordinate_manipulation.ProjectGrid) is given, images and masks are warped onto it instead, and epsg and
+    out_resolution are ignored. mask_strategy picks the sources of the cloudmask, such as "scl" to skip fmask; see
+    create_cloud_mask."""
     safe_file_path_list = [os.path.join(l2_dir, safe_file_path) for safe_file_path in os.listdir(l2_dir)]
     for l2_safe_file in safe_file_path_list:
-        with TemporaryDirectory() as temp_dir:
-            log.info("----------------------------------------------------")
-            log.info("Merging 10m bands in SAFE dir: {}".format(l2_safe_file))
-            temp_path = os.path.join(temp_dir, get_sen_2_granule_id(l2_safe_file)) + ".tif"
-            log.info("Output file: {}".format(temp_path))
-            stack_sentinel_2_bands(l2_safe_file, temp_path, bands=bands, out_resolution=out_resolution)
-
-            log.info("Creating cloudmask for {}".format(temp_path))
+        preprocess_sen2_image(l2_safe_file, out_dir, l1_dir, cloud_threshold, buffer_size, epsg, bands, out_resolution,
+                              scratch_dir, grid, mask_strategy)
+
+
+def preprocess_sen2_image(l2_safe_file, out_dir, l1_dir, cloud_threshold=60, buffer_size=0, epsg=None,
+                          bands=("B02", "B03", "B04", "B08"), out_resolution=10, scratch_dir=None, grid=None,
+                          mask_strategy="scl+fmask"):
+    """Stacks the bands of a single L2 .SAFE folder into a geotif in out_dir with a cloudmask; see
+    preprocess_sen2_images. The cloudmask is made in a separate thread while the bands are stacked.
+    Returns the path to the new image."""
+    with scratch_directory(scratch_dir) as temp_dir, ThreadPoolExecutor(max_workers=1) as executor:
+        log.info("----------------------------------------------------")
+        temp_path = os.path.join(temp_dir, get_sen_2_granule_id(l2_safe_file)) + ".tif"
+        mask_path = get_mask_path(temp_path)
+        log.info("Creating cloudmask for {}".format(temp_path))
+        l1_safe_file = None
+        if "fmask" in parse_mask_strategy(mask_strategy):
             l1_safe_file = get_l1_safe_file(l2_safe_file, l1_dir)
-            mask_path = get_mask_path(temp_path)
-            create_mask_from_sen2cor_and_fmask(l1_safe_file, l2_safe_file, mask_path, buffer_size=buffer_size)
-            log.info("Cloudmask created")
-
-            out_path = os.path.join(out_dir, os.path.basename(temp_path))
-            out_mask_path = os.path.join(out_dir, os.path.basename(mask_path))
-
-            if epsg:
-                log.info("Reprojecting images to {}".format(epsg))
-                proj = osr.SpatialReference()
-                proj.ImportFromEPSG(epsg)
-                wkt = proj.ExportToWkt()
-                reproject_image(temp_path, out_path, wkt)
-                reproject_image(mask_path, out_mask_path, wkt)
-                resample_image_in_place(out_mask_path, out_resolution)
-            else:
-                log.info("Moving images to {}".format(out_dir))
-                shutil.move(temp_path, out_path)
-                shutil.move(mask_path, out_mask_path)
-                resample_image_in_place(out_mask_path, out_resolution)
+        mask_future = executor.submit(create_cloud_mask, l2_safe_file, mask_path, mask_strategy,
+                                      l1_safe_file=l1_safe_file, cloud_threshold=cloud_threshold,
+                                      buffer_size=buffer_size, scratch_dir=scratch_dir)
+
+        log.info("Merging 10m bands in SAFE dir: {}".format(l2_safe_file))
+        log.info("Output file: {}".format(temp_path))
+        stack_sentinel_2_bands(l2_safe_file, temp_path, bands=bands, out_resolution=out_resolution)
+        mask_future.result()
+        log.info("Cloudmask created")
+
+        return _move_preprocessed_image(temp_path, mask_path, out_dir, l2_safe_file, epsg, out_resolution, grid)
+
+
+def _move_preprocessed_image(temp_path, mask_path, out_dir, safe_file, epsg, out_resolution, grid):
+    """Moves a merged image and its mask from scratch space into out_dir, warping them onto grid or reprojecting
+    them to epsg if given. Returns the new path of the image."""
+    out_path = os.path.join(out_dir, os.path.basename(temp_path))
+    out_mask_path = os.path.join(out_dir, os.path.basename(mask_path))
+
+    if grid:
+        tile = get_sen_2_image_tile(safe_file)
+        warp_to_project_grid(temp_path, out_path, grid, tile)
+        warp_to_project_grid(mask_path, out_mask_path, grid, tile)
+    elif epsg:
+        log.info("Reprojecting images to {}".format(epsg))
+        proj = osr.SpatialReference()
+        proj.ImportFromEPSG(epsg)
+        wkt = proj.ExportToWkt()
+        reproject_image(temp_path, out_path, wkt, resolution=out_resolution)
+        reproject_image(mask_path, out_mask_path, wkt, resolution=out_resolution)
+    else:
+        log.info("Moving images to {}".format(out_dir))
+        move_image(temp_path, out_path)
+        gdal.Warp(out_mask_path, mask_path, xRes=out_resolution, yRes=out_resolution,
+                  creationOptions=get_matching_creation_options(mask_path))
+    return out_path
+
+
+# Mask sources that only need the L1C image; see preprocess_sen2_l1_image
+L1_MASK_SOURCES = ("fmask", "heuristic")
+
+
+def preprocess_sen2_l1_images(l1_dir, out_dir, buffer_size=0, epsg=None, bands=("B02", "B03", "B04", "B08"),
+                              out_resolution=10, scratch_dir=None, grid=None, mask_strategy="heuristic"):
+    """A fast alternative to running sen2cor and then preprocess_sen2_images. For every L1C .SAFE folder in l1_dir,
+    stacks the bands with an approximate atmospheric correction (see dark_object_subtraction) and creates a cloudmask
+    from the L1C image alone. The outputs in out_dir are the same as from preprocess_sen2_images; see
+    preprocess_sen2_l1_image."""
+    safe_file_path_list = [os.path.join(l1_dir, safe_file_path) for safe_file_path in sorted(os.listdir(l1_dir))
+                           if safe_file_path.startswith("MSIL1C", 4)]
+    for l1_safe_file in safe_file_path_list:
+        preprocess_sen2_l1_image(l1_safe_file, out_dir, buffer_size, epsg, bands, out_resolution, scratch_dir, grid,
+                                 mask_strategy)
+
+
+def preprocess_sen2_l1_image(l1_safe_file, out_dir, buffer_size=0, epsg=None, bands=("B02", "B03", "B04", "B08"),
+                             out_resolution=10, scratch_dir=None, grid=None, mask_strategy="heuristic"):
+    """Stacks the bands of a single L1C .SAFE folder into a geotif in out_dir with a cloudmask, with dark object
+    subtraction in place of sen2cor. mask_strategy can only use L1_MASK_SOURCES; the cloudmask is made in a separate
+    thread while the bands are corrected. Otherwise the same as preprocess_sen2_image. Returns the path to the new
+    image."""
+    unsupported = [source for source in parse_mask_strategy(mask_strategy) if source not in L1_MASK_SOURCES]
+    if unsupported:
+        raise ValueError("Mask sources {} need sen2cor output; use one or more of {}".format(
+            unsupported, L1_MASK_SOURCES))
+    with scratch_directory(scratch_dir) as temp_dir, ThreadPoolExecutor(max_workers=1) as executor:
+        log.info("----------------------------------------------------")
+        temp_path = os.path.join(temp_dir, get_sen_2_granule_id(l1_safe_file)) + ".tif"
+        mask_path = get_mask_path(temp_path)
+        log.info("Creating cloudmask for {}".format(temp_path))
+        mask_future = executor.submit(create_cloud_mask, l1_safe_file, mask_path, mask_strategy,
+                                      l1_safe_file=l1_safe_file, buffer_size=buffer_size, scratch_dir=scratch_dir)
+        dark_object_subtraction(l1_safe_file, temp_path, bands=bands, out_resolution=out_resolution)
+        mask_future.result()
+        log.info("Cloudmask created")
+        return _move_preprocessed_image(temp_path, mask_path, out_dir, l1_safe_file, epsg, out_resolution, grid)
+
+
+def estimate_dark_object(dataset, dark_fraction=0.0001, nodata=0, sample_factor=8):
+    """
+    Estimates the value of the darkest objects in a band from its histogram, for dark object subtraction. This is the
+    lowest value that at least dark_fraction of the valid pixels are at or below, so that a few noisy pixels don't
+    count as the dark object.
+
+    Parameters
+    ----------
+    dataset
+        A single band gdal.Dataset of integer values
+    dark_fraction
+        The fraction of valid pixels that must be at or below the dark object value
+    nodata
+        The value of pixels outside the image, which are ignored
+    sample_factor
+        The histogram is built from the band read at 1/sample_factor of its resolution. For .jp2 bands, GDAL
+        decodes a reduced resolution level, so this is much faster than reading the full band.
+
+    Returns
+    -------
+    The dark object value, or 0 if the band has no valid pixels
+
+    """
+    sample = dataset.GetRasterBand(1).ReadAsArray(
+        buf_xsize=max(dataset.RasterXSize // sample_factor, 1),
+        buf_ysize=max(dataset.RasterYSize // sample_factor, 1))
+    valid = sample[sample != nodata].astype(np.int64)
+    if valid.size == 0:
+        return 0
+    cumulative = np.cumsum(np.bincount(valid - valid.min())) / valid.size
+    return int(valid.min() + np.searchsorted(cumulative, dark_fraction))
+
+
+def dark_object_subtraction(l1_safe_dir, out_image_path, bands=("B02", "B03", "B04", "B08"), out_resolution=10,
+                            dark_fraction=0.0001, dark_object_reflectance=0.01, block_rows=1024):
+    """
+    Stacks the bands of a Sentinel-2 L1C product into a single geotiff with an approximate atmospheric correction:
+    the haze in each band is estimated from its darkest pixels (see estimate_dark_object), which are assumed to have
+    a reflectance of dark_object_reflectance, and subtracted from the whole band. This takes seconds rather than the
+    tens of minutes of sen2cor, but does not correct for the varying haze across the image or for terrain, so is
+    only suitable for work where consistent relative reflectance between images is enough.
+
+    The output has the same datatype and scaling as the bands of an L2A product from the same processing baseline,
+    so can be used in place of the output of stack_sentinel_2_bands on the L2A product. Bands not at out_resolution
+    are resampled with nearest neighbour. Pixels outside the image stay 0.
+
+    Parameters
+    ----------
+    l1_safe_dir
+        The path to an L1C .SAFE directory
+    out_image_path
+        The path of the new image
+    bands
+        The bands to stack, in order
+    out_resolution
+        The resolution of the new image in metres
+    dark_fraction
+        See estimate_dark_object
+    dark_object_reflectance
+        The reflectance the darkest pixels are set to. 0.01 is the usual assumption.
+    block_rows
+        The number of rows to correct at a time
+
+    Returns
+    -------
+    out_image_path
+
+    """
+    log.info("Approximate atmospheric correction of {}".format(l1_safe_dir))
+    band_paths = [get_sen_2_band_path(l1_safe_dir, band) for band in bands]
+    datasets = [gdal.Open(band_path) for band_path in band_paths]
+    offset, quantification = get_sen_2_radiometric_scaling(l1_safe_dir)
+    dark_object_value = int(round(dark_object_reflectance * quantification)) - offset
+    shifts = []
+    for band, dataset in zip(bands, datasets):
+        haze = estimate_dark_object(dataset, dark_fraction)
+        log.info("Dark object value of {}: {}".format(band, haze))
+        shifts.append(dark_object_value - haze)
+
+    max_value = np.iinfo(gdal_array.GDALTypeCodeToNumericTypeCode(datasets[0].GetRasterBand(1).DataType)).max
+    datasets = None
+
+    def subtract_haze(shift):
+        def band_function(rows):
+            corrected = np.clip(rows.astype(np.int32) + shift, 1, max_value)
+            corrected[rows == 0] = 0
+            return corrected.astype(rows.dtype)
+        return band_function
+
+    ingest_bands(band_paths, out_image_path, out_resolution, band_names=bands,
+                 band_functions=[subtract_haze(shift) for shift in shifts], nodata=0, block_rows=block_rows)
+    log.info("Corrected image at {}".format(out_image_path))
+    return out_image_path
 
 
 def preprocess_landsat_images(image_dir, out_image_path, new_projection = None, bands_to_stack=("B2","B3","B4")):
@@ -1174,7 +1877,8 @@ def preprocess_landsat_images(image_dir, out_image_path, new_projection = None,
             xsize = first_ls_array.shape[1],
             ysize = first_ls_array.shape[0],
             bands = n_bands,
-            eType = first_ls_raster.GetRasterBand(1).DataType
+            eType = first_ls_raster.GetRasterBand(1).DataType,
+            options = get_creation_options(datatype=first_ls_raster.GetRasterBand(1).DataType)
             )
     out_image.SetGeoTransform(first_ls_raster.GetGeoTransform())
     out_image.SetProjection(first_ls_raster.GetProjection())
@@ -1195,78 +1899,115 @@ def preprocess_landsat_images(image_dir, out_image_path, new_projection = None,
             log.info("Reprojecting to {}")
             temp_path = os.path.join(td, "reproj_temp.tif")
             log.info("Temporary image path at {}".format(temp_path))
-            reproject_image(out_image_path, temp_path, new_projection, do_post_resample = False)
+            reproject_image(out_image_path, temp_path, new_projection, resolution=30)
             os.remove(out_image_path)
-            os.rename(temp_path, out_image_path)
-            resample_image_in_place(out_image_path, 30)
+            shutil.move(temp_path, out_image_path)
     log.info("Stacked image at {}".format(out_image_path))
 
 
 def stack_sentinel_2_bands(safe_dir, out_image_path, bands=("B02", "B03", "B04", "B08"), out_resolution=10):
-    """Stacks the specified bands of a .SAFE granule directory into a single geotiff"""
-
+    """Stacks the specified bands of a .SAFE granule directory into a single geotiff. Bands not at out_resolution are
+    resampled in memory; see ingest_bands."""
     band_paths = [get_sen_2_band_path(safe_dir, band, out_resolution) for band in bands]
+    return ingest_bands(band_paths, out_image_path, out_resolution, band_names=bands)
+
+
+def ingest_bands(band_paths, out_image_path, out_resolution=10, band_names=None, band_functions=None, nodata=None,
+                 block_rows=1024, num_threads=None):
+    """
+    Stacks single band images, such as the .jp2 bands of a Sentinel-2 product, into one tiled multi-band geotiff in a
+    single pass. The image is built a strip of block_rows rows at a time; the strip of every band is decoded in its
+    own thread, and the next strip is decoded while the last is written. For .jp2 bands, the remaining threads are
+    shared out between the bands for OpenJPEG's own multithreaded decoding.
+
+    Bands coarser than out_resolution are repeated to it (nearest neighbour); finer bands are subsampled. Every band
+    must have the same top left corner, as the bands of a Sentinel-2 granule do. The extent is taken from the first
+    band.
+
+    Parameters
+    ----------
+    band_paths
+        A list of paths to single band images
+    out_image_path
+        The path of the new image
+    out_resolution
+        The resolution of the new image, in the units of the bands' projection
+    band_names
+        Optional. Descriptions for each band of the new image.
+    band_functions
+        Optional. A list of one function or None per band. Each function takes a strip of its band at
+        out_resolution and returns the strip to write; for example, a correction.
+    nodata
+        Optional. The nodata value of every band of the new image.
+    block_rows
+        The number of rows in each strip. 1024 matches the internal tiling of Sentinel-2 .jp2 files.
+    num_threads
+        The total number of decoding threads. Defaults to the number of CPUs.
 
-    # Move every image NOT in the requested resolution to resample_dir and resample
-    with TemporaryDirectory() as resample_dir:
-        new_band_paths = []
-        for band_path in band_paths:
-            if get_image_resolution(band_path) != out_resolution:
-                log.info("Resampling {} to {}m".format(band_path, out_resolution))
-                resample_path = os.path.join(resample_dir, os.path.basename(band_path))
-                shutil.copy(band_path, resample_path)
-                resample_image_in_place(resample_path, out_resolution)  # why did I make this the only in-place function?
-                new_band_paths.append(resample_path)
-            else:
-                new_band_paths.append(band_path)
-
-        stack_images(new_band_paths, out_image_path, geometry_mode="intersect")
-
-    # Saving band labels in images
-    new_raster = gdal.Open(out_image_path)
-    for band_index, band_label in enumerate(bands):
-        band = new_raster.GetRasterBand(band_index+1)
-        band.SetDescription(band_label)
+    Returns
+    -------
+    out_image_path
 
+    """
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+    if band_functions is None:
+        band_functions = [None] * len(band_paths)
+    decoder_threads = str(max(num_threads // len(band_paths), 1))
+    template = get_raster_info(band_paths[0])
+    x_size = int(round(template.x_size * template.geotransform[1] / out_resolution))
+    y_size = int(round(template.y_size * template.geotransform[1] / out_resolution))
+    out_gt = (template.geotransform[0], out_resolution, 0, template.geotransform[3], 0, -out_resolution)
+    datatype = get_common_datatype([open_dataset(band_path) for band_path in band_paths])
+    out_image = create_new_image_from_geotransform(out_gt, x_size, y_size, out_image_path, len(band_paths),
+                                                   template.projection, datatype=datatype)
+    for band_index in range(len(band_paths)):
+        if band_names:
+            out_image.GetRasterBand(band_index + 1).SetDescription(band_names[band_index])
+        if nodata is not None:
+            out_image.GetRasterBand(band_index + 1).SetNoDataValue(nodata)
+
+    def read_strip(band_index, y_start, y_end):
+        # Runs in a worker thread; GDAL handles can't be shared between threads, so each thread opens its own
+        gdal.SetThreadLocalConfigOption("GDAL_NUM_THREADS", decoder_threads)
+        rows = _read_rows_at_resolution(open_dataset(band_paths[band_index]), out_resolution, y_start, y_end, x_size)
+        if band_functions[band_index]:
+            rows = band_functions[band_index](rows)
+        return rows
+
+    def submit_strip(executor, y_start):
+        y_end = min(y_start + block_rows, y_size)
+        return y_start, [executor.submit(read_strip, band_index, y_start, y_end)
+                         for band_index in range(len(band_paths))]
+
+    def write_strip(y_start, futures):
+        for band_index, future in enumerate(futures):
+            out_image.GetRasterBand(band_index + 1).WriteArray(future.result(), 0, y_start)
+
+    log.info("Stacking {} bands into {}".format(len(band_paths), out_image_path))
+    with ThreadPoolExecutor(max_workers=len(band_paths)) as executor:
+        pending = None
+        for y_start in range(0, y_size, block_rows):
+            submitted = submit_strip(executor, y_start)
+            if pending:
+                write_strip(*pending)
+            pending = submitted
+        if pending:
+            write_strip(*pending)
+    out_image = None
     return out_image_path
 
 
 def get_sen_2_band_path(l2_safe_dir, band, resolution=None):
-    """Returns the path to the raster of the specified band in the specified safe_dir. """
-    if resolution == 10:
-        res_string = "10m"
-    elif resolution == 20:
-        res_string = "20m"
-    elif resolution == 60:
-        res_string = "60m"
-    else:
-        res_string = None
-
-    if res_string in ["10m", "20m", "60m"]:  # If resolution is given, then find the band of that resolution
-        band_glob = "GRANULE/*/IMG_DATA/R{}/*_{}_*.*".format(res_string, band)
-        band_glob = os.path.join(l2_safe_dir, band_glob)
-        try:
-            band_path = glob.glob(band_glob)[0]
-        except IndexError:
-            log.warning("Band {} not found of specified resolution, searching in other available resolutions".format(band))
-
-    if res_string is None or 'band_path' not in locals():  # Else use the highest resolution available for that band
-        band_glob = "GRANULE/*/IMG_DATA/R*/*_{}_*.*".format(band)
-        band_glob = os.path.join(l2_safe_dir, band_glob)
-        band_paths = glob.glob(band_glob)
-        try:
-            band_path = sorted(band_paths)[0] # Sorting alphabetically gives the highest resolution first
-        except TypeError:
-            raise FileNotFoundError("Band {} not found for safe file {}". format(band, l2_safe_dir))
-    return band_path
+    """Returns the path to the raster of the specified band in the specified safe_dir, at resolution if given and
+    available, otherwise at the finest resolution available. Works for L1C and L2A products; see SafeIndex. Raises
+    FileNotFoundError if the band isn't present."""
+    return get_safe_index(l2_safe_dir).get_band_path(band, resolution)
 
 
 def get_image_resolution(image_path):
     """Returns the resolution of the image in its native projection. Assumes square pixels."""
-    image= gdal.Open(image_path)
-    if image is None:
-        raise FileNotFoundError("Image not found at {}".format(image_path))
-    gt = image.GetGeoTransform()
+    gt = get_raster_info(image_path).geotransform
     if gt[1] != gt[5]*-1:
         raise NonSquarePixelException("Image at {} has non-square pixels - this is currently not implemented in Pyeo")
     return gt[1]
@@ -1395,8 +2136,11 @@ def get_sen2cor_version(sen2cor_path):
         raise FileNotFoundError("Version information not found; please check your sen2cor path.")
 
 
-def atmospheric_correction(in_directory, out_directory, sen2cor_path, delete_unprocessed_image=False):
-    """Applies Sen2cor cloud correction to level 1C images"""
+def atmospheric_correction(in_directory, out_directory, sen2cor_path, delete_unprocessed_image=False,
+                           quarantine_dir=None):
+    """Applies Sen2cor cloud correction to level 1C images. If quarantine_dir is given, each image is first checked
+    against its manifest with validate_safe_file, and incomplete or corrupt images are moved to quarantine_dir instead
+    of being processed."""
     log = logging.getLogger(__name__)
     images = [image for image in os.listdir(in_directory)
               if image.startswith('MSIL1C', 4)]
@@ -1411,6 +2155,9 @@ def atmospheric_correction(in_directory, out_directory, sen2cor_path, delete_unp
         if glob.glob(out_glob):
             log.warning("{} exists. Skipping.".format(out_path))
             continue
+        if quarantine_dir and validate_safe_file(image_path):
+            quarantine_safe_file(image_path, quarantine_dir)
+            continue
         try:
             l2_path = apply_sen2cor(image_path, sen2cor_path, delete_unprocessed_image=delete_unprocessed_image)
         except (subprocess.CalledProcessError, BadS2Exception):
@@ -1434,7 +2181,7 @@ def create_mask_from_model(image_path, model_path, model_clear=0, num_chunks=10,
         temp_mask = gdal.Open(temp_mask_path, gdal.GA_Update)
         temp_mask_array = temp_mask.GetVirtualMemArray()
         mask_path = get_mask_path(image_path)
-        mask = create_matching_dataset(temp_mask, mask_path, datatype=gdal.GDT_Byte)
+        mask = create_matching_dataset(temp_mask, mask_path, datatype=gdal.GDT_Byte, nbits=MASK_NBITS)
         mask_array = mask.GetVirtualMemArray(eAccess=gdal.GF_Write)
         mask_array[:, :] = np.where(temp_mask_array != model_clear, 0, 1)
         temp_mask_array = None
@@ -1447,26 +2194,59 @@ def create_mask_from_model(image_path, model_path, model_clear=0, num_chunks=10,
         return mask_path
 
 
+# Scene classification (SCL) classes counted as clear: vegetation, bare soil and water
+SCL_CLEAR_CLASSES = (4, 5, 6)
+# fmask classes counted as cloudy: cloud, shadow and snow
+FMASK_CLOUD_CLASSES = (2, 3, 4)
+# The masks that can be combined in a mask strategy; see create_cloud_mask
+MASK_SOURCES = ("scl", "cld", "fmask", "heuristic")
+
+
+def class_lookup(class_array, classes, invert=False):
+    """
+    Returns a boolean array that is True where class_array holds one of classes. For 8 and 16 bit arrays this is a
+    single lookup into a table of every possible value, which is much faster than np.isin on large rasters.
+
+    Parameters
+    ----------
+    class_array
+        An integer array of class values, such as a SCL or fmask layer
+    classes
+        The classes to look for
+    invert
+        If True, returns True where class_array holds none of classes
+
+    Returns
+    -------
+    A boolean array the same shape as class_array
+
+    """
+    if class_array.dtype not in (np.uint8, np.uint16):
+        return np.isin(class_array, classes, invert=invert)
+    table = np.full(np.iinfo(class_array.dtype).max + 1, invert, dtype=np.bool_)
+    table[list(classes)] = not invert
+    return table[class_array]
+
+
 def create_mask_from_confidence_layer(l2_safe_path, out_path, cloud_conf_threshold=0, buffer_size=3):
     """Creates a multiplicative binary mask where cloudy pixels are 0 and non-cloudy pixels are 1. If
     cloud_conf_threshold = 0, use scl mask else use confidence image """
     log = logging.getLogger(__name__)
     log.info("Creating mask for {} with {} confidence threshold".format(l2_safe_path, cloud_conf_threshold))
     if cloud_conf_threshold:
-        cloud_glob = "GRANULE/*/QI_DATA/*CLD*_20m.jp2"  # This should match both old and new mask formats
-        cloud_path = glob.glob(os.path.join(l2_safe_path, cloud_glob))[0]
+        # This should match both old and new mask formats
+        cloud_path = get_safe_index(l2_safe_path).find_qi_files("*CLD*_20m.jp2")[0]
         cloud_image = gdal.Open(cloud_path)
         cloud_confidence_array = cloud_image.GetVirtualMemArray()
         mask_array = (cloud_confidence_array < cloud_conf_threshold)
         cloud_confidence_array = None
     else:
-        cloud_glob = "GRANULE/*/IMG_DATA/R20m/*SCL*_20m.jp2"  # This should match both old and new mask formats
-        cloud_path = glob.glob(os.path.join(l2_safe_path, cloud_glob))[0]
+        cloud_path = get_sen_2_band_path(l2_safe_path, "SCL", 20)
         cloud_image = gdal.Open(cloud_path)
         scl_array = cloud_image.GetVirtualMemArray()
-        mask_array = np.isin(scl_array, (4, 5, 6))
+        mask_array = class_lookup(scl_array, SCL_CLEAR_CLASSES)
 
-    mask_image = create_matching_dataset(cloud_image, out_path)
+    mask_image = create_matching_dataset(cloud_image, out_path, datatype=gdal.GDT_Byte, nbits=MASK_NBITS)
     mask_image_array = mask_image.GetVirtualMemArray(eAccess=gdal.GF_Write)
     np.copyto(mask_image_array, mask_array)
     mask_image_array = None
@@ -1485,7 +2265,7 @@ def create_mask_from_class_map(class_map_path, out_path, classes_of_interest, bu
     class_image = gdal.Open(class_map_path)
     class_array = class_image.GetVirtualMemArray()
     mask_array = np.isin(class_array, classes_of_interest)
-    out_mask = create_matching_dataset(class_image, out_path, datatype=gdal.GDT_Byte)
+    out_mask = create_matching_dataset(class_image, out_path, datatype=gdal.GDT_Byte, nbits=MASK_NBITS)
     out_array = out_mask.GetVirtualMemArray(eAccess=gdal.GA_Update)
     np.copyto(out_array, mask_array)
     class_array = None
@@ -1499,68 +2279,180 @@ def create_mask_from_class_map(class_map_path, out_path, classes_of_interest, bu
     return out_path
 
 
-def combine_masks(mask_paths, out_path, combination_func = 'and', geometry_func ="intersect"):
-    """ORs or ANDs several masks. Gets metadata from top mask. Assumes that masks are a
-    Python true or false. Also assumes that all masks are the same projection for now."""
-    # TODO Implement intersection and union
+_MASK_COMBINATIONS = ("and", "or", "nor")
+
+
+def _combine_mask_strip(mask_paths, windows, x_size, y_start, y_end, combination_func):
+    """Combines the rows y_start to y_end of the output of combine_masks. Runs in a worker thread, so opens its own
+    dataset handles."""
+    identity = combination_func == "and"
+    layers = []
+    covered = np.zeros((y_end - y_start, x_size), dtype=np.bool_)
+    for mask_path, ((in_x_min, in_x_max, in_y_min, in_y_max), (out_x_min, out_x_max, out_y_min, out_y_max)) \
+            in zip(mask_paths, windows):
+        top = max(y_start, out_y_min)
+        bottom = min(y_end, out_y_max)
+        if top >= bottom or out_x_min >= out_x_max:
+            continue
+        band = open_dataset(mask_path).GetRasterBand(1)
+        in_rows = band.ReadAsArray(in_x_min, in_y_min + top - out_y_min, in_x_max - in_x_min, bottom - top)
+        layer = np.full(covered.shape, identity, dtype=np.bool_)
+        layer[top - y_start: bottom - y_start, out_x_min: out_x_max] = in_rows
+        covered[top - y_start: bottom - y_start, out_x_min: out_x_max] = True
+        layers.append(layer)
+    if not layers:
+        return np.ones(covered.shape, dtype=np.uint8)
+    if combination_func == "and":
+        out = np.logical_and.reduce(layers)
+    else:
+        out = np.logical_or.reduce(layers)
+        if combination_func == "nor":
+            out = np.logical_not(out)
+    out[np.logical_not(covered)] = True   # Pixels that no mask covers are left unmasked
+    return out.astype(np.uint8)
+
+
+def combine_masks(mask_paths, out_path, combination_func = 'and', geometry_func ="intersect", num_threads=None,
+                  block_rows=256):
+    """
+    ORs, ANDs or NORs several masks in a single pass. Gets metadata from top mask. Assumes that masks are a
+    Python true or false. Also assumes that all masks are the same projection for now.
+
+    The output is built a strip of block_rows rows at a time; each strip reads the matching rows of every mask that
+    overlaps it and combines them with one logical reduction. Strips are combined in a pool of threads.
+
+    Parameters
+    ----------
+    mask_paths
+        A list of paths to masks
+    out_path
+        The path of the combined mask
+    combination_func
+        'and' (a pixel is unmasked only if it is unmasked in every mask), 'or' (unmasked in any mask) or 'nor'
+        (masked in every mask).
+    geometry_func
+        'intersect' for an output covering the area common to every mask, or 'union' for the area covered by any mask.
+        Pixels of the union covered by no mask are unmasked.
+    num_threads
+        The number of threads to combine strips with. Defaults to the number of CPUs.
+    block_rows
+        The number of rows in each strip.
+
+    Returns
+    -------
+    out_path
+
+    """
     log = logging.getLogger(__name__)
     log.info("Combining masks {}:\n   combination function: '{}'\n   geometry function:'{}'".format(
         mask_paths, combination_func, geometry_func))
-    masks = [gdal.Open(mask_path) for mask_path in mask_paths]
-    combined_polygon = align_bounds_to_whole_number(get_combined_polygon(masks, geometry_func))
+    if combination_func not in _MASK_COMBINATIONS:
+        raise Exception("Invalid combination_func; valid values are 'or', 'and', and 'nor'")
+    if geometry_func not in ("intersect", "union"):
+        raise Exception("Invalid geometry_func; can be 'intersect' or 'union'")
+    masks = [open_dataset(mask_path) for mask_path in mask_paths]
     gt = masks[0].GetGeoTransform()
     x_res = gt[1]
     y_res = gt[5]*-1  # Y res is -ve in geotransform
     bands = 1
     projection = masks[0].GetProjection()
-    out_mask = create_new_image_from_polygon(combined_polygon, out_path, x_res, y_res,
-                                             bands, projection, datatype=gdal.GDT_Byte, nodata=0)
-
-    # This bit here is similar to stack_raster, but different enough to not be worth spinning into a combination_func
-    # I might reconsider this later, but I think it'll overcomplicate things.
-    out_mask_array = out_mask.GetVirtualMemArray(eAccess=gdal.GF_Write)
-    out_mask_array[:, :] = 1
-    for i, in_mask in enumerate(masks):
-        in_mask_array = in_mask.GetVirtualMemArray()
-        if geometry_func == "intersect":
-            out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_mask, combined_polygon)
-            in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(in_mask, combined_polygon)
-        elif geometry_func == "union":
-            out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_mask, get_raster_bounds(in_mask))
-            in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(in_mask, get_raster_bounds(in_mask))
-        else:
-            raise Exception("Invalid geometry_func; can be 'intersect' or 'union'")
-        out_mask_view = out_mask_array[out_y_min: out_y_max, out_x_min: out_x_max]
-        in_mask_view = in_mask_array[in_y_min: in_y_max, in_x_min: in_x_max]
-        if i is 0:
-            out_mask_view[:,:] = in_mask_view
-        else:
-            if combination_func is 'or':
-                out_mask_view[:, :] = np.bitwise_or(out_mask_view, in_mask_view, dtype=np.uint8)
-            elif combination_func is 'and':
-                out_mask_view[:, :] = np.bitwise_and(out_mask_view, in_mask_view, dtype=np.uint8)
-            elif combination_func is 'nor':
-                out_mask_view[:, :] = np.bitwise_not(np.bitwise_or(out_mask_view, in_mask_view, dtype=np.uint8), dtype=np.uint8)
-            else:
-                raise Exception("Invalid combination_func; valid values are 'or', 'and', and 'nor'")
-        in_mask_view = None
-        out_mask_view = None
-        in_mask_array = None
-        in_mask = None
-    out_mask_array = None
+    grid_windows = get_grid_windows(masks, geometry_func)
+    if grid_windows:
+        out_gt, (x_size, y_size), windows = grid_windows
+        out_mask = create_new_image_from_geotransform(out_gt, x_size, y_size, out_path, bands, projection,
+                                                      datatype=gdal.GDT_Byte, nbits=MASK_NBITS)
+    else:
+        combined_polygon = align_bounds_to_whole_number(get_combined_polygon(masks, geometry_func))
+        out_mask = create_new_image_from_polygon(combined_polygon, out_path, x_res, y_res,
+                                                 bands, projection, datatype=gdal.GDT_Byte, nodata=0,
+                                                 nbits=MASK_NBITS)
+        # Work out where each mask goes once, rather than for every strip
+        windows = []
+        combined_bounds = combined_polygon.GetEnvelope()
+        for in_mask in masks:
+            bounds = combined_bounds if geometry_func == "intersect" else get_raster_extent(in_mask)
+            windows.append((pixel_bounds_from_polygon(in_mask, bounds), pixel_bounds_from_polygon(out_mask, bounds)))
+
+    x_size = out_mask.RasterXSize
+    y_size = out_mask.RasterYSize
+    out_band = out_mask.GetRasterBand(1)
+    strip_starts = range(0, y_size, block_rows)
+    with ThreadPoolExecutor(max_workers=num_threads if num_threads else os.cpu_count()) as executor:
+        strips = executor.map(
+            lambda y_start: _combine_mask_strip(mask_paths, windows, x_size, y_start,
+                                                min(y_start + block_rows, y_size), combination_func),
+            strip_starts)
+        # GDAL datasets can't be written from several threads, so strips are written here, in order
+        for y_start, strip in zip(strip_starts, strips):
+            out_band.WriteArray(strip, 0, y_start)
+    out_band = None
     out_mask = None
     return out_path
 
 
-def buffer_mask_in_place(mask_path, buffer_size):
-    """Expands a mask in-place, overwriting the previous mask"""
+def buffer_mask_array(mask_array, buffer_size):
+    """
+    Expands the masked (0) areas of a mask array by buffer_size pixels. Gives the same result as an erosion with a
+    disk of radius buffer_size, but uses a distance transform, so takes the same time for any buffer size.
+
+    Parameters
+    ----------
+    mask_array
+        A 2d array of 1 (unmasked) and 0 (masked)
+    buffer_size
+        The buffer radius in pixels
+
+    Returns
+    -------
+    A boolean array, True for unmasked pixels
+
+    """
+    mask_array = mask_array.astype(np.bool_)
+    if mask_array.all():
+        return mask_array   # Nothing to buffer; the distance transform is undefined with no masked pixels
+    return ndimage.distance_transform_edt(mask_array) > buffer_size
+
+
+def buffer_mask_in_place(mask_path, buffer_size, block_rows=1024):
+    """
+    Expands a mask in-place, overwriting the previous mask. The mask is processed in strips of block_rows rows, each
+    read with buffer_size rows of overlap above and below, so large masks are never loaded whole.
+
+    Parameters
+    ----------
+    mask_path
+        The path to the mask to buffer
+    buffer_size
+        The buffer radius in pixels
+    block_rows
+        The number of rows to buffer at a time
+
+    """
     log = logging.getLogger(__name__)
     log.info("Buffering {} with buffer size {}".format(mask_path, buffer_size))
+    if buffer_size <= 0:
+        return
+    halo = int(np.ceil(buffer_size))
     mask = gdal.Open(mask_path, gdal.GA_Update)
-    mask_array = mask.GetVirtualMemArray(eAccess=gdal.GA_Update)
-    cache = morph.binary_erosion(mask_array, selem=morph.disk(buffer_size))
-    np.copyto(mask_array, cache)
-    mask_array = None
+    band = mask.GetRasterBand(1)
+    x_size = mask.RasterXSize
+    y_size = mask.RasterYSize
+    rows_above = None   # The unbuffered rows above the current strip; they have already been overwritten on disk
+    for y_offset in range(0, y_size, block_rows):
+        rows = min(block_rows, y_size - y_offset)
+        rows_below = min(halo, y_size - y_offset - rows)
+        strip = band.ReadAsArray(0, y_offset, x_size, rows + rows_below)
+        if rows_above is None:
+            block = strip
+            top = 0
+        else:
+            block = np.concatenate((rows_above, strip))
+            top = rows_above.shape[0]
+        buffered = buffer_mask_array(block, buffer_size)
+        band.WriteArray(buffered[top: top + rows].astype(np.uint8), 0, y_offset)
+        # Taken from the whole block, so context from earlier strips is kept when block_rows is less than halo
+        rows_above = block[max(top + rows - halo, 0): top + rows]
+    band = None
     mask = None
 
 
@@ -1571,13 +2463,104 @@ def apply_array_image_mask(array, mask, fill_value=0):
     return np.where(stacked_mask == 1, array, fill_value)
 
 
-def create_mask_from_sen2cor_and_fmask(l1_safe_file, l2_safe_file, out_mask_path, buffer_size=0):
-    with TemporaryDirectory() as td:
-        s2c_mask_path = os.path.join(td, "s2_mask.tif")
-        fmask_mask_path = os.path.join(td, "fmask.tif")
-        create_mask_from_confidence_layer(l2_safe_file, s2c_mask_path, buffer_size=buffer_size)
-        create_mask_from_fmask(l1_safe_file, fmask_mask_path)
-        combine_masks([s2c_mask_path, fmask_mask_path], out_mask_path, combination_func="and", geometry_func="union")
+def create_mask_from_sen2cor_and_fmask(l1_safe_file, l2_safe_file, out_mask_path, buffer_size=0, scratch_dir=None):
+    """Creates a mask that is the union of the sen2cor and fmask masks. The intermediate masks are kept in a temporary
+    directory in scratch_dir; see scratch_directory."""
+    return create_cloud_mask(l2_safe_file, out_mask_path, "scl+fmask", l1_safe_file=l1_safe_file,
+                             buffer_size=buffer_size, scratch_dir=scratch_dir)
+
+
+def parse_mask_strategy(strategy):
+    """
+    Splits a mask strategy such as "scl+fmask" into its sources.
+
+    Parameters
+    ----------
+    strategy
+        One or more of MASK_SOURCES joined with "+"
+
+    Returns
+    -------
+    A tuple of sources
+
+    Raises
+    ------
+    ValueError
+        If the strategy is empty or contains an unknown source
+
+    """
+    sources = tuple(source.strip().lower() for source in strategy.split("+") if source.strip())
+    unknown = [source for source in sources if source not in MASK_SOURCES]
+    if not sources or unknown:
+        raise ValueError("Invalid mask strategy '{}'; combine one or more of {} with '+'".format(
+            strategy, MASK_SOURCES))
+    return sources
+
+
+def create_cloud_mask(l2_safe_file, out_mask_path, strategy="scl+fmask", l1_safe_file=None, cloud_threshold=60,
+                      buffer_size=0, scratch_dir=None):
+    """
+    Creates a multiplicative cloud mask for a Sentinel-2 image from one or more sources. Masks from several sources
+    are ANDed together, so a pixel is only clear if every source says it is clear.
+
+    Parameters
+    ----------
+    l2_safe_file
+        The path to the L2A .SAFE file. Only read by 'scl' and 'cld'; for strategies without them, this can be the
+        L1C .SAFE file.
+    out_mask_path
+        The path of the new mask
+    strategy
+        The sources to use, joined with '+'. Any of:
+        - 'scl': the clear classes (SCL_CLEAR_CLASSES) of the sen2cor scene classification. The fastest.
+        - 'cld': pixels with a sen2cor cloud probability below cloud_threshold
+        - 'fmask': fmask run on the L1C image. The slowest, as it reads the whole L1C product; when combined with
+          other sources, it runs in a separate thread alongside them.
+        - 'heuristic': a quick spectral cloud and shadow test (see create_mask_from_heuristic). Much faster than
+          fmask, but less accurate. Uses the L1C image if given, for its cirrus band, otherwise the L2A image.
+    l1_safe_file
+        The path to the L1C .SAFE file. Needed for fmask; optional for heuristic.
+    cloud_threshold
+        The cloud probability threshold for 'cld', from 1 to 100.
+    buffer_size
+        If more than 0, masked areas of the sen2cor and heuristic masks are expanded by this many pixels.
+    scratch_dir
+        Where to keep the masks of each source; see scratch_directory.
+
+    Returns
+    -------
+    out_mask_path
+
+    """
+    sources = parse_mask_strategy(strategy)
+    if "fmask" in sources and not l1_safe_file:
+        raise ValueError("Mask strategy '{}' needs the L1C image for fmask".format(strategy))
+    if "cld" in sources and not cloud_threshold:
+        raise ValueError("Mask strategy '{}' needs a cloud_threshold above 0".format(strategy))
+    log.info("Creating {} mask for {}".format("+".join(sources), l2_safe_file))
+    with scratch_directory(scratch_dir) as td, ThreadPoolExecutor(max_workers=1) as executor:
+        source_paths = [os.path.join(td, "{}_mask.tif".format(source)) for source in sources]
+        if len(sources) == 1:
+            source_paths = [out_mask_path]
+        fmask_future = None
+        for source, source_path in zip(sources, source_paths):
+            if source == "fmask":
+                # fmask is an external process, so it can run while the sen2cor masks are made
+                fmask_future = executor.submit(create_mask_from_fmask, l1_safe_file, source_path)
+            elif source == "scl":
+                create_mask_from_confidence_layer(l2_safe_file, source_path, cloud_conf_threshold=0,
+                                                  buffer_size=buffer_size)
+            elif source == "cld":
+                create_mask_from_confidence_layer(l2_safe_file, source_path, cloud_conf_threshold=cloud_threshold,
+                                                  buffer_size=buffer_size)
+            elif source == "heuristic":
+                create_mask_from_heuristic(l1_safe_file if l1_safe_file else l2_safe_file, source_path,
+                                           buffer_size=buffer_size)
+        if fmask_future:
+            fmask_future.result()
+        if len(sources) > 1:
+            combine_masks(source_paths, out_mask_path, combination_func="and", geometry_func="union")
+    return out_mask_path
 
 
 def create_mask_from_fmask(in_l1_dir, out_path):
@@ -1588,10 +2571,10 @@ def create_mask_from_fmask(in_l1_dir, out_path):
         apply_fmask(in_l1_dir, temp_fmask_path)
         fmask_image = gdal.Open(temp_fmask_path)
         fmask_array = fmask_image.GetVirtualMemArray()
-        out_image = create_matching_dataset(fmask_image, out_path, datatype=gdal.GDT_Byte)
+        out_image = create_matching_dataset(fmask_image, out_path, datatype=gdal.GDT_Byte, nbits=MASK_NBITS)
         out_array = out_image.GetVirtualMemArray(eAccess=gdal.GA_Update)
         log.info("fmask created, converting to binary cloud/shadow mask")
-        out_array[:,:] = np.isin(fmask_array, (2, 3, 4), invert=True)
+        out_array[:,:] = class_lookup(fmask_array, FMASK_CLOUD_CLASSES, invert=True)
         out_array = None
         out_image = None
         fmask_array = None
@@ -1599,6 +2582,187 @@ def create_mask_from_fmask(in_l1_dir, out_path):
         resample_image_in_place(out_path, 10)
 
 
+def _shift_array(array, rows, cols):
+    """Returns a copy of a 2d boolean array moved down by rows and right by cols, filled with False."""
+    out = np.zeros_like(array)
+    height, width = array.shape
+    if abs(rows) >= height or abs(cols) >= width:
+        return out
+    out[max(rows, 0): height + min(rows, 0), max(cols, 0): width + min(cols, 0)] = \
+        array[max(-rows, 0): height - max(rows, 0), max(-cols, 0): width - max(cols, 0)]
+    return out
+
+
+def project_cloud_shadows(cloud, sun_zenith, sun_azimuth, resolution, min_cloud_height=500, max_cloud_height=5000):
+    """
+    Returns the area that the shadows of clouds could fall on: the cloud mask moved away from the sun by the shadow
+    lengths of every cloud height from min_cloud_height to max_cloud_height.
+
+    Parameters
+    ----------
+    cloud
+        A 2d boolean array, True for cloud
+    sun_zenith, sun_azimuth
+        The angles of the sun in degrees; azimuth is clockwise from north
+    resolution
+        The pixel size of cloud in metres
+    min_cloud_height, max_cloud_height
+        The range of cloud heights to project, in metres
+
+    Returns
+    -------
+    A 2d boolean array, True where a shadow could be
+
+    """
+    shadow_length = np.tan(np.radians(sun_zenith)) / resolution   # Pixels of shadow per metre of height
+    row_step = np.cos(np.radians(sun_azimuth))    # Shadows point away from the sun; rows increase southwards
+    col_step = -np.sin(np.radians(sun_azimuth))
+    start = min_cloud_height * shadow_length
+    smear = (max_cloud_height - min_cloud_height) * shadow_length
+    shadow = _shift_array(cloud, int(round(start * row_step)), int(round(start * col_step)))
+    # Smear along the shadow direction by doubling, so the cost is log2 of the shadow length rather than linear
+    covered = 0
+    while covered < smear:
+        step = min(covered + 1, smear - covered)
+        shadow |= _shift_array(shadow, int(round(step * row_step)), int(round(step * col_step)))
+        covered += step
+    return shadow
+
+
+def detect_clouds_and_shadows(blue, green, red, nir, swir, cirrus=None, sun_angles=None, resolution=20,
+                              min_cloud_height=500, max_cloud_height=5000):
+    """
+    A quick spectral test for cloud and cloud shadow, after the potential cloud and shadow tests of fmask. All bands
+    are top of atmosphere or surface reflectance from 0 to 1, on the same grid.
+
+    Parameters
+    ----------
+    blue, green, red, nir, swir
+        Sentinel-2 bands 2, 3, 4, 8 and 11
+    cirrus
+        Optional. Band 10; only in L1C products.
+    sun_angles
+        Optional. A tuple of (zenith, azimuth) in degrees. If given, dark pixels where a cloud could cast a shadow
+        (see project_cloud_shadows) are marked as shadow; if None, no shadows are found.
+    resolution
+        The pixel size of the bands in metres
+    min_cloud_height, max_cloud_height
+        The range of cloud heights, in metres, to look for shadows from
+
+    Returns
+    -------
+    A tuple of boolean arrays (cloud, shadow)
+
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ndsi = (green - swir) / (green + swir)
+        ndvi = (nir - red) / (nir + red)
+        visible_mean = (blue + green + red) / 3
+        whiteness = (np.abs(blue - visible_mean) + np.abs(green - visible_mean) + np.abs(red - visible_mean)) \
+            / visible_mean
+        cloud = (swir > 0.03) & (ndsi < 0.8) & (ndvi < 0.8)     # Not snow or vegetation
+        cloud &= whiteness < 0.7                                # Flat visible spectrum
+        cloud &= (blue - 0.5 * red - 0.08) > 0                  # Haze optimised transform
+        cloud &= (nir / swir) > 0.75                            # Excludes bright rock and sand
+    if cirrus is not None:
+        cloud |= cirrus > 0.01
+    if sun_angles is None:
+        shadow = np.zeros(cloud.shape, dtype=np.bool_)
+    else:
+        shadow = project_cloud_shadows(cloud, sun_angles[0], sun_angles[1], resolution, min_cloud_height,
+                                       max_cloud_height)
+        shadow &= (nir < 0.16) & (swir < 0.12) & np.logical_not(cloud)
+    return cloud, shadow
+
+
+def _read_rows_at_resolution(dataset, resolution, y_start, y_end, x_size):
+    """Reads the rows y_start to y_end of a grid of x_size pixels of size resolution from a band at another
+    resolution. Coarser bands are repeated, finer bands are subsampled."""
+    band_resolution = dataset.GetGeoTransform()[1]
+    band = dataset.GetRasterBand(1)
+    if band_resolution >= resolution:
+        factor = int(round(band_resolution / resolution))
+        source_start = y_start // factor
+        source_end = min(-(-y_end // factor), dataset.RasterYSize)
+        rows = band.ReadAsArray(0, source_start, dataset.RasterXSize, source_end - source_start)
+        rows = np.repeat(np.repeat(rows, factor, axis=0), factor, axis=1)
+        return rows[y_start - source_start * factor: y_end - source_start * factor, :x_size]
+    factor = int(round(resolution / band_resolution))
+    return band.ReadAsArray(0, y_start * factor, x_size * factor, (y_end - y_start) * factor,
+                            buf_xsize=x_size, buf_ysize=y_end - y_start)
+
+
+def create_mask_from_heuristic(safe_dir, out_path, resolution=20, buffer_size=0, block_rows=512,
+                               min_cloud_height=500, max_cloud_height=5000):
+    """
+    Creates a multiplicative cloud and shadow mask from the bands of a Sentinel-2 product with a quick spectral
+    test (see detect_clouds_and_shadows), without calling fmask. Works on L1C or L2A products; L1C products also get
+    a cirrus test from band 10. Shadows are looked for where clouds would cast them, from the sun angles in the
+    granule metadata. The image is processed in strips of block_rows rows, with enough overlap to catch the shadows
+    of clouds in neighbouring strips.
+
+    Parameters
+    ----------
+    safe_dir
+        The path to a L1C or L2A .SAFE directory
+    out_path
+        The path of the new mask. The mask is resampled to 10m.
+    resolution
+        The resolution in metres to run the test at
+    buffer_size
+        If more than 0, masked areas are expanded by this many pixels.
+    block_rows
+        The number of rows to process at a time
+    min_cloud_height, max_cloud_height
+        The range of cloud heights, in metres, to look for shadows from
+
+    Returns
+    -------
+    out_path
+
+    """
+    log = logging.getLogger(__name__)
+    log.info("Creating heuristic cloud and shadow mask for {}".format(safe_dir))
+    band_names = ("B02", "B03", "B04", "B08", "B11", "B10")
+    safe_index = get_safe_index(safe_dir)
+    band_paths = {band: safe_index.get_band_path(band) for band in band_names[:5]}
+    if safe_index.get_band_resolutions("B10"):
+        band_paths["B10"] = safe_index.get_band_path("B10")
+    datasets = {band: gdal.Open(path) for band, path in band_paths.items()}
+    offset, quantification = get_sen_2_radiometric_scaling(safe_dir)
+    sun_angles = get_sen_2_sun_angles(safe_dir)
+
+    template = datasets["B11"]
+    template_gt = template.GetGeoTransform()
+    x_size = int(template.RasterXSize * template_gt[1] / resolution)
+    y_size = int(template.RasterYSize * template_gt[1] / resolution)
+    out_gt = (template_gt[0], resolution, 0, template_gt[3], 0, -resolution)
+    out_mask = create_new_image_from_geotransform(out_gt, x_size, y_size, out_path, 1, template.GetProjection(),
+                                                  datatype=gdal.GDT_Byte, nbits=MASK_NBITS)
+    out_band = out_mask.GetRasterBand(1)
+    halo = int(np.ceil(max_cloud_height * np.tan(np.radians(sun_angles[0])) / resolution)) + 1
+    for y_start in range(0, y_size, block_rows):
+        y_end = min(y_start + block_rows, y_size)
+        read_start = max(y_start - halo, 0)
+        read_end = min(y_end + halo, y_size)
+        reflectance = {band: (_read_rows_at_resolution(dataset, resolution, read_start, read_end, x_size)
+                              .astype(np.float32) + offset) / quantification
+                       for band, dataset in datasets.items()}
+        cloud, shadow = detect_clouds_and_shadows(reflectance["B02"], reflectance["B03"], reflectance["B04"],
+                                                  reflectance["B08"], reflectance["B11"], reflectance.get("B10"),
+                                                  sun_angles, resolution, min_cloud_height, max_cloud_height)
+        clear = np.logical_not(cloud | shadow)[y_start - read_start: y_end - read_start]
+        out_band.WriteArray(clear.astype(np.uint8), 0, y_start)
+    out_band = None
+    out_mask = None
+    datasets = None
+    resample_image_in_place(out_path, 10)
+    if buffer_size:
+        buffer_mask_in_place(out_path, buffer_size)
+    log.info("Heuristic mask created at {}".format(out_path))
+    return out_path
+
+
 def apply_fmask(in_safe_dir, out_file, fmask_command="fmask_sentinel2Stacked.py"):
     """Calls fmask to create a new mask for L1 data"""
     # For reasons known only to the spirits, calling subprocess.run from within this function on a HPC cause the PATH
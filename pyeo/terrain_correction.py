@@ -232,8 +232,8 @@ def calculate_reflectance(raster_path, dem_path, out_raster_path, raster_datetim
         print("Preprocessing DEM")
         clipped_dem_path = p.join(td, "clipped_dem.tif")
         reproj_dem_path = p.join(td, "reproj_dem.tif")
-        ras.reproject_image(dem_path, reproj_dem_path, in_raster.GetProjection(), do_post_resample=False)
-        ras.resample_image_in_place(reproj_dem_path, in_raster.GetGeoTransform()[1])  # Assuming square pixels
+        ras.reproject_image(dem_path, reproj_dem_path, in_raster.GetProjection(),
+                            resolution=in_raster.GetGeoTransform()[1])  # Assuming square pixels
         ras.clip_raster_to_intersection(reproj_dem_path, raster_path, clipped_dem_path, is_landsat)
 
         ic_array, zenith_array, slope_array = calculate_illumination_condition_array(clipped_dem_path, raster_datetime)
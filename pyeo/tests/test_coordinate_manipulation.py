@@ -0,0 +1,78 @@
+import numpy as np
+
+import pyeo.coordinate_manipulation
+
+
+class _GridRaster(object):
+    """Just enough of a gdal.Image for the pure-arithmetic window functions"""
+    def __init__(self, gt, x_size, y_size, projection="PROJ"):
+        self.gt = gt
+        self.RasterXSize = x_size
+        self.RasterYSize = y_size
+        self.projection = projection
+
+    def GetGeoTransform(self):
+        return self.gt
+
+    def GetProjection(self):
+        return self.projection
+
+
+def test_grid_windows_intersect_and_union():
+    rasters = [_GridRaster((1000, 10, 0, 5000, 0, -10), 10, 10),
+               _GridRaster((1050, 10, 0, 4970, 0, -10), 10, 10)]
+    out_gt, size, windows = pyeo.coordinate_manipulation.get_grid_windows(rasters, "intersect")
+    assert out_gt == (1050, 10, 0, 4970, 0, -10)
+    assert size == (5, 7)
+    assert windows[0] == ((5, 10, 3, 10), (0, 5, 0, 7))
+    assert windows[1] == ((0, 5, 0, 7), (0, 5, 0, 7))
+    out_gt, size, windows = pyeo.coordinate_manipulation.get_grid_windows(rasters, "union")
+    assert out_gt == (1000, 10, 0, 5000, 0, -10)
+    assert size == (15, 13)
+    assert windows[1] == ((0, 10, 0, 10), (5, 15, 3, 13))
+
+
+def test_grid_windows_rejects_misaligned_rasters():
+    base = _GridRaster((1000, 10, 0, 5000, 0, -10), 10, 10)
+    assert pyeo.coordinate_manipulation.get_grid_windows([base, _GridRaster((1005, 10, 0, 5000, 0, -10), 10, 10)]) \
+        is None
+    assert pyeo.coordinate_manipulation.get_grid_windows([base, _GridRaster((1000, 20, 0, 5000, 0, -20), 5, 5)]) \
+        is None
+    assert pyeo.coordinate_manipulation.get_grid_windows([base, _GridRaster((2000, 10, 0, 5000, 0, -10), 10, 10)]) \
+        is None
+
+
+def test_project_grid_snaps_outwards():
+    grid = pyeo.coordinate_manipulation.ProjectGrid("PROJ", 10, origin_x=5, origin_y=0,
+                                                    tile_extents={"T36MZE": (0, 100, 0, 100)})
+    assert grid.snap_bounds(12, 38, 1, 99) == (5, 45, 0, 100)
+    assert grid.get_output_bounds(None, "T36MZE") == (0, 100, 0, 100)
+
+
+def test_bounds_arithmetic():
+    assert pyeo.coordinate_manipulation.bounds_intersection((0, 10, 0, 10), (5, 20, -5, 5)) == (5, 10, 0, 5)
+    assert pyeo.coordinate_manipulation.bounds_intersection((0, 10, 0, 10), (10, 20, 0, 10)) is None
+    assert pyeo.coordinate_manipulation.bounds_union((0, 10, 0, 10), (5, 20, -5, 5)) == (0, 20, -5, 10)
+
+
+def test_pixel_window_matches_point_conversion():
+    raster = _GridRaster((1000, 10, 0, 5000, 0, -10), 100, 100)
+    bounds = (1215, 1480, 4400, 4730)
+    x_min, y_max = pyeo.coordinate_manipulation.point_to_pixel_coordinates(raster, (bounds[0], bounds[2]))
+    x_max, y_min = pyeo.coordinate_manipulation.point_to_pixel_coordinates(raster, (bounds[1], bounds[3]))
+    assert pyeo.coordinate_manipulation.bounds_to_pixel_window(raster.GetGeoTransform(), bounds) == \
+        (x_min, x_max, y_min, y_max)
+    assert pyeo.coordinate_manipulation.pixel_bounds_from_polygon(raster, (0, 1480, 4400, 9999)) == (0, 48, 0, 60)
+
+
+def test_array_point_conversion_matches_single_points():
+    gt = (1000, 10, 0, 5000, 0, -10)
+    pixels = np.random.RandomState(0).randint(0, 10000, (100000, 2))
+    points = pyeo.coordinate_manipulation.pixels_to_points(pixels, gt)
+    assert tuple(points[5]) == pyeo.coordinate_manipulation.pixel_to_point_coordinates(pixels[5], gt)
+    centres = pyeo.coordinate_manipulation.pixels_to_points(pixels, gt, pixel_centre=True)
+    assert np.allclose(centres - points, (5, -5))
+    round_trip = pyeo.coordinate_manipulation.points_to_pixels(gt, centres)
+    assert np.array_equal(round_trip, pixels[:, ::-1])
+    raster = _GridRaster(gt, 10000, 10000)
+    assert tuple(round_trip[7]) == pyeo.coordinate_manipulation.point_to_pixel_coordinates(raster, tuple(centres[7]))
@@ -0,0 +1,41 @@
+import os
+import threading
+
+import gdal
+
+from pyeo.dataset_cache import open_dataset, get_raster_info, close_all_datasets
+
+
+def _make_raster(path, x_size=20):
+    raster = gdal.GetDriverByName("GTiff").Create(path, xsize=x_size, ysize=10, bands=2, eType=gdal.GDT_Int16)
+    raster.SetGeoTransform([1000, 10, 0, 5000, 0, -10])
+    raster = None
+
+
+def test_pool_reuses_handles_until_file_changes(tmp_path):
+    close_all_datasets()
+    path = os.path.join(str(tmp_path), "image.tif")
+    _make_raster(path)
+    first = open_dataset(path)
+    assert open_dataset(path) is first
+    other_thread_handle = []
+    thread = threading.Thread(target=lambda: other_thread_handle.append(open_dataset(path)))
+    thread.start()
+    thread.join()
+    assert other_thread_handle[0] is not first
+    _make_raster(path, x_size=30)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert open_dataset(path) is not first
+    assert open_dataset(path).RasterXSize == 30
+
+
+def test_raster_info(tmp_path):
+    close_all_datasets()
+    path = os.path.join(str(tmp_path), "image.tif")
+    _make_raster(path)
+    info = get_raster_info(path)
+    assert (info.x_size, info.y_size, info.band_count) == (20, 10, 2)
+    assert info.datatype == gdal.GDT_Int16
+    assert info.bounds == (1000, 1200, 4900, 5000)
+    assert get_raster_info(path) is info
@@ -1,5 +1,8 @@
+import hashlib
 import os
 
+import pytest
+
 import pyeo.filesystem_utilities
 
 
@@ -17,3 +20,146 @@ def test_l2_validation():
     test_wrong = "test_data/S2A_MSIL2A_20170922T025541_N0205_R032_T48MXU_20170922T031550.SAFE"
     assert pyeo.filesystem_utilities.check_for_invalid_l2_data(test_wrong) == 0
 
+
+
+def _make_test_index_dir(root):
+    names = [
+        "S2A_MSIL2A_20180103T172709_N0206_R012_T13QFB_20180103T192359.tif",
+        "S2A_MSIL2A_20180329T171921_N0206_R012_T13QFB_20180329T221746.tif",
+        "S2B_MSIL2A_20180319T172021_N0206_R012_T14QKG_20180319T211405.tif",
+        "S2B_MSIL2A_20180319T172021_N0206_R012_T14QKG_20180319T211405.msk",
+        "not_an_image.txt"
+    ]
+    for name in names:
+        open(os.path.join(root, name), "w").close()
+    os.mkdir(os.path.join(root, "S2A_MSIL1C_20180329T171921_N0206_R012_T13QFB_20180329T221746.SAFE"))
+    return str(root)
+
+
+def test_parse_sen_2_image_name():
+    record = pyeo.filesystem_utilities.parse_sen_2_image_name(
+        "test_data/S2A_MSIL2A_20180329T171921_N0206_R012_T13QFB_20180329T221746.SAFE")
+    assert record.tile == "T13QFB"
+    assert record.sensing_time.strftime("%Y%m%dT%H%M%S") == "20180329T171921"
+    assert record.orbit == "R012"
+    assert record.baseline == "N0206"
+    assert record.level == "L2A"
+    composite = pyeo.filesystem_utilities.parse_sen_2_image_name("composite_20180329T171921.tif")
+    assert composite.tile is None
+    assert pyeo.filesystem_utilities.parse_sen_2_image_name("not_an_image.txt") is None
+
+
+def test_image_index_preceding_and_following(tmp_path):
+    test_dir = _make_test_index_dir(tmp_path)
+    index = pyeo.filesystem_utilities.get_image_index(test_dir)
+    assert len(index.records(extension=".tif")) == 3
+    target = pyeo.filesystem_utilities.get_image_acquisition_time("20180329T171921")
+    preceding = index.get_preceding(target, extension=".tif")
+    assert "T14QKG" in preceding.path
+    preceding = index.get_preceding(target, tile="T13QFB", extension=".tif")
+    assert "20180103T172709" in preceding.path
+    following = index.get_following(preceding.sensing_time, tile="T13QFB")
+    assert "20180329T171921" in following.path
+    with pytest.raises(FileNotFoundError):
+        pyeo.filesystem_utilities.get_preceding_image_path(
+            "S2B_MSIL2A_20180103T172709_N0206_R012_T13QFB_20180103T192359.tif", test_dir, tile="T13QFB")
+
+
+def test_image_index_invalidation(tmp_path):
+    test_dir = _make_test_index_dir(tmp_path)
+    index = pyeo.filesystem_utilities.get_image_index(test_dir)
+    assert len(index.records(tile="T13QFB")) == 3
+    open(os.path.join(test_dir, "S2A_MSIL2A_20180403T171921_N0206_R012_T13QFB_20180403T221746.tif"), "w").close()
+    assert len(index.records(tile="T13QFB")) == 4
+    l1_path = pyeo.filesystem_utilities.get_l1_safe_file(
+        "S2A_MSIL2A_20180329T171921_N0206_R012_T13QFB_20180329T221746.tif", test_dir)
+    assert l1_path == os.path.join(test_dir, "S2A_MSIL1C_20180329T171921_N0206_R012_T13QFB_20180329T221746.SAFE")
+
+
+def test_sen_2_metadata_angles_and_scaling(tmp_path):
+    granule_dir = tmp_path / "GRANULE" / "L1C_T13QFB_A014476_20180329T173102"
+    granule_dir.mkdir(parents=True)
+    (granule_dir / "MTD_TL.xml").write_text(
+        '<n1:Level-1C_Tile_ID xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/S2_PDI_Level-1C_Tile_Metadata.xsd">'
+        '<n1:Geometric_Info><Tile_Angles><Mean_Sun_Angle><ZENITH_ANGLE unit="deg">32.5</ZENITH_ANGLE>'
+        '<AZIMUTH_ANGLE unit="deg">141.2</AZIMUTH_ANGLE></Mean_Sun_Angle></Tile_Angles></n1:Geometric_Info>'
+        '</n1:Level-1C_Tile_ID>')
+    (tmp_path / "MTD_MSIL1C.xml").write_text(
+        '<n1:Level-1C_User_Product xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/User_Product_Level-1C.xsd">'
+        '<n1:General_Info><Product_Image_Characteristics><QUANTIFICATION_VALUE unit="none">10000'
+        '</QUANTIFICATION_VALUE><Radiometric_Offset_List><RADIO_ADD_OFFSET band_id="0">-1000</RADIO_ADD_OFFSET>'
+        '</Radiometric_Offset_List></Product_Image_Characteristics></n1:General_Info></n1:Level-1C_User_Product>')
+    assert pyeo.filesystem_utilities.get_sen_2_sun_angles(str(tmp_path)) == (32.5, 141.2)
+    assert pyeo.filesystem_utilities.get_sen_2_radiometric_scaling(str(tmp_path)) == (-1000, 10000)
+
+
+def test_safe_index(tmp_path):
+    safe_dir = tmp_path / "S2A_MSIL2A_20180329T171921_N0206_R012_T13QFB_20180329T221746.SAFE"
+    granule_dir = safe_dir / "GRANULE" / "L2A_T13QFB_A014476_20180329T173102"
+    for sub_dir in ("IMG_DATA/R10m", "IMG_DATA/R20m", "QI_DATA"):
+        (granule_dir / sub_dir).mkdir(parents=True)
+    for name in ("IMG_DATA/R10m/T13QFB_20180329T171921_B02_10m.jp2",
+                 "IMG_DATA/R20m/T13QFB_20180329T171921_B02_20m.jp2",
+                 "IMG_DATA/R20m/T13QFB_20180329T171921_B11_20m.jp2",
+                 "IMG_DATA/R20m/T13QFB_20180329T171921_SCL_20m.jp2",
+                 "QI_DATA/MSK_CLDPRB_20m.jp2",
+                 "MTD_TL.xml"):
+        (granule_dir / name).write_text("")
+    (safe_dir / "MTD_MSIL2A.xml").write_text("")
+    (safe_dir / "manifest.safe").write_text("")
+    index = pyeo.filesystem_utilities.get_safe_index(str(safe_dir))
+    assert index is pyeo.filesystem_utilities.get_safe_index(str(safe_dir))
+    assert index.get_band_resolutions("B02") == [10, 20]
+    assert index.get_band_path("B02").endswith("B02_10m.jp2")
+    assert index.get_band_path("B02", 20).endswith("B02_20m.jp2")
+    assert index.get_band_path("B11", 10).endswith("B11_20m.jp2")
+    assert index.get_band_path("SCL", 20).endswith("SCL_20m.jp2")
+    with pytest.raises(FileNotFoundError):
+        index.get_band_path("B08")
+    assert [os.path.basename(path) for path in index.find_qi_files("*CLD*_20m.jp2")] == ["MSK_CLDPRB_20m.jp2"]
+    assert sorted(os.path.basename(path) for path in index.find_metadata_files("MTD_*.xml")) == ["MTD_MSIL2A.xml",
+                                                                                                "MTD_TL.xml"]
+    # Bands extracted into the product are only seen once its index is invalidated
+    (granule_dir / "IMG_DATA/R10m/T13QFB_20180329T171921_B08_10m.jp2").write_text("")
+    assert pyeo.filesystem_utilities.get_safe_index(str(safe_dir)) is index
+    pyeo.filesystem_utilities.invalidate_safe_index(str(safe_dir))
+    assert pyeo.filesystem_utilities.get_safe_index(str(safe_dir)).get_band_path("B08").endswith("B08_10m.jp2")
+    # Writing a sidecar file into the product doesn't drop its index
+    index = pyeo.filesystem_utilities.get_safe_index(str(safe_dir))
+    (safe_dir / pyeo.filesystem_utilities.SAFE_VALIDATION_RECORD).write_text("{}")
+    assert pyeo.filesystem_utilities.get_safe_index(str(safe_dir)) is index
+
+
+def _make_test_safe(safe_dir, members):
+    os.makedirs(os.path.join(safe_dir, "GRANULE"))
+    objects = ""
+    for name, content in members.items():
+        with open(os.path.join(safe_dir, name), "wb") as fp:
+            fp.write(content)
+        objects += ('<dataObject ID="{0}"><byteStream mimeType="application/octet-stream" size="{1}">'
+                    '<fileLocation locatorType="URL" href="./{0}"/><checksum checksumName="MD5">{2}</checksum>'
+                    '</byteStream></dataObject>').format(name, len(content), hashlib.md5(content).hexdigest())
+    with open(os.path.join(safe_dir, "manifest.safe"), "w") as fp:
+        fp.write('<xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1"><dataObjectSection>{}</dataObjectSection>'
+                 '</xfdu:XFDU>'.format(objects))
+
+
+def test_validate_safe_dir(tmp_path):
+    l1_dir = os.path.join(str(tmp_path), "L1")
+    quarantine_dir = os.path.join(str(tmp_path), "quarantine")
+    good = os.path.join(l1_dir, "S2A_MSIL1C_20180329T171921_N0206_R012_T13QFB_20180329T221746.SAFE")
+    bad = os.path.join(l1_dir, "S2B_MSIL1C_20180103T172709_N0206_R012_T13QFB_20180103T192359.SAFE")
+    members = {"GRANULE/B02.jp2": b"band two" * 1000, "MTD_MSIL1C.xml": b"<metadata/>"}
+    _make_test_safe(good, members)
+    _make_test_safe(bad, members)
+    with open(os.path.join(bad, "GRANULE/B02.jp2"), "r+b") as fp:
+        fp.write(b"BAND")   # Same size, wrong checksum
+    assert pyeo.filesystem_utilities.read_safe_manifest(good)[0].checksum_name == "MD5"
+    assert pyeo.filesystem_utilities.validate_safe_file(bad, check_checksums=False) == []
+    valid = pyeo.filesystem_utilities.validate_safe_dir(l1_dir, quarantine_dir, num_threads=2)
+    assert valid == [good]
+    assert os.listdir(quarantine_dir) == [os.path.basename(bad)]
+    assert os.path.exists(os.path.join(good, pyeo.filesystem_utilities.SAFE_VALIDATION_RECORD))
+    os.remove(os.path.join(good, "MTD_MSIL1C.xml"))
+    assert pyeo.filesystem_utilities.validate_safe_file(good) == []   # The recorded result is used
+    assert pyeo.filesystem_utilities.validate_safe_file(good, force=True) == ["MTD_MSIL1C.xml is missing"]
@@ -0,0 +1,108 @@
+import datetime as dt
+import os
+import threading
+import time
+
+import pytest
+
+from pyeo.exceptions import PipelineException
+from pyeo.pipeline import Stage, PipelineRunner, WorkUnit, work_unit_from_path, group_by_tile, run_tile_shards
+
+
+def _make_units():
+    return [WorkUnit("T13QFB", dt.datetime(2018, 1, day), "image_{}".format(day)) for day in (3, 1, 2)]
+
+
+def test_work_unit_from_path():
+    unit = work_unit_from_path("test_data/S2A_MSIL2A_20180329T171921_N0206_R012_T13QFB_20180329T221746.SAFE")
+    assert unit.tile == "T13QFB"
+    assert unit.date == dt.datetime(2018, 3, 29, 17, 19, 21)
+    assert unit.name == "S2A_MSIL2A_20180329T171921_N0206_R012_T13QFB_20180329T221746"
+
+
+def test_pipeline_order_and_overlap():
+    events = []
+    lock = threading.Lock()
+
+    def record(stage_name, delay=0):
+        def function(unit, results):
+            time.sleep(delay)
+            with lock:
+                events.append((stage_name, unit.name))
+            return "{}_{}".format(stage_name, unit.name)
+        return function
+
+    stages = [
+        Stage("preprocess", record("preprocess", 0.05), workers=3),
+        Stage("update", record("update"), requires=("preprocess",), requires_previous=("update",))
+    ]
+    results = PipelineRunner(stages).run(_make_units())
+    assert results["image_2"]["update"] == "update_image_2"
+    updates = [name for stage, name in events if stage == "update"]
+    assert updates == ["image_1", "image_2", "image_3"]
+
+
+def test_pipeline_resumes_from_checkpoint(tmp_path):
+    checkpoint = os.path.join(str(tmp_path), "checkpoint.json")
+    calls = []
+    fail = [True]
+
+    def flaky(unit, results):
+        calls.append(unit.name)
+        if unit.name == "image_2" and fail[0]:
+            raise ValueError("Simulated failure")
+        return unit.name
+
+    stages = [Stage("step", flaky, requires_previous=("step",))]
+    with pytest.raises(PipelineException):
+        PipelineRunner(stages, checkpoint).run(_make_units())
+    assert calls == ["image_1", "image_2"]
+    fail[0] = False
+    results = PipelineRunner(stages, checkpoint).run(_make_units())
+    assert calls == ["image_1", "image_2", "image_2", "image_3"]
+    assert results["image_3"]["step"] == "image_3"
+
+
+def test_pipeline_keeps_checkpoint_of_other_units(tmp_path):
+    checkpoint = os.path.join(str(tmp_path), "checkpoint.json")
+    stages = [Stage("step", lambda unit, results: unit.name)]
+    units = _make_units()
+    PipelineRunner(stages, checkpoint).run(units[:1])
+    PipelineRunner(stages, checkpoint).run(units[1:])
+    assert sorted(PipelineRunner(stages, checkpoint).load_checkpoint()) == ["step:image_1", "step:image_2",
+                                                                           "step:image_3"]
+
+
+def test_pipeline_rejects_unknown_stage():
+    with pytest.raises(PipelineException):
+        PipelineRunner([Stage("classify", lambda unit, results: None, requires=("stack",))])
+    with pytest.raises(PipelineException):
+        PipelineRunner([Stage("s2:stack", lambda unit, results: None)])
+
+
+def _describe_shard(tile, image_paths, suffix):
+    import tempfile
+    return [os.path.basename(path) + suffix for path in image_paths], tempfile.gettempdir(), os.getpid()
+
+
+def test_group_by_tile():
+    shards = group_by_tile([
+        "S2A_MSIL2A_20180329T171921_N0206_R012_T13QFB_20180329T221746.tif",
+        "S2B_MSIL2A_20180319T172021_N0206_R012_T14QKG_20180319T211405.tif",
+        "S2B_MSIL2A_20180103T172709_N0206_R012_T13QFB_20180103T192359.tif"
+    ])
+    assert list(shards.keys()) == ["T13QFB", "T14QKG"]
+    assert shards["T13QFB"][0] == "S2B_MSIL2A_20180103T172709_N0206_R012_T13QFB_20180103T192359.tif"
+
+
+def test_run_tile_shards(tmp_path):
+    image_paths = [
+        "S2A_MSIL2A_20180329T171921_N0206_R012_T13QFB_20180329T221746.tif",
+        "S2B_MSIL2A_20180319T172021_N0206_R012_T14QKG_20180319T211405.tif",
+        "S2B_MSIL2A_20180103T172709_N0206_R012_T13QFB_20180103T192359.tif"
+    ]
+    out = run_tile_shards(_describe_shard, image_paths, processes=2, temp_root=str(tmp_path), args=(".done",))
+    assert out["T13QFB"][0] == ["S2B_MSIL2A_20180103T172709_N0206_R012_T13QFB_20180103T192359.tif.done",
+                                "S2A_MSIL2A_20180329T171921_N0206_R012_T13QFB_20180329T221746.tif.done"]
+    assert out["T14QKG"][1] == os.path.join(str(tmp_path), "T14QKG")
+    assert out["T13QFB"][2] != os.getpid()
@@ -0,0 +1,220 @@
+import json
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+import requests
+import requests.adapters
+
+from pyeo.planet_downloads import PlanetDownloader, RateLimiter, split_date_range
+
+
+class FakePlanetAPI(object):
+    """A local stand-in for the Planet data API. Each asset becomes active after a few polls following its
+    activation, and every third request for an asset is refused with a 429. Quick searches over items return pages
+    of page_size items, each taking page_delay seconds to fetch. If server_errors is True, the first request for each
+    asset and each download gets a 503."""
+    def __init__(self, polls_to_activate=2, items=(), page_size=2, page_delay=0, server_errors=False):
+        self.server_errors = server_errors
+        self.failed_once = set()
+        self.polls_to_activate = polls_to_activate
+        self.items = list(items)
+        self.page_size = page_size
+        self.page_delay = page_delay
+        self.searches = []
+        self.events = []
+        self.polls = {}
+        self.activations = {}
+        self.requests = 0
+        self.refused = 0
+        self.lock = threading.Lock()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send(self, status, body=b"", content_type="application/json"):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                if status == 429:
+                    self.send_header("Retry-After", "0")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                parts = self.path.strip("/").split("/")
+                with api.lock:
+                    api.requests += 1
+                    refuse = api.requests % 3 == 0
+                if parts[0] == "pages":
+                    self._send_page(int(parts[1]), int(parts[2]))
+                    return
+                with api.lock:
+                    fail = api.server_errors and self.path not in api.failed_once
+                    api.failed_once.add(self.path)
+                if fail:
+                    self._send(503)
+                    return
+                if parts[0] == "download":
+                    with api.lock:
+                        api.events.append("download")
+                    self._send(200, parts[1].encode() * 10000, "image/tiff")
+                    return
+                if refuse:
+                    with api.lock:
+                        api.refused += 1
+                    self._send(429)
+                    return
+                item_id = parts[3]
+                with api.lock:
+                    if item_id in api.activations:
+                        api.polls[item_id] = api.polls.get(item_id, 0) + 1
+                    status = "inactive"
+                    if item_id in api.activations:
+                        status = "active" if api.polls[item_id] > api.polls_to_activate else "activating"
+                asset = {"status": status,
+                         "_links": {"activate": "{}/activate/{}".format(api.url, item_id)}}
+                if status == "active":
+                    asset["location"] = "{}/download/{}".format(api.url, item_id)
+                self._send(200, json.dumps({"analytic": asset}).encode())
+
+            def _send_page(self, search_number, page_number):
+                time.sleep(api.page_delay)
+                results = api.searches[search_number]
+                start = page_number * api.page_size
+                page = {"features": results[start:start + api.page_size], "_links": {}}
+                if start + api.page_size < len(results):
+                    page["_links"]["_next"] = "{}/pages/{}/{}".format(api.url, search_number, page_number + 1)
+                with api.lock:
+                    api.events.append("page")
+                self._send(200, json.dumps(page).encode())
+
+            def do_POST(self):
+                if self.path.strip("/") == "quick-search":
+                    body = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode())
+                    dates = body["filter"]["config"][0]["config"]
+                    results = [item for item in api.items
+                               if dates["gte"] <= item["properties"]["acquired"] <= dates["lte"]]
+                    with api.lock:
+                        api.searches.append(results)
+                        search_number = len(api.searches) - 1
+                    self._send_page(search_number, 0)
+                    return
+                item_id = self.path.strip("/").split("/")[1]
+                with api.lock:
+                    api.activations[item_id] = api.activations.get(item_id, 0) + 1
+                self._send(202)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("localhost", 0), Handler)
+        self.url = "http://localhost:{}".format(self.server.server_port)
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+
+
+def _make_items(count):
+    return [{"id": "item_{}".format(i), "properties": {"item_type": "PSScene4Band"}} for i in range(count)]
+
+
+def test_planet_downloader(tmp_path):
+    with FakePlanetAPI() as api:
+        downloader = PlanetDownloader("fake_key", str(tmp_path), max_downloads=2, requests_per_second=200,
+                                      poll_interval=0.01, max_poll_interval=0.05, retry_delay=0.01,
+                                      api_root=api.url + "/")
+        paths = downloader.run(_make_items(6) + _make_items(1))
+    assert sorted(paths) == ["item_{}".format(i) for i in range(6)]
+    for item_id, path in paths.items():
+        with open(path, "rb") as fp:
+            assert fp.read() == item_id.encode() * 10000
+    assert all(count == 1 for count in api.activations.values())
+    assert api.refused > 0
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith(".part")]
+
+
+def test_planet_downloader_retries_server_errors(tmp_path):
+    with FakePlanetAPI(polls_to_activate=0, server_errors=True) as api:
+        downloader = PlanetDownloader("fake_key", str(tmp_path), requests_per_second=200, poll_interval=0.01,
+                                      retry_delay=0.01, api_root=api.url + "/")
+        paths = downloader.run(_make_items(3))
+    assert all(path and os.path.exists(path) for path in paths.values())
+
+
+def test_planet_downloader_keeps_session_adapters():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(max_retries=3)
+    session.mount("https://", adapter)
+    PlanetDownloader(session=session)
+    assert session.get_adapter("https://api.planet.com/") is adapter
+
+
+def test_planet_downloader_accepts_async_items(tmp_path):
+    async def search():
+        for item in _make_items(3):
+            yield item
+
+    with FakePlanetAPI(polls_to_activate=0) as api:
+        downloader = PlanetDownloader("fake_key", str(tmp_path), requests_per_second=200, poll_interval=0.01,
+                                      retry_delay=0.01, api_root=api.url + "/")
+        paths = downloader.run(search())
+    assert len(paths) == 3
+    assert all(os.path.exists(path) for path in paths.values())
+
+
+def _make_dated_items(count):
+    return [{"id": "item_{}".format(i),
+             "properties": {"item_type": "PSScene4Band",
+                            "acquired": "2019-01-{:02d}T10:00:00.000000Z".format(i + 1)}}
+            for i in range(count)]
+
+
+def test_split_date_range():
+    assert split_date_range("2019-01-01", "2019-01-25", 10) == [
+        ("2019-01-01T00:00:00.000000Z", "2019-01-11T00:00:00.000000Z"),
+        ("2019-01-11T00:00:00.000000Z", "2019-01-21T00:00:00.000000Z"),
+        ("2019-01-21T00:00:00.000000Z", "2019-01-25T00:00:00.000000Z")]
+    assert split_date_range("2019-01-01T00:00:00.000Z", "2019-01-02T12:00:00Z", None) == [
+        ("2019-01-01T00:00:00.000000Z", "2019-01-02T12:00:00.000000Z")]
+
+
+def test_planet_search():
+    aoi = {"type": "Point", "coordinates": [0, 0]}
+    with FakePlanetAPI(items=_make_dated_items(20) + _make_dated_items(3), page_size=3) as api:
+        downloader = PlanetDownloader("fake_key", requests_per_second=200, retry_delay=0.01,
+                                      api_root=api.url + "/")
+        items = downloader.run_search(aoi, "2019-01-01", "2019-01-31", ["PSScene4Band"], days_per_query=7)
+    assert sorted(item["id"] for item in items) == sorted("item_{}".format(i) for i in range(20))
+    assert len(api.searches) == 5
+    assert api.events.count("page") > len(api.searches)
+
+
+def test_planet_search_streams_into_downloads(tmp_path):
+    aoi = {"type": "Point", "coordinates": [0, 0]}
+    with FakePlanetAPI(polls_to_activate=0, items=_make_dated_items(6), page_size=1, page_delay=0.1) as api:
+        downloader = PlanetDownloader("fake_key", str(tmp_path), requests_per_second=200, poll_interval=0.01,
+                                      retry_delay=0.01, api_root=api.url + "/")
+        search = downloader.search(aoi, "2019-01-01", "2019-01-31", ["PSScene4Band"], days_per_query=None)
+        paths = downloader.run(search)
+    assert sorted(paths) == ["item_{}".format(i) for i in range(6)]
+    assert all(os.path.exists(path) for path in paths.values())
+    assert api.events.index("download") < len(api.events) - 1 - api.events[::-1].index("page")
+
+
+def test_rate_limiter():
+    import asyncio
+
+    async def acquire_many():
+        limiter = RateLimiter(50, burst=1)
+        for _ in range(11):
+            await limiter.acquire()
+
+    start = time.monotonic()
+    asyncio.new_event_loop().run_until_complete(acquire_many())
+    assert time.monotonic() - start == pytest.approx(0.2, abs=0.1)
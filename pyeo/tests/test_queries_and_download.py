@@ -1,7 +1,12 @@
+import io
 import os
 import shutil
+import tarfile
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
 
 import pytest
+import requests
 from sklearn.externals import joblib
 
 import pyeo.queries_and_downloads
@@ -43,7 +48,69 @@ def test_landsat_query_and_download():
     products = pyeo.queries_and_downloads.download_landsat_data(images, out_dir, test_conf)
 
 
+def _make_landsat_archive():
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for name in ("LC08_L1TP_012031_20180101_20180104_01_T1_B2.TIF", "LC08_L1TP_012031_20180101_20180104_01_T1_B5.TIF",
+                     "LC08_L1TP_012031_20180101_20180104_01_T1_MTL.txt"):
+            content = name.encode() * 1000
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def landsat_server():
+    """A local stand-in for the USGS download pages, serving a landing page and a product archive."""
+    archive = _make_landsat_archive()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/landing":
+                body = ('<html><input type="button" onclick="window.location=\'http://localhost:{}/download/STANDARD/EE'
+                        '\'" value="Level-1 GeoTIFF Data Product"/></html>').format(server.server_port).encode()
+            elif self.path == "/download/STANDARD/EE":
+                body = archive
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("localhost", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://localhost:{}".format(server.server_port)
+    server.shutdown()
+
+
+def test_stream_landsat_product(tmp_path, landsat_server):
+    session = requests.Session()
+    url = pyeo.queries_and_downloads.get_landsat_download_url(session, landsat_server + "/landing")
+    assert url == landsat_server + "/download/STANDARD/EE"
+    out_folder = os.path.join(str(tmp_path), "LC08_L1TP_012031_20180101_20180104_01_T1")
+    pyeo.queries_and_downloads.stream_landsat_product(session, url, out_folder, bands=("B2",))
+    assert sorted(os.listdir(out_folder)) == ["LC08_L1TP_012031_20180101_20180104_01_T1_B2.TIF",
+                                              "LC08_L1TP_012031_20180101_20180104_01_T1_MTL.txt"]
+    assert not os.path.exists(out_folder + ".partial")
+
+
 @pytest.mark.webtest
+def test_planet_query_search_name_is_deprecated(tmp_path):
+    with pytest.warns(DeprecationWarning), pytest.raises(FileNotFoundError):
+        pyeo.queries_and_downloads.planet_query(os.path.join(str(tmp_path), "missing_aoi.geojson"), "2019-01-01",
+                                                "2019-01-02", str(tmp_path), "fake_key", search_name="my_search")
+    request = pyeo.queries_and_downloads.build_search_request({"type": "Point", "coordinates": [0, 0]},
+                                                              "2019-01-01", "2019-01-02", "PSScene4Band", "my_search")
+    assert request["name"] == "my_search"
+
+
 def test_google_cloud_dl():
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
     try:
@@ -3,11 +3,15 @@ import os
 import shutil
 
 import gdal
+import numpy as np
 import osr
+from osgeo import gdal_array
 import pytest
 
+import pyeo.coordinate_manipulation
 import pyeo.filesystem_utilities
 import pyeo.raster_manipulation
+from pyeo.exceptions import DatatypeOverflowException
 
 
 @pytest.mark.skip
@@ -112,6 +116,89 @@ def test_reprojection():
     result_array = result.GetVirtualMemArray()
     assert result_array.max() > 10
 
+
+def test_reprojection_to_aligned_grid():
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        os.remove(r"test_outputs/aligned_reprojection_test.tif")
+    except FileNotFoundError:
+        pass
+    image = r"test_data/composite_T36MZE_20190509T073621_20190519T073621_clipped.tif"
+    out_file = r"test_outputs/aligned_reprojection_test.tif"
+    pyeo.raster_manipulation.reproject_image(image, out_file, 32736, resolution=10, num_threads=2)
+    result = gdal.Open(out_file)
+    gt = result.GetGeoTransform()
+    assert gt[1] == 10 and gt[5] == -10
+    assert gt[0] % 10 == 0 and gt[3] % 10 == 0
+
+
+def test_creation_options():
+    try:
+        pyeo.raster_manipulation.set_creation_options(COMPRESS="ZSTD", NUM_THREADS=None)
+        int_options = pyeo.raster_manipulation.get_creation_options(datatype=gdal.GDT_Int32)
+        assert "COMPRESS=ZSTD" in int_options and "PREDICTOR=2" in int_options
+        assert not any(option.startswith("NUM_THREADS") for option in int_options)
+        assert "PREDICTOR=3" in pyeo.raster_manipulation.get_creation_options(datatype=gdal.GDT_Float32)
+        assert pyeo.raster_manipulation.get_creation_options("MEM", gdal.GDT_Int32) == []
+    finally:
+        pyeo.raster_manipulation.reset_creation_options()
+
+
+def test_get_common_datatype():
+    mem_driver = gdal.GetDriverByName("MEM")
+    uint16_image = mem_driver.Create("", 1, 1, 2, gdal.GDT_UInt16)
+    byte_image = mem_driver.Create("", 1, 1, 1, gdal.GDT_Byte)
+    int16_image = mem_driver.Create("", 1, 1, 1, gdal.GDT_Int16)
+    assert pyeo.raster_manipulation.get_common_datatype([uint16_image, byte_image]) == gdal.GDT_UInt16
+    assert pyeo.raster_manipulation.get_common_datatype([uint16_image, int16_image]) == gdal.GDT_Int32
+    assert pyeo.raster_manipulation.get_common_datatype([byte_image], values=(-9999,)) == gdal.GDT_Int16
+
+
+def test_new_image_datatype_from_rasters():
+    mem_driver = gdal.GetDriverByName("MEM")
+    uint16_image = mem_driver.Create("", 1, 1, 2, gdal.GDT_UInt16)
+    byte_image = mem_driver.Create("", 1, 1, 1, gdal.GDT_Byte)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32630)
+    gt = (500000, 10, 0, 5000, 0, -10)
+    new_image = pyeo.raster_manipulation.create_new_image_from_geotransform(gt, 2, 2, "", 3, srs.ExportToWkt(),
+                                                                           format="MEM",
+                                                                           rasters=[uint16_image, byte_image])
+    assert new_image.GetRasterBand(1).DataType == gdal.GDT_UInt16
+    assert new_image.GetRasterBand(3).GetNoDataValue() is None
+    new_image = pyeo.raster_manipulation.create_new_image_from_geotransform(gt, 2, 2, "", 2, srs.ExportToWkt(),
+                                                                           format="MEM", nodata=-9999)
+    assert [new_image.GetRasterBand(band).GetNoDataValue() for band in (1, 2)] == [-9999, -9999]
+    polygon = pyeo.coordinate_manipulation.get_raster_bounds(new_image)
+    new_image = pyeo.raster_manipulation.create_new_image_from_polygon(polygon, "", 10, 10, 1, srs.ExportToWkt(),
+                                                                      format="MEM", rasters=[byte_image])
+    assert new_image.GetRasterBand(1).DataType == gdal.GDT_Byte
+    new_image = pyeo.raster_manipulation.create_new_image_from_polygon(polygon, "", 10, 10, 1, srs.ExportToWkt(),
+                                                                      format="MEM")
+    assert new_image.GetRasterBand(1).DataType == gdal.GDT_Int32
+
+
+def test_check_datatype_fits():
+    pyeo.raster_manipulation.check_datatype_fits(np.array([0, 65535], dtype=np.int32), gdal.GDT_UInt16)
+    with pytest.raises(DatatypeOverflowException):
+        pyeo.raster_manipulation.check_datatype_fits(np.array([-1, 10], dtype=np.int32), gdal.GDT_UInt16)
+
+
+def test_save_as_cog():
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        os.remove(r"test_outputs/cog_test.tif")
+    except FileNotFoundError:
+        pass
+    image = r"test_data/composite_T36MZE_20190509T073621_20190519T073621_clipped.tif"
+    out_file = r"test_outputs/cog_test.tif"
+    pyeo.raster_manipulation.save_as_cog(image, out_file)
+    result = gdal.Open(out_file)
+    assert result.GetRasterBand(1).GetOverviewCount() > 0
+    assert result.GetMetadata("IMAGE_STRUCTURE")["COMPRESSION"] == "DEFLATE"
+    assert result.GetRasterBand(1).GetBlockSize() == [512, 512]
+
+
 @pytest.mark.skip
 def test_buffered_composite():
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
@@ -198,6 +285,55 @@ def test_mask_combination():
     assert not mask_2.GetVirtualMemArray().all == False
 
 
+def test_n_way_mask_combination(tmp_path):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32630)
+    mask_arrays = [np.ones((10, 10), dtype=np.uint8) for _ in range(3)]
+    mask_arrays[0][2, :] = 0
+    mask_arrays[1][:, 3] = 0
+    mask_arrays[2][5, 3] = 0
+    mask_paths = []
+    for i, mask_array in enumerate(mask_arrays):
+        mask_path = os.path.join(str(tmp_path), "mask_{}.msk".format(i))
+        # The third mask is shifted right by five pixels, so only half of it overlaps the others
+        pyeo.raster_manipulation.save_array_as_image(mask_array, mask_path, [500000 + 50*(i == 2), 10, 0, 5000, 0, -10],
+                                                     srs.ExportToWkt())
+        mask_paths.append(mask_path)
+    out_path = os.path.join(str(tmp_path), "and.msk")
+    pyeo.raster_manipulation.combine_masks(mask_paths, out_path, combination_func="and", geometry_func="union",
+                                           block_rows=3, num_threads=2)
+    out_array = gdal.Open(out_path).ReadAsArray()
+    assert out_array.shape == (10, 15)
+    assert np.array_equal(out_array[:, :5], np.logical_and(mask_arrays[0], mask_arrays[1])[:, :5])
+    assert out_array[5, 8] == 0 and out_array[2, 8] == 0 and out_array[3, 8] == 1 and out_array[2, 12] == 1
+    out_path = os.path.join(str(tmp_path), "nor.msk")
+    pyeo.raster_manipulation.combine_masks(mask_paths[:2], out_path, combination_func="nor")
+    assert np.array_equal(gdal.Open(out_path).ReadAsArray(),
+                          np.logical_not(np.logical_or(mask_arrays[0], mask_arrays[1])))
+    with pytest.raises(Exception):
+        pyeo.raster_manipulation.combine_masks(mask_paths, out_path, combination_func="xor")
+
+
+@pytest.mark.parametrize("buffer_size, block_rows", [(4, 50), (6, 3)])
+def test_buffer_mask_in_place(tmp_path, buffer_size, block_rows):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32630)
+    mask_array = np.ones((300, 40), dtype=np.uint8)
+    mask_array[[5, 101, 102, 250], [20, 0, 39, 17]] = 0
+    mask_path = os.path.join(str(tmp_path), "buffer.msk")
+    pyeo.raster_manipulation.save_array_as_image(mask_array, mask_path, [500000, 10, 0, 5000, 0, -10],
+                                                 srs.ExportToWkt())
+    pyeo.raster_manipulation.buffer_mask_in_place(mask_path, buffer_size, block_rows=block_rows)
+    out_array = gdal.Open(mask_path).ReadAsArray()
+    # Every pixel within buffer_size pixels of a masked pixel is masked, even across strip boundaries and when the
+    # strips are thinner than the buffer
+    y, x = np.mgrid[0:300, 0:40]
+    expected = np.ones((300, 40), dtype=bool)
+    for masked_y, masked_x in zip(*np.nonzero(mask_array == 0)):
+        expected[(y - masked_y)**2 + (x - masked_x)**2 <= buffer_size**2] = False
+    assert np.array_equal(out_array.astype(bool), expected)
+
+
 def test_mask_from_confidence_layer():
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
     try:
@@ -211,6 +347,83 @@ def test_mask_from_confidence_layer():
         buffer_size=3)
 
 
+def test_class_lookup():
+    scl_array = np.array([[0, 4, 5], [6, 8, 9]], dtype=np.uint8)
+    expected = np.isin(scl_array, pyeo.raster_manipulation.SCL_CLEAR_CLASSES)
+    assert np.array_equal(pyeo.raster_manipulation.class_lookup(scl_array, (4, 5, 6)), expected)
+    assert np.array_equal(pyeo.raster_manipulation.class_lookup(scl_array.astype(np.int32), (4, 5, 6), invert=True),
+                          np.logical_not(expected))
+
+
+def test_parse_mask_strategy():
+    assert pyeo.raster_manipulation.parse_mask_strategy("SCL + fmask") == ("scl", "fmask")
+    with pytest.raises(ValueError):
+        pyeo.raster_manipulation.parse_mask_strategy("scl+clouds")
+
+
+def test_scl_only_mask():
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        os.remove("test_outputs/masks/scl_mask.tif")
+    except FileNotFoundError:
+        pass
+    pyeo.raster_manipulation.create_cloud_mask(
+        "test_data/S2A_MSIL2A_20170922T025541_N0205_R032_T48MXU_20170922T031450.SAFE",
+        "test_outputs/masks/scl_mask.tif",
+        strategy="scl")
+    assert gdal.Open("test_outputs/masks/scl_mask.tif").GetGeoTransform()[1] == 10
+
+
+def test_project_cloud_shadows():
+    cloud = np.zeros((40, 20), dtype=np.bool_)
+    cloud[30, 10] = True
+    # Sun due south, 45 degrees up: clouds 500m to 1500m high cast shadows 5 to 15 pixels of 100m to the north
+    shadow = pyeo.raster_manipulation.project_cloud_shadows(cloud, 45, 180, 100, 500, 1500)
+    assert shadow[15:26, 10].all()
+    assert shadow.sum() == 11
+
+
+def test_detect_clouds_and_shadows():
+    shape = (40, 40)
+    blue, green, red, nir, swir = [np.full(shape, value, dtype=np.float32) for value in (0.05, 0.08, 0.06, 0.3, 0.2)]
+    for band, value in zip((blue, green, red, nir, swir), (0.5, 0.5, 0.5, 0.5, 0.4)):
+        band[25:30, 5:10] = value
+    nir[5:10, 5:10] = 0.05
+    swir[5:10, 5:10] = 0.05
+    cloud, shadow = pyeo.raster_manipulation.detect_clouds_and_shadows(blue, green, red, nir, swir,
+                                                                       sun_angles=(45, 180), resolution=100,
+                                                                       min_cloud_height=1000,
+                                                                       max_cloud_height=2500)
+    assert cloud[25:30, 5:10].all()
+    assert cloud.sum() == 25
+    assert shadow[5:10, 5:10].all()
+    assert shadow.sum() == 25
+
+
+def test_estimate_dark_object():
+    array = np.full((400, 400), 1500, dtype=np.uint16)
+    array[:100, :] = 0       # Outside the image
+    array[200:220, :] = 900  # Dark water
+    array[300, 300] = 3      # A dead pixel, well below dark_fraction
+    dataset = gdal_array.OpenArray(array)
+    assert pyeo.raster_manipulation.estimate_dark_object(dataset, dark_fraction=0.01, sample_factor=1) == 900
+
+
+def test_dark_object_subtraction():
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        os.remove("test_outputs/dos_stack.tif")
+    except FileNotFoundError:
+        pass
+    pyeo.raster_manipulation.dark_object_subtraction(
+        "test_data/S2A_MSIL1C_20170922T025541_N0205_R032_T48MXU_20191021T161210.SAFE",
+        "test_outputs/dos_stack.tif", bands=("B02", "B03", "B04", "B08", "B11"))
+    image = gdal.Open("test_outputs/dos_stack.tif")
+    assert image.RasterCount == 5
+    assert image.GetGeoTransform()[1] == 10
+    assert image.GetRasterBand(5).GetDescription() == "B11"
+
+
 def test_fmask():
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
     try:
@@ -263,6 +476,40 @@ def test_mask_joining():
     assert 0 in out_array
 
 
+def test_masks_are_bit_packed():
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        os.remove("test_outputs/masks/packed_mask.tif")
+    except FileNotFoundError:
+        pass
+    pyeo.raster_manipulation.combine_masks(["test_data/masks/fmask_cloud_and_shadow.tif", "test_data/masks/confidence_mask.tif"],
+                       "test_outputs/masks/packed_mask.tif", combination_func="and", geometry_func="union")
+    out_image = gdal.Open("test_outputs/masks/packed_mask.tif")
+    assert out_image.GetRasterBand(1).GetMetadataItem("NBITS", "IMAGE_STRUCTURE") == "1"
+    strips = list(pyeo.raster_manipulation.read_mask_blocks(out_image, block_rows=100))
+    assert sum(strip.shape[0] for _, strip in strips) == out_image.RasterYSize
+    assert np.array_equal(np.concatenate([strip for _, strip in strips]), out_image.ReadAsArray().astype(bool))
+
+
+def test_get_masked_array_is_writable(tmp_path):
+    driver = gdal.GetDriverByName("GTiff")
+    raster_path = os.path.join(str(tmp_path), "raster.tif")
+    mask_path = os.path.join(str(tmp_path), "raster.msk")
+    raster = driver.Create(raster_path, 4, 4, 3, gdal.GDT_UInt16)
+    for band_index in range(1, 4):
+        raster.GetRasterBand(band_index).Fill(band_index)
+    mask = driver.Create(mask_path, 4, 4, 1, gdal.GDT_Byte)
+    mask_array = np.ones((4, 4), dtype=np.uint8)
+    mask_array[0, 0] = 0
+    mask.GetRasterBand(1).WriteArray(mask_array)
+    mask = None
+    masked_array = pyeo.raster_manipulation.get_masked_array(raster, mask_path)
+    assert masked_array.mask[:, 0, 0].all()
+    masked_array[1, 2, 2] = np.ma.masked
+    assert masked_array.mask[1, 2, 2]
+    assert not masked_array.mask[0, 2, 2] and not masked_array.mask[2, 2, 2]
+
+
 def test_s2_band_stacking():
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
     try:
@@ -282,6 +529,49 @@ def test_s2_band_stacking():
                                                     out_resolution=60)
 
 
+def test_ingest_bands(tmp_path):
+    driver = gdal.GetDriverByName("GTiff")
+    band_paths = []
+    arrays = []
+    for resolution in (10, 20):
+        size = 2000 // resolution
+        array = np.random.randint(1, 10000, (size, size)).astype(np.uint16)
+        band_path = os.path.join(str(tmp_path), "band_{}m.tif".format(resolution))
+        band = driver.Create(band_path, size, size, 1, gdal.GDT_UInt16)
+        band.SetGeoTransform((500000, resolution, 0, 4000000, 0, -resolution))
+        band.GetRasterBand(1).WriteArray(array)
+        band = None
+        band_paths.append(band_path)
+        arrays.append(array)
+    out_path = os.path.join(str(tmp_path), "stack.tif")
+    pyeo.raster_manipulation.ingest_bands(band_paths, out_path, 10, band_names=("B02", "B11"),
+                                          band_functions=(None, lambda rows: rows // 2), block_rows=64)
+    out_image = gdal.Open(out_path)
+    assert out_image.GetRasterBand(1).DataType == gdal.GDT_UInt16
+    assert out_image.GetRasterBand(2).GetDescription() == "B11"
+    out_array = out_image.ReadAsArray()
+    assert np.array_equal(out_array[0], arrays[0])
+    assert np.array_equal(out_array[1], np.repeat(np.repeat(arrays[1], 2, axis=0), 2, axis=1) // 2)
+
+
+def test_in_memory_scratch_directory():
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        os.remove("test_outputs/in_memory_resample.tif")
+    except FileNotFoundError:
+        pass
+    with pyeo.raster_manipulation.scratch_directory("/vsimem/") as scratch_dir:
+        assert pyeo.raster_manipulation.is_in_memory(scratch_dir + "/")
+        temp_path = os.path.join(scratch_dir, "mask.tif")
+        gdal.Translate(temp_path, "test_data/masks/confidence_mask.tif")
+        pyeo.raster_manipulation.resample_image_in_place(temp_path, 20)
+        pyeo.raster_manipulation.move_image(temp_path, "test_outputs/in_memory_resample.tif")
+        assert gdal.VSIStatL(temp_path) is None
+    assert not gdal.ReadDirRecursive(scratch_dir)
+    out_image = gdal.Open("test_outputs/in_memory_resample.tif")
+    assert out_image.GetGeoTransform()[1] == 20
+
+
 def test_band_maths():
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
     try:
@@ -2,6 +2,7 @@ from pyeo import validation
 from pyeo.filesystem_utilities import init_log
 import numpy as np
 import gdal
+import ogr
 import os
 import pytest
 
@@ -63,6 +64,35 @@ def test_convert_point_list_to_shapefile():
     assert os.path.exists(out_path)
 
 
+def test_save_point_list_to_geopackage():
+    image_path = r"test_data/class_composite_T36MZE_20190509T073621_20190519T073621.tif"
+    out_path = r"test_outputs/conversion_test.gpkg"
+    point_list = {
+        1: np.array([(0, 50), (10, 10)]),
+        2: np.array([(2000, 0)])
+    }
+    image = gdal.Open(image_path)
+    gt = image.GetGeoTransform()
+    validation.save_point_list_to_shapefile(point_list, out_path, gt, image.GetProjection(), produce_csv=True)
+    layer = ogr.Open(out_path).GetLayer(0)
+    assert layer.GetFeatureCount() == 3
+    feature = layer.GetNextFeature()
+    assert feature.GetField("class") == "1"
+    assert feature.GetGeometryRef().GetX() == gt[0] + 50.5*gt[1]
+    with open(r"test_outputs/conversion_test.csv") as csv_file:
+        assert len(csv_file.readlines()) == 4
+
+
+def test_save_point_list_to_shapefile_directory(tmp_path):
+    image_path = r"test_data/class_composite_T36MZE_20190509T073621_20190519T073621.tif"
+    out_path = os.path.join(str(tmp_path), "points")
+    image = gdal.Open(image_path)
+    validation.save_point_list_to_shapefile({1: np.array([(0, 50)])}, out_path, image.GetGeoTransform(),
+                                            image.GetProjection())
+    layer = ogr.Open(out_path).GetLayer(0)
+    assert layer.GetFeatureCount() == 1
+
+
 def test_point_allocation():
     #TODO: Get some working numbers for this from Qing.
     se_expected_overall = 0.01  # the standard error of the estimated overall accuracy that we would like to achieve
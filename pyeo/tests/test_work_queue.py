@@ -0,0 +1,123 @@
+import multiprocessing
+import os
+import time
+
+from pyeo.work_queue import FileWorkQueue, run_worker
+
+
+def _process_item(item):
+    # Appends rather than overwrites, so an item processed twice shows up as two lines
+    time.sleep(0.01)
+    with open(item, "a") as fp:
+        fp.write("{}\n".format(os.getpid()))
+
+
+def _worker(queue_dir):
+    run_worker(FileWorkQueue(queue_dir, lease_seconds=60), _process_item)
+
+
+def test_workers_process_every_item_once(tmp_path):
+    queue_dir = os.path.join(str(tmp_path), "queue")
+    items = [os.path.join(str(tmp_path), "item_{}".format(i)) for i in range(20)]
+    queue = FileWorkQueue(queue_dir)
+    assert queue.enqueue(items) == 20
+    assert queue.enqueue(items) == 0
+    workers = [multiprocessing.Process(target=_worker, args=(queue_dir,)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    for item in items:
+        with open(item) as fp:
+            assert len(fp.readlines()) == 1
+    assert queue.status() == {"todo": 0, "claimed": 0, "done": 20, "failed": 0}
+
+
+def test_stale_lease_is_reclaimed(tmp_path):
+    queue_dir = os.path.join(str(tmp_path), "queue")
+    dead_worker = FileWorkQueue(queue_dir, lease_seconds=10)
+    dead_worker.enqueue(["image_1"])
+    assert dead_worker.claim() == ("image_1", "image_1")
+    live_worker = FileWorkQueue(queue_dir, lease_seconds=10)
+    assert live_worker.claim() is None
+    old_time = time.time() - 60
+    os.utime(os.path.join(queue_dir, "claimed", "image_1"), (old_time, old_time))
+    assert live_worker.claim() == ("image_1", "image_1")
+    assert not dead_worker.renew("image_1")
+    live_worker.complete("image_1")
+    assert live_worker.claim() is None
+
+
+def test_failed_items_are_recorded(tmp_path):
+    queue = FileWorkQueue(os.path.join(str(tmp_path), "queue"))
+    queue.enqueue(["good", "bad"])
+
+    def function(item):
+        if item == "bad":
+            raise ValueError("Simulated failure")
+
+    assert run_worker(queue, function) == (1, 1)
+    assert queue.status()["failed"] == 1
+    queue.retry_failed()
+    assert queue.claim() == ("bad", "bad")
+
+
+def test_stale_lease_is_only_broken_once(tmp_path):
+    # Workers A and B both see the same stale lock; A breaks it and claims the item before B gets to it
+    queue_dir = os.path.join(str(tmp_path), "queue")
+    dead_worker = FileWorkQueue(queue_dir, lease_seconds=10)
+    dead_worker.enqueue(["image_1"])
+    dead_worker.claim()
+    lock_path = os.path.join(queue_dir, "claimed", "image_1")
+    old_time = time.time() - 60
+    os.utime(lock_path, (old_time, old_time))
+    worker_a = FileWorkQueue(queue_dir, lease_seconds=10)
+    worker_b = FileWorkQueue(queue_dir, lease_seconds=10)
+    lock_seen_by_b = worker_b._read_lock(lock_path)
+    assert worker_b._is_stale(lock_seen_by_b)
+    assert worker_a.claim() == ("image_1", "image_1")
+    assert not worker_b._break_stale_lease("image_1", lock_seen_by_b)
+    assert worker_a.owns("image_1")
+    assert worker_b.claim() is None
+    assert [name for name in os.listdir(os.path.join(queue_dir, "claimed"))] == ["image_1"]
+
+
+def test_item_failed_during_claim_is_released(tmp_path, monkeypatch):
+    # Another worker marks the item failed between the first check and the creation of the lock file
+    queue_dir = os.path.join(str(tmp_path), "queue")
+    queue = FileWorkQueue(queue_dir)
+    queue.enqueue(["image_1"])
+    is_finished = queue._is_finished
+    checks = []
+
+    def fail_after_first_check(name):
+        checks.append(name)
+        if len(checks) == 1:
+            with open(os.path.join(queue_dir, "failed", name), "w") as fp:
+                fp.write("other worker")
+            return False
+        return is_finished(name)
+
+    monkeypatch.setattr(queue, "_is_finished", fail_after_first_check)
+    assert queue.claim() is None
+    assert os.listdir(os.path.join(queue_dir, "claimed")) == []
+
+
+def test_lost_lease_is_not_completed(tmp_path):
+    queue_dir = os.path.join(str(tmp_path), "queue")
+    slow_worker = FileWorkQueue(queue_dir, lease_seconds=10)
+    slow_worker.enqueue(["image_1"])
+    other_worker = FileWorkQueue(queue_dir, lease_seconds=10)
+
+    def take_over(item):
+        # While the slow worker is busy, its lease goes stale and another worker claims the item
+        old_time = time.time() - 60
+        os.utime(os.path.join(queue_dir, "claimed", "image_1"), (old_time, old_time))
+        assert other_worker.claim() == ("image_1", "image_1")
+        time.sleep(0.1)
+
+    assert run_worker(slow_worker, take_over, heartbeat_seconds=0.02) == (0, 0)
+    assert other_worker.owns("image_1")
+    assert os.listdir(os.path.join(queue_dir, "done")) == []
+    assert other_worker.complete("image_1")
+    assert not slow_worker.complete("image_1")
@@ -16,7 +16,6 @@ import logging
 import datetime
 import json
 import csv
-import itertools
 
 gdal.UseExceptions()
 
@@ -91,63 +90,55 @@ def produce_stratified_validation_points(map_path, out_path, class_sample_counts
 
 def save_point_list_to_shapefile(class_sample_point_dict, out_path, geotransform, projection_wkt, produce_csv=False):
     """Saves a list of points to a shapefile at out_path. Need the gt and projection of the raster.
-    GT is needed to move each point to the centre of the pixel. Can also produce a .csv file for CoolEarth"""
+    GT is needed to move each point to the centre of the pixel. Can also produce a .csv file for CoolEarth.
+    If out_path ends in .gpkg or .fgb, writes a GeoPackage or FlatGeobuf instead; see
+    pyeo.coordinate_manipulation.write_points."""
     log = logging.getLogger(__name__)
     log.info("Saving point list to shapefile")
     log.debug("GT: {}\nProjection: {}".format(geotransform, projection_wkt))
-    driver = ogr.GetDriverByName("ESRI Shapefile")
-    data_source = driver.CreateDataSource(out_path)
-    srs = osr.SpatialReference()
-    srs.ImportFromWkt(projection_wkt)
-    layer = data_source.CreateLayer("validation_points", srs, ogr.wkbPoint)
-    class_field = ogr.FieldDefn("class", ogr.OFTString)
-    class_field.SetWidth(24)
-    layer.CreateField(class_field)
-
-    for map_class, point_list in class_sample_point_dict.items():
-        for point in point_list:
-            feature = ogr.Feature(layer.GetLayerDefn())
-            coord = pyeo.coordinate_manipulation.pixel_to_point_coordinates(point, geotransform)
-            offset = geotransform[1]/2   # Adds half a pixel offset so points end up in the center of pixels
-            wkt = "POINT({} {})".format(coord[0]+offset, coord[1]-offset) # Never forget about negative y values in gts.
-            new_point = ogr.CreateGeometryFromWkt(wkt)
-            feature.SetGeometry(new_point)
-            feature.SetField("class", map_class)
-            layer.CreateFeature(feature)
-            feature = None
-
-    layer = None
-    data_source = None
+
+    # Convert every point at once, with a half pixel offset so points end up in the center of pixels
+    map_classes = list(class_sample_point_dict.keys())
+    class_coords = [pyeo.coordinate_manipulation.pixels_to_points(class_sample_point_dict[map_class], geotransform,
+                                                                  pixel_centre=True)
+                    for map_class in map_classes]
+    coords = np.concatenate(class_coords) if class_coords else np.empty((0, 2))
+    classes = np.repeat(np.array([str(map_class) for map_class in map_classes], dtype=object),
+                        [len(class_coord) for class_coord in class_coords])
+
+    pyeo.coordinate_manipulation.write_points(coords, out_path, projection_wkt, fields={"class": classes},
+                                              layer_name="validation_points")
 
     if produce_csv:
         csv_out_path = out_path.rsplit('.')[0] + ".csv"
         with open(csv_out_path, "w") as csv_file:
             writer = csv.writer(csv_file)
             writer.writerow(["id", "yCoordinate", "xCoordinate"])
-
-            # Join all points create single dimesional list of points (and revise the '*' operator)
-            for id,  point in enumerate(itertools.chain(*class_sample_point_dict.values())):
-                coord = pyeo.coordinate_manipulation.pixel_to_point_coordinates(point, geotransform)
-                offset = geotransform[1] / 2  # Adds half a pixel offset so points end up in the center of pixels
-                lat = coord[0] + offset
-                lon = coord[1] - offset
-                writer.writerow([id, lon, lat])
+            writer.writerows([id, y, x] for id, (x, y) in enumerate(coords.tolist()))
         log.info("CSV out at: {}".format(csv_out_path))
 
 
 def stratified_random_sample(map_path, class_sample_count, no_data=None, seed = None):
-    """Produces a stratified list of pixel coordinates. WARNING: high mem!"""
+    """Produces a stratified sample of pixel coordinates: a dictionary of {class: array}, where each array has shape
+    (N, 2) and each row is the (y, x) index of a pixel. Draws each class from the flat indicies of its pixels rather
+    than building a list of every pixel."""
     log = logging.getLogger(__name__)
     if not seed:
         seed = datetime.datetime.now().timestamp()
+    random_state = np.random.RandomState(int(seed) % 2**32)
     map = gdal.Open(map_path)
     map_array = map.GetVirtualMemArray()
-    class_dict = build_class_dict(map_array, no_data)
-    map_array = None
     out_coord_dict = {}
     for map_class, sample_count in class_sample_count.items():
-        map_class_samples = random.sample(class_dict[int(map_class)], class_sample_count[map_class])
-        out_coord_dict.update({map_class: map_class_samples})
+        if int(map_class) == no_data:
+            continue
+        class_indicies = np.flatnonzero(map_array == int(map_class))
+        if sample_count > class_indicies.size:
+            raise ValueError("Sample larger than population: {} points requested from class {} with {} pixels"
+                             .format(sample_count, map_class, class_indicies.size))
+        chosen = random_state.choice(class_indicies, sample_count, replace=False)
+        out_coord_dict.update({map_class: np.stack(np.unravel_index(chosen, map_array.shape), axis=1)})
+    map_array = None
     return out_coord_dict
 
 
@@ -0,0 +1,277 @@
+"""
+pyeo.work_queue
+---------------
+A work queue kept in a directory on a shared filesystem, for spreading jobs such as sen2cor over any number of
+worker processes on one or many machines, with or without a batch scheduler.
+
+The queue directory contains four subdirectories:
+
+- todo/ : one file per item; the file contains the item (usually a path)
+- claimed/ : a lock file per item being worked on, containing the owner of the lease
+- done/ : a marker file per finished item
+- failed/ : a file per failed item, containing the error
+
+An item is claimed by creating its lock file with O_CREAT | O_EXCL, which only one process can do. Workers renew
+their lease by touching the lock file while they work; a lock file that has not been touched for lease_seconds is
+treated as belonging to a dead worker, and the item can be claimed again. A stale lock file is not deleted but renamed
+aside and checked again, so a worker that was beaten to it by another worker puts the other worker's new lock back
+rather than deleting it. A worker checks that it still owns its lock after creating it, and a worker that loses its
+lease while working does not mark the item done or failed; that is left to the worker that took it over.
+
+SQLite was not used as its locking is unreliable on NFS.
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+log = logging.getLogger("pyeo")
+
+
+class FileWorkQueue(object):
+    """
+    A work queue in queue_dir. See the module documentation for details.
+
+    Parameters
+    ----------
+    queue_dir
+        The directory holding the queue. Will be created if it does not exist.
+    lease_seconds
+        How long a claim lasts without being renewed before it is considered stale.
+    """
+    def __init__(self, queue_dir, lease_seconds=1800):
+        self.queue_dir = queue_dir
+        self.lease_seconds = lease_seconds
+        self.worker_id = "{}-{}-{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        for sub_dir in ("todo", "claimed", "done", "failed"):
+            os.makedirs(os.path.join(queue_dir, sub_dir), exist_ok=True)
+
+    def _path(self, sub_dir, name):
+        return os.path.join(self.queue_dir, sub_dir, name)
+
+    def enqueue(self, items):
+        """
+        Adds items to the queue. Items that are already queued, done or failed are not added again.
+
+        Parameters
+        ----------
+        items
+            An iterable of strings, usually paths. The basename of each item is used as its name in the queue.
+
+        Returns
+        -------
+        The number of new items
+        """
+        new_items = 0
+        for item in items:
+            name = os.path.basename(item.rstrip("/"))
+            if os.path.exists(self._path("todo", name)):
+                continue
+            temp_path = self._path("todo", ".{}.{}".format(name, self.worker_id))
+            with open(temp_path, "w") as fp:
+                fp.write(item)
+            os.replace(temp_path, self._path("todo", name))
+            new_items += 1
+        log.info("Added {} items to queue {}".format(new_items, self.queue_dir))
+        return new_items
+
+    def status(self):
+        """Returns a dictionary of the number of items that are todo (not yet finished), claimed, done and failed."""
+        out = {}
+        for sub_dir in ("todo", "claimed", "done", "failed"):
+            out[sub_dir] = len([name for name in os.listdir(os.path.join(self.queue_dir, sub_dir))
+                                if not name.startswith(".")])
+        out["todo"] -= out["done"] + out["failed"]
+        return out
+
+    def _read_lock(self, lock_path):
+        """Returns (mtime_ns, contents) of a lock file, or None if it does not exist."""
+        try:
+            mtime_ns = os.stat(lock_path).st_mtime_ns
+            with open(lock_path, "r") as fp:
+                return mtime_ns, fp.read()
+        except FileNotFoundError:
+            return None
+
+    def _is_stale(self, lock):
+        return lock is not None and time.time() - lock[0] / 1e9 > self.lease_seconds
+
+    def _break_stale_lease(self, name, stale_lock):
+        """Releases the lease on name, if its lock file is still the one that was judged stale. Returns True if the
+        lease was released."""
+        lock_path = self._path("claimed", name)
+        stale_path = self._path("claimed", ".stale.{}.{}".format(name, self.worker_id))
+        try:
+            os.rename(lock_path, stale_path)
+        except FileNotFoundError:
+            return False
+        # Another worker may have broken the lease and claimed the item since we looked at it, in which case we have
+        # just taken its fresh lock; if so, put it back.
+        if self._read_lock(stale_path) != stale_lock:
+            try:
+                os.link(stale_path, lock_path)   # Unlike rename, fails rather than replacing a newer lock
+            except FileExistsError:
+                log.warning("Lock on {} changed hands while its lease was being broken".format(name))
+            os.remove(stale_path)
+            return False
+        try:
+            owner = json.loads(stale_lock[1])["worker"]
+        except (ValueError, KeyError):
+            owner = "unknown"
+        log.warning("Lease on {} held by {} is stale; releasing it".format(name, owner))
+        os.remove(stale_path)
+        return True
+
+    def claim(self):
+        """
+        Claims the next free item in the queue.
+
+        Returns
+        -------
+        A tuple of (name, item), or None if there is nothing left to claim.
+        """
+        for name in sorted(os.listdir(os.path.join(self.queue_dir, "todo"))):
+            if name.startswith("."):
+                continue
+            if self._is_finished(name):
+                continue
+            lock_path = self._path("claimed", name)
+            lock = self._read_lock(lock_path)
+            if lock is not None:
+                if not self._is_stale(lock) or not self._break_stale_lease(name, lock):
+                    continue
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue   # Someone else got there first
+            with os.fdopen(fd, "w") as fp:
+                fp.write(json.dumps({"worker": self.worker_id, "claimed": time.time()}))
+            # A worker breaking what it saw as a stale lease may have taken our new lock between the create and now
+            if not self.owns(name):
+                log.warning("Lock on {} was taken by another worker while it was being claimed".format(name))
+                continue
+            # It may have been finished between the check above and the claim
+            if self._is_finished(name):
+                os.remove(lock_path)
+                continue
+            with open(self._path("todo", name), "r") as fp:
+                item = fp.read()
+            log.info("{} claimed {}".format(self.worker_id, name))
+            return name, item
+        return None
+
+    def _is_finished(self, name):
+        return os.path.exists(self._path("done", name)) or os.path.exists(self._path("failed", name))
+
+    def owns(self, name):
+        """Returns True if this worker still holds the lease on name."""
+        try:
+            with open(self._path("claimed", name), "r") as fp:
+                return json.loads(fp.read())["worker"] == self.worker_id
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def renew(self, name):
+        """Renews the lease on name. Returns False if the lease has been lost."""
+        if not self.owns(name):
+            return False
+        os.utime(self._path("claimed", name))
+        return True
+
+    def complete(self, name):
+        """Marks name as done and releases its lease. If the lease has been lost, the item is left to the worker
+        that now holds it, and False is returned."""
+        if not self.owns(name):
+            log.warning("Lease on {} was lost before it completed; leaving it to its new owner".format(name))
+            return False
+        with open(self._path("done", name), "w") as fp:
+            fp.write(self.worker_id)
+        self._release(name)
+        return True
+
+    def fail(self, name, error=""):
+        """Marks name as failed, recording error, and releases its lease. Failed items are not claimed again
+        until retry_failed is called. If the lease has been lost, the item is left to the worker that now holds it,
+        and False is returned."""
+        if not self.owns(name):
+            log.warning("Lease on {} was lost before it failed; leaving it to its new owner".format(name))
+            return False
+        with open(self._path("failed", name), "w") as fp:
+            fp.write("{}\n{}".format(self.worker_id, error))
+        self._release(name)
+        return True
+
+    def retry_failed(self):
+        """Returns every failed item to the queue."""
+        for name in os.listdir(os.path.join(self.queue_dir, "failed")):
+            os.remove(self._path("failed", name))
+
+    def _release(self, name):
+        if self.owns(name):
+            os.remove(self._path("claimed", name))
+
+
+def run_worker(queue, function, heartbeat_seconds=None):
+    """
+    Claims and processes items from a FileWorkQueue until none are left. The lease on each item is renewed in a
+    background thread while function runs.
+
+    Parameters
+    ----------
+    queue
+        A FileWorkQueue object
+    function
+        A function taking a single item from the queue. If it raises an exception, the item is marked as failed.
+    heartbeat_seconds
+        How often to renew the lease. Defaults to a third of the lease time of the queue.
+
+    Returns
+    -------
+    A tuple of (number of items done, number of items failed) by this worker. Items whose lease was lost while they
+    were processed are counted as neither, and left to the worker that took them over.
+
+    """
+    if heartbeat_seconds is None:
+        heartbeat_seconds = queue.lease_seconds / 3
+    done = 0
+    failed = 0
+    while True:
+        claimed = queue.claim()
+        if claimed is None:
+            break
+        name, item = claimed
+        stop = threading.Event()
+        lease_lost = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(heartbeat_seconds):
+                if not queue.renew(name):
+                    log.warning("Lost lease on {}".format(name))
+                    lease_lost.set()
+                    return
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            function(item)
+        except Exception:
+            log.exception("Processing {} failed".format(name))
+            stop.set()
+            heartbeat_thread.join()
+            # If the lease was lost, another worker has the item; its result is the one that counts
+            if not lease_lost.is_set() and queue.fail(name, traceback.format_exc()):
+                failed += 1
+        else:
+            stop.set()
+            heartbeat_thread.join()
+            if lease_lost.is_set():
+                log.warning("Not marking {} done; another worker now holds it".format(name))
+            elif queue.complete(name):
+                done += 1
+    log.info("Worker {} finished: {} done, {} failed".format(queue.worker_id, done, failed))
+    return done, failed